@@ -1,11 +1,34 @@
 import struct
+import array
 import sys
 import os
+import hashlib
+import shutil
+import mmap
+import io
+import csv
+import json
+import re
+import time
+import socket
+import tempfile
+import collections
+import difflib
+import gc
+import threading
+import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import xml.etree.cElementTree as ET
 
 import subprocess
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def debug(*args):
     if False:
@@ -116,6 +139,7 @@ class TagType(object):
         self.interfaces = []
         self.hsh = 0
         self.tag = None
+        self.plan = None
 
     def __str__(self):
         if self.mSubType != None:
@@ -155,6 +179,12 @@ class TagType(object):
     def tupleSize(self):
         return self.mFormatInfo >> 8
 
+    @property
+    def key(self):
+        # Identifies the same type across files.
+        return (self.name, tuple((x.name, x.value.key if x.isType and x.value != None else x.value)
+                                 for x in self.templates))
+
 
 class TagObject(object):
     def __init__(self, value, typ):
@@ -172,6 +202,448 @@ class TagItem(object):
         self.value = None
 
 
+class TagGraphWalker(object):
+    """Depth-first traversal driven by an explicit stack instead of recursion.
+
+    ``enter(node)`` is called when a node is reached and returns its children
+    (any iterable, consumed lazily, or None for a leaf). ``leave(node)`` is
+    called once all of the children have been walked.
+    """
+
+    @staticmethod
+    def walk(root, enter, leave=None):
+        stack = [(root, iter(enter(root) or ()))]
+
+        while stack:
+            node, children = stack[-1]
+
+            for child in children:
+                stack.append((child, iter(enter(child) or ())))
+                break
+
+            else:
+                stack.pop()
+
+                if leave != None:
+                    leave(node)
+
+
+class TagItemReference(object):
+    """Stands in for the contents of an item a depth-limited read did not follow."""
+
+    def __init__(self, index, item):
+        self.index = index
+        self.item = item
+
+
+class TagDecodeContext(object):
+    def __init__(self, values=None, currPatch=None):
+        # Item -> decoded elements for this decode only, or None to cache
+        # them in TagItem.value.
+        self.values = values
+        # Type index -> number of PTCH offsets consumed, or None to read
+        # items at their ITEM offsets.
+        self.currPatch = currPatch
+
+
+class TagDecodePlan(object):
+    """Flattened layout of one element of a type.
+
+    All primitive and item index fields reachable without leaving the element
+    are unpacked by a single struct call; tree mirrors the nesting of classes
+    and tuples and says where each field's value sits in the unpacked tuple.
+    Tree nodes are (subType, type, payload) where payload is a list of
+    (name, node) for classes, a list of nodes for tuples and the field's
+    [offset, format, position] otherwise.
+    """
+
+    def __init__(self, typ):
+        self.typ = typ
+        self.fields = []
+        self.primitive = True
+        self.tree = self.addFields(typ, 0)
+        self.fields.sort(key=lambda x: x[0])
+
+        for i, field in enumerate(self.fields):
+            field[2] = i
+
+        self.stringPositions = [i for i, field in enumerate(self.fields) if field[3] == TagSubType.String]
+
+        # Overlapping fields can't be described by one format string.
+        self.struct = None
+        self.structs = None
+        fmt = "<"
+        end = 0
+        for offset, format, position, subType in self.fields:
+            if offset < end:
+                self.structs = [(x[0], struct.Struct("<" + x[1])) for x in self.fields]
+                break
+
+            if offset > end:
+                fmt += "{}x".format(offset - end)
+
+            fmt += format
+            end = offset + struct.calcsize("<" + format)
+
+        else:
+            self.struct = struct.Struct(fmt)
+
+    def addFields(self, typOrg, offset):
+        typ = typOrg.superType
+
+        if typ.subType == TagSubType.Class:
+            return (typ.subType, typOrg, [(x.name, self.addFields(x.typ, offset + x.byteOffset))
+                                          for x in typ.allMembers])
+
+        elif typ.subType == TagSubType.Tuple:
+            size = typ.mSubType.superType.byteSize
+            return (typ.subType, typOrg, [self.addFields(typ.mSubType, offset + x * size)
+                                          for x in xrange(typ.tupleSize)])
+
+        if typ.subType == TagSubType.Bool or typ.subType == TagSubType.Int:
+            format = TagReader.getFormatString(typ.mFormatInfo)
+
+        elif typ.subType == TagSubType.Float:
+            format = "f"
+
+        else:
+            format = "I"
+
+        if typ.subType != TagSubType.Bool and typ.subType != TagSubType.Int and typ.subType != TagSubType.Float:
+            self.primitive = False
+
+        field = [offset, format.lstrip("<"), None, typ.subType]
+        self.fields.append(field)
+        return (typ.subType, typOrg, field)
+
+    @staticmethod
+    def get(typ):
+        # Cached on the type, which readers share across files.
+        if typ.plan == None:
+            typ.plan = TagDecodePlan(typ)
+
+        return typ.plan
+
+    def unpack(self, data, offset):
+        if self.struct != None:
+            return self.struct.unpack_from(data, offset)
+
+        return tuple([s.unpack_from(data, offset + x)[0] for x, s in self.structs])
+
+    def build(self, node, values, items, pointers):
+        """Makes the TagObject for a tree node from one unpacked element.
+
+        items maps item indices to element lists and pointers collects
+        (object, item index) pairs to resolve once every item is built.
+        """
+        subType, typ, payload = node
+
+        if subType == TagSubType.Class:
+            return TagObject({name: self.build(x, values, items, pointers) for name, x in payload}, typ)
+
+        elif subType == TagSubType.Tuple:
+            return TagObject(tuple([self.build(x, values, items, pointers) for x in payload]), typ)
+
+        value = values[payload[2]]
+
+        if subType == TagSubType.Bool:
+            return TagObject(value > 0, typ)
+
+        elif subType == TagSubType.String:
+            return TagObject(value or "", typ)
+
+        elif subType == TagSubType.Array:
+            return TagObject(items[value] if value else [], typ)
+
+        elif subType == TagSubType.Pointer:
+            obj = TagObject(None, typ)
+            if value:
+                pointers.append((obj, value))
+
+            return obj
+
+        return TagObject(value, typ)
+
+
+class TagArrayView(object):
+    """Views items as NumPy structured arrays laid out by their types.
+
+    Members become fields at their byteOffset, tuples become subarrays and
+    the type's byteSize is the itemsize. Strings, pointers and arrays are
+    the uint32 item indices stored in DATA, which can be given to
+    getItemArray or TagReader.readItem in turn.
+    """
+
+    formats = {"B": "u1", "b": "i1", "H": "<u2", "h": "<i2", "I": "<u4", "i": "<i4", "Q": "<u8", "q": "<i8"}
+
+    @staticmethod
+    def getDtype(typ):
+        if numpy == None:
+            raise ValueError("NumPy is needed for array views")
+
+        sup = typ.superType
+
+        if sup.subType == TagSubType.Class:
+            members = [(x, TagArrayView.getDtype(x.typ)) for x in sup.allMembers]
+            members = [(x, dtype) for x, dtype in members if dtype != None]
+
+            return numpy.dtype({
+                "names": [x.name for x, dtype in members],
+                "formats": [dtype for x, dtype in members],
+                "offsets": [x.byteOffset for x, dtype in members],
+                "itemsize": sup.byteSize})
+
+        elif sup.subType == TagSubType.Tuple:
+            dtype = TagArrayView.getDtype(sup.mSubType)
+            if dtype == None:
+                return None
+
+            return numpy.dtype((dtype, (sup.tupleSize,)))
+
+        elif sup.subType == TagSubType.Bool:
+            return numpy.dtype("?" if sup.byteSize == 1 else "<u{}".format(sup.byteSize))
+
+        elif sup.subType == TagSubType.Int:
+            format = TagReader.getFormatString(sup.mFormatInfo).lstrip("<")
+            return numpy.dtype(TagArrayView.formats.get(format, "<u{}".format(sup.byteSize)))
+
+        elif sup.subType == TagSubType.Float:
+            return numpy.dtype("<f{}".format(sup.byteSize or 4))
+
+        elif sup.subType == TagSubType.String or sup.subType == TagSubType.Pointer or sup.subType & 0xF == TagSubType.Array:
+            return numpy.dtype("<u4")
+
+        return None
+
+    @staticmethod
+    def getItemArray(r, index, view=False):
+        """Returns all elements of an item as one array. index is anything
+        TagReader.readItem takes.
+
+        The array is a copy unless view is set, in which case it is a
+        read-only array over the reader's data. Closing the reader then
+        leaves the file mapped until the views are gone too.
+        """
+        item = r.items[r.resolveItemIndex(index)]
+        if item.typ == None:
+            raise ValueError("Item {} has no type".format(index))
+
+        elements = numpy.frombuffer(r.data, TagArrayView.getDtype(item.typ), item.count, item.offset)
+        if not view:
+            return elements.copy()
+
+        r.hasViews = True
+        return elements
+
+
+class TagArrayBlock(object):
+    """Elements of an array item given as one buffer instead of TagObjects.
+
+    An array TagObject may hold a NumPy array or an array.array in place of
+    its list of elements. Structured NumPy arrays are matched to the element
+    type's members by field name; string, pointer and array members are
+    object fields holding TagObjects or plain values, which are written per
+    element. Other arrays are flat runs of numbers and fit element types made
+    of one number format only, such as 12 floats per hkQsTransformf.
+
+    So arrays from TagArrayView write back as they are only for types
+    without strings, pointers and arrays; the item indices it gives for
+    those have to be replaced by object fields first.
+    """
+
+    def __init__(self, typ, value):
+        self.typ = typ
+        self.objects = []
+
+        if numpy != None and isinstance(value, numpy.ndarray) and value.dtype.names != None:
+            self.data = self.fromStructured(value)
+        else:
+            self.data = self.fromFlat(value)
+
+        size = typ.superType.byteSize
+        if len(self.data) % size != 0:
+            raise ValueError("Array of {} bytes doesn't hold a whole number of {}".format(len(self.data), typ.name))
+
+        self.count = len(self.data) // size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # What the elements reach, for passes that look for items.
+        return iter([obj for offset, obj in self.objects])
+
+    @staticmethod
+    def isArrayBacked(value):
+        return isinstance(value, array.array) or (numpy != None and isinstance(value, numpy.ndarray))
+
+    @staticmethod
+    def getFlatFormat(typ):
+        plan = TagDecodePlan.get(typ)
+        if not plan.primitive or plan.struct == None:
+            return None
+
+        formats = set([x[1] for x in plan.fields])
+        if len(formats) != 1:
+            return None
+
+        format = formats.pop()
+
+        # Fields are sorted and don't overlap, so they leave no gaps if they
+        # add up to the whole element.
+        if len(plan.fields) * struct.calcsize("<" + format) != typ.superType.byteSize:
+            return None
+
+        return format
+
+    def fromFlat(self, value):
+        format = TagArrayBlock.getFlatFormat(self.typ)
+        if format == None:
+            raise ValueError("{} is not made of numbers of one format".format(self.typ.name))
+
+        if isinstance(value, array.array):
+            # Integers only need to match in size, as they're written as is.
+            if (value.typecode in "fd") != (format in "fd") or value.itemsize != struct.calcsize("<" + format):
+                raise ValueError("array.array of '{}' can't hold {}".format(value.typecode, self.typ.name))
+
+            if sys.byteorder != "little":
+                value = array.array(value.typecode, value)
+                value.byteswap()
+
+            return value.tostring()
+
+        return numpy.ascontiguousarray(value, "<" + format).tobytes()
+
+    def fromStructured(self, value):
+        typ = self.typ.superType
+        dtype = TagArrayView.getDtype(self.typ)
+
+        if value.dtype == dtype and TagDecodePlan.get(self.typ).primitive:
+            return numpy.ascontiguousarray(value).tobytes()
+
+        members = {x.name: x for x in typ.allMembers}
+        data = numpy.zeros(len(value), dtype)
+
+        for name in value.dtype.names:
+            member = members.get(name)
+            if member == None:
+                raise ValueError("{} has no member {}".format(self.typ.name, name))
+
+            subType = member.typ.superType.subType
+
+            if subType == TagSubType.String or subType == TagSubType.Pointer or subType == TagSubType.Array:
+                if value.dtype.fields[name][0].kind != "O":
+                    # Such as the item indices of a TagArrayView array, which
+                    # mean nothing outside the file they were read from.
+                    raise ValueError("{}.{} must be an object field of values or TagObjects, not {}".format(
+                        self.typ.name, name, value.dtype.fields[name][0]))
+
+                for i, x in enumerate(value[name]):
+                    if x is None:
+                        continue
+
+                    obj = x if isinstance(x, TagObject) and x.typ == member.typ else TagObject(x, member.typ)
+                    self.objects.append((i * typ.byteSize + member.byteOffset, obj))
+
+            elif TagDecodePlan.get(member.typ).primitive:
+                data[name] = value[name]
+
+            else:
+                raise ValueError("{}.{} holds items, give its elements as TagObjects".format(self.typ.name, name))
+
+        return data.tobytes()
+
+
+class TagTypeInterner(object):
+    """Process-wide table of the types read so far.
+
+    Types with the same name, templates, hash and layout are the same type
+    no matter which file they come from, so every reader gets one shared
+    TagType for them, along with whatever is cached on it (decode plan, XML
+    tag). Referenced types are compared by name and hash if they have a
+    hash, which is what the hash is there for, and in full otherwise.
+
+    Both tables are dropped once they grow past maxTypes or maxSections, so
+    a long-running server doesn't keep every type it has seen. Readers keep
+    the types they already have.
+    """
+
+    types = {}
+    sections = {}
+    lock = threading.Lock()
+    maxTypes = 65536
+    maxSections = 1024
+
+    @staticmethod
+    def getReference(typ, visiting):
+        if typ == None:
+            return None
+
+        # Types on the way here are only named, or cycles would never end.
+        if typ.hsh or typ in visiting:
+            return (typ.key, typ.hsh)
+
+        return TagTypeInterner.getKey(typ, visiting)
+
+    @staticmethod
+    def getKey(typ, visiting=None):
+        if visiting == None:
+            visiting = set()
+
+        visiting.add(typ)
+        ref = lambda x: TagTypeInterner.getReference(x, visiting)
+        key = (typ.key, typ.hsh, typ.flags, typ.mFormatInfo, typ.version, typ.byteSize, typ.alignment,
+               typ.abstractValue, ref(typ.parent), ref(typ.mSubType),
+               tuple((x.name, x.flags, x.byteOffset, ref(x.typ)) for x in typ.members),
+               tuple((ref(x), y) for x, y in typ.interfaces))
+        visiting.remove(typ)
+
+        return key
+
+    @staticmethod
+    def intern(types, digest=None):
+        with TagTypeInterner.lock:
+            if (len(TagTypeInterner.types) > TagTypeInterner.maxTypes or
+                    len(TagTypeInterner.sections) > TagTypeInterner.maxSections):
+                TagTypeInterner.types = {}
+                TagTypeInterner.sections = {}
+
+            canonicalTypes = {}
+            newTypes = []
+
+            for typ in types[1:]:
+                key = TagTypeInterner.getKey(typ)
+                canonical = TagTypeInterner.types.get(key)
+
+                if canonical == None:
+                    canonical = typ
+                    TagTypeInterner.types[key] = typ
+                    newTypes.append(typ)
+
+                canonicalTypes[typ] = canonical
+
+            # New types must only point at shared ones.
+            for typ in newTypes:
+                typ.parent = canonicalTypes.get(typ.parent, typ.parent)
+                typ.mSubType = canonicalTypes.get(typ.mSubType, typ.mSubType)
+
+                for template in typ.templates:
+                    if template.isType:
+                        template.value = canonicalTypes.get(template.value, template.value)
+
+                for member in typ.members:
+                    member.typ = canonicalTypes.get(member.typ, member.typ)
+
+                typ.interfaces = [(canonicalTypes.get(x, x), y) for x, y in typ.interfaces]
+
+            types = [None] + [canonicalTypes[x] for x in types[1:]]
+
+            if digest != None:
+                TagTypeInterner.sections[digest] = types
+
+            return types
+
+
 class TagSectionReader(object):
     def __init__(self, r, *signatures):
         self.r = r
@@ -187,6 +659,20 @@ class TagSectionReader(object):
     def end(self):
         return self.r.f.tell() >= (self.offset + self.size)
 
+    @property
+    def padding(self):
+        # True when only the zeroes padding the section to 4 bytes are left.
+        remaining = self.offset + self.size - self.r.f.tell()
+        if remaining <= 0:
+            return True
+
+        if remaining >= 4:
+            return False
+
+        data = self.r.f.read(remaining)
+        self.r.f.seek(-len(data), 1)
+        return not data.strip("\0")
+
     def __enter__(self):
         self.r.f.seek(self.offset)
         return self
@@ -199,33 +685,76 @@ class TagFileType(object):
     Invalid = -1
     Object = 0
     Compendium = 1
+    Graph = 2
 
 
 class TagReader(object):
+    # TagGraphSnapshots that fromFile loads decoded graphs from, if any.
+    snapshots = None
+
     def __init__(self, f, compendium=None):
         self.f = f
         self.dataOffset = 0
         self.types = []
         self.items = []
+        # Type -> indices of the items of that type
+        self.itemIndices = {}
         # Support read from HavocCli
         # Type -> Index -> Offset to DATA
         self.patches = {}
+        # Type index -> number of PTCH offsets consumed so far. Shared by
+        # every full decode of the reader, so items decoded by separate
+        # getObject calls still take the offsets in turn.
         self.currPatch = {}
+        # Item index -> number of fields pointing at it, see getReferenceCounts
+        self.referenceCounts = None
+        # Set once TagArrayView hands out arrays over data
+        self.hasViews = False
         self.ids = []
         self.compendium = compendium
+        self.typeIndices = {}
+        self.structs = {}
+        self.lock = threading.RLock()
         self.readRootSection()
+        self.typeIndices = {typ: i for i, typ in enumerate(self.types)}
+
+        self.data = TagReader.mapFile(f)
 
     def __enter__(self):
         return self
 
     def __exit__(self, arg1, arg2, arg3):
         if (self.compendium != None):
-            self.compendium.f.close()
+            self.compendium.close()
+
+        self.close()
+
+    def close(self):
+        # Unmapping under arrays from TagArrayView would crash their readers,
+        # so the mapping is then freed with the last of them.
+        if isinstance(self.data, mmap.mmap) and not self.hasViews:
+            self.data.close()
 
         self.f.close()
 
     @staticmethod
-    def fromFile(inputFileName, compendiumFileName=None):
+    def mapFile(f):
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except (AttributeError, ValueError, EnvironmentError):
+            f.seek(0)
+            return f.read()
+
+    @staticmethod
+    def fromFile(inputFileName, compendiumFileName=None, processes=None):
+        if TagReader.snapshots != None:
+            return TagReader.snapshots.load(inputFileName, compendiumFileName, processes)
+
+        return TagReader.decodeFile(inputFileName, compendiumFileName, processes)
+
+    @staticmethod
+    def decodeFile(inputFileName, compendiumFileName=None, processes=None):
         compendium = None
         if (compendiumFileName != None and os.path.exists(compendiumFileName)):
             debug("read compendium file")
@@ -235,6 +764,9 @@ class TagReader(object):
         debug("read input file")
         with TagReader(open(inputFileName, "rb"), compendium) as r:
             debug("read input file finished, items count:", len(r.items))
+            if processes != None:
+                TagParallelDecoder.decode(r, processes)
+
             return r.getObject(0)
 
     @staticmethod
@@ -247,6 +779,8 @@ class TagReader(object):
                 return TagFileType.Object
             elif (signature == "TCM0"):
                 return TagFileType.Compendium
+            elif (signature == "TGRF"):
+                return TagFileType.Graph
             else:
                 return TagFileType.Invalid
 
@@ -265,6 +799,14 @@ class TagReader(object):
                 self.types = self.compendium.types
                 return
 
+            # Files written by the same tool usually carry the same TYPE section.
+            digest = hashlib.sha1(self.f.read(t1.size)).digest()
+            self.types = TagTypeInterner.sections.get(digest)
+            if self.types != None:
+                return
+
+            self.f.seek(t1.offset)
+
             with TagSectionReader(self, "TPTR") as t2:
                 pass
 
@@ -281,6 +823,12 @@ class TagReader(object):
                 idx = 0
                 for typ in self.types[1:]:
                     idx+=1
+
+                    # Some writers count the null type too, leaving the last entry out.
+                    if idx == typeCount and t4.padding:
+                        self.types.pop()
+                        break
+
                     typ.name = typeStrings[self.readPacked()]
                     debugType(str(idx) + " read type " + typ.name)
 
@@ -390,6 +938,8 @@ class TagReader(object):
             with TagSectionReader(self, "TPAD") as t8:
                 pass
 
+            self.types = TagTypeInterner.intern(self.types, digest)
+
     def readIndexSection(self):
         with TagSectionReader(self, "INDX") as t1:
             with TagSectionReader(self, "ITEM") as t2:
@@ -402,6 +952,8 @@ class TagReader(object):
                     item.count = self.readFormat("<I")
                     if item.typ != None and item.typ.name == "hkStringPtr":
                         debugReadObj("INDX: hkStringPtr count:", item.count, "isPtr?:", item.isPtr, "flag", flag, "offset", item.offset)
+                    if item.typ != None:
+                        self.itemIndices.setdefault(item.typ, []).append(len(self.items))
                     self.items.append(item)
 
             with TagSectionReader(self, "PTCH") as t3:
@@ -473,140 +1025,238 @@ class TagReader(object):
         else:
             return ret
 
-    def readObject(self, typ, offset=0, isTarget=False):
-        # if not isTarget:
-        #     isTarget = typ.name == "hkaDefaultAnimatedReferenceFrame"
-        # if isTarget:
-
-        global indent
-        # debugReadObj("ReadObj: " + typ.name + " Offset: " + str(offset))
-        # if offset > 10000:
-        #     exit(1)
+    def readObject(self, typ, offset=0):
         if offset == 0:
             offset = self.f.tell()
 
-        else:
-            self.f.seek(offset)
+        result = []
+        with self.lock:
+            self.decode(typ, offset, result, None, TagDecodeContext(None, self.currPatch))
 
-        typOrg = typ
-        typ = typ.superType
+        return result[0]
 
-        value = None
+    def decode(self, typ, offset, container, depth, context):
+        TagGraphWalker.walk([typ, offset, container, None, None, None, depth, context],
+                            self.enterObject, self.leaveObject)
 
-        if typ.subType == TagSubType.Bool:
-            # debugReadObj("reading bool")
-            value = self.readFormat(TagReader.getFormatString(typ.mFormatInfo)) > 0
+    # Nodes of the decode walk are lists of
+    # [type, offset, container, key, value, item, depth, context]; the decoded
+    # TagObject is stored into container[key] (or appended when key is None)
+    # on leave. depth is the number of pointer/array hops still allowed (None
+    # for no limit). Everything is read at absolute offsets of self.data, so
+    # nothing but the context changes while decoding.
+    def enterObject(self, node):
+        typ = node[0].superType
+        offset = node[1]
 
-        elif typ.subType == TagSubType.String:
-            debugReadObj("reading str")
-            global flagDebugReadObj
-            # flagDebugReadObj = False
-            indent += 1
-            value = "".join(map(chr, [x.value for x in self.readItemPtr(typ)[:-1]]))
-            indent -= 1
-            # flagDebugReadObj = True
-            debugReadObj("^-got str:", value)
+        if typ.subType == TagSubType.Bool:
+            node[4] = self.readFormatAt(TagReader.getFormatString(typ.mFormatInfo), offset) > 0
 
         elif typ.subType == TagSubType.Int:
-            # debugReadObj("reading int")
-            value = self.readFormat(TagReader.getFormatString(typ.mFormatInfo))
+            node[4] = self.readFormatAt(TagReader.getFormatString(typ.mFormatInfo), offset)
 
         elif typ.subType == TagSubType.Float:
-            # debugReadObj("reading float")
-            value = self.readFormat("<f")
+            node[4] = self.readFormatAt("<f", offset)
 
-        elif typ.subType == TagSubType.Pointer:
-            debugReadObj("reading ptr")
-            indent += 1
-            value = self.readItemPtr(typ)
-            indent -= 1
+        elif typ.subType == TagSubType.String or typ.subType == TagSubType.Pointer or typ.subType == TagSubType.Array:
+            index = self.readFormatAt("<I", offset)
+            if index == 0:
+                return
+
+            item = self.items[index]
+            node[5] = item
+            depth = node[6]
+            context = node[7]
 
-            if len(value) == 1:
-                value = value[0]
+            if typ.subType == TagSubType.String:
+                if not self.typeIndices[item.typ] in self.patches:
+                    node[4] = self.data[item.offset:item.offset + max(item.count - 1, 0)]
+                    node[5] = None
 
-            else:
-                value = None
+                elif context.values == None:
+                    if item.value == None:
+                        item.value = []
+                        return self.iterItemObjects(item, item.value, None, context)
+
+                elif not context.values.has_key(item):
+                    context.values[item] = []
+                    return self.iterItemObjects(item, context.values[item], None, context)
+
+            elif depth != None and depth <= 0:
+                node[4] = TagItemReference(index, item)
+                node[5] = None
+
+            elif context.values == None:
+                if item.value == None:
+                    item.value = []
+                    return self.iterItemObjects(item, item.value, None, context)
+
+            elif not context.values.has_key(item):
+                context.values[item] = []
+                return self.iterItemObjects(item, context.values[item], depth - 1 if depth != None else None, context)
 
         elif typ.subType == TagSubType.Class:
-            # if isTarget:
-            #     print("ReadObj: " + typ.name)
-            #     print("ReadObj: " + str(typ.subType))
             value = {}
-            debugReadObj("reading class", typ.name)
-            for x in typ.allMembers:
-                # if isTarget:
-                debugReadObj(typ.name + "." + x.name, "(" + str(x.typ.name) + ")")
-                indent += 1
-                value[x.name] = self.readObject(x.typ, offset + x.byteOffset)
-                indent -= 1
-            #
-            # value = {x.name: self.readObject(x.typ, offset + x.byteOffset)
-            #          for x in typ.allMembers}
+            node[4] = value
+            depth = node[6]
+            context = node[7]
 
-        elif typ.subType == TagSubType.Array:
-            debugReadObj("reading array", str(typ), "offset", offset)
-            indent += 1
-            value = self.readItemPtr(typ)
-            indent -= 1
+            return [[x.typ, offset + x.byteOffset, value, x.name, None, None, depth, context]
+                    for x in typ.allMembers]
 
         elif typ.subType == TagSubType.Tuple:
-            debugReadObj("reading tuple", typ.name, "size", typ.tupleSize, "offset", offset)
-            value = tuple([self.readObject(typ.mSubType, offset + x * typ.mSubType.superType.byteSize)
-                           for x in xrange(typ.tupleSize)])
+            value = []
+            node[4] = value
+            depth = node[6]
+            context = node[7]
+            size = typ.mSubType.superType.byteSize
 
-        self.f.seek(offset + typ.byteSize)
-        return TagObject(value, typOrg)
+            return [[typ.mSubType, offset + x * size, value, None, None, None, depth, context]
+                    for x in xrange(typ.tupleSize)]
 
-    def readItemPtr(self, containerType):
-        startOffset = self.f.tell()
-        index = self.readFormat("<I")
-        if index == 0:
-            return []
+    def leaveObject(self, node):
+        typOrg, offset, container, key, value, item, depth, context = node
+        typ = typOrg.superType
 
-        else:
-            debugReadObj("read item ptr, offset", startOffset, "type index", index)
-            if index >= len(self.items):
-                debugReadObj("===index exceed!===")
-                debugReadObj("read item ptr", "index", index, "pos", self.f.tell())
-                item = self.items[index]
-                return
-            item = self.items[index]
-            debugReadObj("container type:", str(containerType))
-            debugReadObj("item ptr:", item.typ.superType.name, ", index", index, ", item count", item.count, ", item offset", item.offset, ", pos", self.f.tell())
+        if item != None:
+            itemValue = item.value if context.values == None else context.values[item]
+
+            if typ.subType == TagSubType.String:
+                value = "".join([chr(x.value) for x in itemValue[:-1]])
+
+            elif typ.subType == TagSubType.Pointer:
+                value = itemValue[0] if len(itemValue) == 1 else None
 
-            global indent
-            if item.value == None:
-                item.value = []
-                for x in xrange(item.count):
-                    offset = item.offset + x * item.typ.superType.byteSize
-                    if item.typ.name != "char":
-                        debugReadObj("^-try read subitem", x, ", type", item.typ.name, ", type size", item.typ.superType.byteSize, ", offset", offset)
-                        debugReadObj("^-superType", item.typ.superType.name, "subType?", item.typ.flags & TagFlag.SubType)
-                    indent += 1
-
-                    typeIndex = self.types.index(item.typ)
-                    if item.typ.name != "char":
-                        debugReadObj("typeIndex", typeIndex)
-                    if typeIndex in self.patches:
-                        if typeIndex not in self.currPatch:
-                            self.currPatch[typeIndex] = 0
-                        # itemIdx = index+x
-                        itemIdx = self.currPatch[typeIndex]
-                        self.currPatch[typeIndex] += 1
-                        patches = self.patches[typeIndex]
-                        if itemIdx < len(patches):
-                            offset = patches[itemIdx] + self.dataOffset
-                            debugReadObj("item ptr patchOffset", patches[itemIdx], "offset", offset)
-                        else:
-                            debugReadObj("type " + str(item.typ) + " has patches but itemIdx " + str(itemIdx) + " exceeds max " + str(len(patches)))
-                    else:
-                        debugReadObj("type " + str(item.typ) + " has no patches")
-                    obj = self.readObject(item.typ, offset)
-                    item.value.append(obj)
-                    indent -= 1
             else:
-                debugReadObj("  already exist", item.typ, item.value)
-            return item.value
+                value = itemValue
+
+        elif typ.subType == TagSubType.String and value == None:
+            value = ""
+
+        elif typ.subType == TagSubType.Array and value == None:
+            value = []
+
+        elif typ.subType == TagSubType.Tuple:
+            value = tuple(value)
+
+        obj = TagObject(value, typOrg)
+
+        if key == None:
+            container.append(obj)
+
+        else:
+            container[key] = obj
+
+    def iterItemObjects(self, item, value, depth, context):
+        # Generated lazily so that patch offsets are consumed in the same
+        # order as a depth-first decode. Reads that jump around the file have
+        # no patch counters and use the ITEM offsets as they are.
+        typeIndex = self.typeIndices[item.typ]
+        byteSize = item.typ.superType.byteSize
+        patches = self.patches.get(typeIndex) if context.currPatch != None else None
+
+        for x in xrange(item.count):
+            offset = item.offset + x * byteSize
+
+            if patches != None:
+                itemIdx = context.currPatch.get(typeIndex, 0)
+                context.currPatch[typeIndex] = itemIdx + 1
+                if itemIdx < len(patches):
+                    offset = patches[itemIdx] + self.dataOffset
+
+            yield [item.typ, offset, value, None, None, None, depth, context]
+
+    def readItem(self, index, start=0, stop=None, depth=None):
+        """Decodes elements start to stop of a single item.
+
+        index is an ITEM index, or a type (or type name) whose first item is
+        read. With a depth, at most that many pointer/array hops are followed;
+        anything further is left as a TagItemReference that can be passed back
+        to readItem. Strings are always read.
+
+        Files whose items are read at PTCH offsets (see usesPatchOffsets) are
+        decoded from the root for whole items; other reads of them raise
+        ValueError.
+        """
+        index = self.resolveItemIndex(index)
+        item = self.items[index]
+
+        if depth == None and start == 0 and (stop == None or stop >= item.count):
+            if item.value == None:
+                # With PTCH offsets, items are only read right on the way
+                # from the root.
+                self.getObject(0 if self.usesPatchOffsets() else index - 1)
+
+            return item.value or []
+
+        return self.decodeItem(index, start, stop, depth)
+
+    def readItems(self, indices, threads=4, depth=None):
+        """Decodes whole items concurrently, one item per task.
+
+        Each item is decoded with its own cache, so objects shared between
+        two items are not shared between their results. Like partial reads
+        with readItem, this raises ValueError for files using PTCH offsets.
+        """
+        self.checkItemOffsets()
+        indices = [self.resolveItemIndex(x) for x in indices]
+        pool = ThreadPool(threads)
+
+        try:
+            return pool.map(lambda index: self.decodeItem(index, 0, None, depth), indices)
+
+        finally:
+            pool.close()
+
+    def resolveItemIndex(self, index):
+        if isinstance(index, TagItemReference):
+            return index.index
+
+        elif isinstance(index, (int, long)):
+            return index
+
+        return self.getItemIndex(index)
+
+    def checkItemOffsets(self):
+        # Items decoded on their own are read at their ITEM offsets, which
+        # are the wrong ones when the file needs the PTCH offsets.
+        if self.usesPatchOffsets():
+            raise ValueError("Items of this file are read at PTCH offsets, so only whole objects can be decoded")
+
+    def decodeItem(self, index, start, stop, depth):
+        self.checkItemOffsets()
+        item = self.items[index]
+        if item.typ == None:
+            return []
+
+        if stop == None or stop > item.count:
+            stop = item.count
+
+        context = TagDecodeContext({})
+        byteSize = item.typ.superType.byteSize
+        result = []
+
+        for x in xrange(start, stop):
+            self.decode(item.typ, item.offset + x * byteSize, result, depth, context)
+
+        return result
+
+    def getDecodePlan(self, typ):
+        return TagDecodePlan.get(typ)
+
+    def readFormatAt(self, format, offset):
+        s = self.structs.get(format)
+        if s == None:
+            s = struct.Struct(format)
+            self.structs[format] = s
+
+        data = s.unpack_from(self.data, offset)
+
+        if len(data) == 1:
+            return data[0]
+
+        else:
+            return data
 
     def readFormat(self, format):
         data = struct.unpack(format, self.f.read(struct.calcsize(format)))
@@ -665,13 +1315,51 @@ class TagReader(object):
             if typ.name == name:
                 return typ
 
+    def getItemIndex(self, name):
+        typ = self.getType(name) if isinstance(name, str) else name
+
+        indices = self.itemIndices.get(typ)
+        if not indices:
+            raise ValueError("No item of type {} could be found".format(name))
+
+        return indices[0]
+
     def getItem(self, typ):
         if isinstance(typ, str):
             typ = self.getType(typ)
 
-        for item in self.items:
-            if item.typ == typ:
-                return item
+        if self.itemIndices.has_key(typ):
+            return self.items[self.itemIndices[typ][0]]
+
+    def getReferenceCounts(self):
+        """Number of string and array fields pointing at each item, read at
+        the PTCH offsets.
+
+        Writers that dedupe strings and arrays leave several fields pointing
+        at one item, so writing into such an item changes every one of them.
+        Pointers are left out: an object several pointers point at is one
+        shared object, which readers decode as such.
+        """
+        if self.referenceCounts == None:
+            counts = {}
+            for typeIndex, offsets in self.patches.iteritems():
+                sup = self.types[typeIndex].superType
+                if sup.subType != TagSubType.String and sup.subType & 0xF != TagSubType.Array:
+                    continue
+
+                for offset in offsets:
+                    index = self.readFormatAt("<I", self.dataOffset + offset)
+                    counts[index] = counts.get(index, 0) + 1
+
+            self.referenceCounts = counts
+
+        return self.referenceCounts
+
+    def usesPatchOffsets(self):
+        # PTCH normally lists offsets by the type of the fields pointing at
+        # items. Files from HavocCli list them by the type of the items
+        # instead, and those items are read at the PTCH offsets.
+        return any(self.typeIndices[typ] in self.patches for typ in self.itemIndices)
 
     def getObject(self, index):
         item = self.items[index + 1]
@@ -679,26 +1367,320 @@ class TagReader(object):
         if item.typ == None:
             return None
 
-        if item.value == None:
-            itemCount = item.count
-            debugReadObj("read obj, type:", item.typ.name, "item count", itemCount)
-            item.value = []
-            for x in xrange(itemCount):
-                subItem = self.readObject(item.typ, item.offset + x * item.typ.superType.byteSize)
+        # Decoded objects are cached in TagItem.value, so one full decode
+        # runs at a time. readItems decodes without touching that cache.
+        with self.lock:
+            if item.value == None:
+                debugReadObj("read obj, type:", item.typ.name, "item count", item.count)
+                context = TagDecodeContext(None, self.currPatch)
+                value = []
+                for x in xrange(item.count):
+                    self.decode(item.typ, item.offset + x * item.typ.superType.byteSize, value, None, context)
 
-                item.value.append(subItem)
-            # item.value = [self.readObject(item.typ,
-            #                               item.offset + x * item.typ.superType.byteSize)
-            #               for x in xrange(item.count)]
+                item.value = value
 
         return item.value[0]
 
 
-class TagSectionWriter(object):
-    def __init__(self, w, signature, flag=True):
-        self.w = w
-        self.headerOffset = w.f.tell()
-        self.flag = flag
+class TagParallelDecoder(object):
+    """Decodes the items of one file with the help of worker processes.
+
+    Every worker maps the file itself and unpacks whole chunks of the ITEM
+    table with TagDecodePlan, resolving strings on the way. Only flat tuples
+    of values travel back; the parent turns those into TagObjects and links
+    pointers and arrays up by item index.
+    """
+
+    reader = None
+
+    @staticmethod
+    def initWorker(inputFileName, compendiumFileName):
+        compendium = None
+        if compendiumFileName != None:
+            compendium = TagReader(open(compendiumFileName, "rb"))
+
+        TagParallelDecoder.reader = TagReader(open(inputFileName, "rb"), compendium)
+
+    @staticmethod
+    def decodeChunk(chunk):
+        r = TagParallelDecoder.reader
+        return [(index, TagParallelDecoder.unpackItem(r, r.items[index])) for index in xrange(chunk[0], chunk[1])]
+
+    @staticmethod
+    def unpackItem(r, item):
+        if item.typ == None:
+            return []
+
+        plan = r.getDecodePlan(item.typ)
+        byteSize = item.typ.superType.byteSize
+        elements = [plan.unpack(r.data, item.offset + x * byteSize) for x in xrange(item.count)]
+
+        if plan.stringPositions:
+            for i, values in enumerate(elements):
+                values = list(values)
+                for position in plan.stringPositions:
+                    if values[position]:
+                        string = r.items[values[position]]
+                        values[position] = r.data[string.offset:string.offset + max(string.count - 1, 0)]
+
+                elements[i] = values
+
+        return elements
+
+    @staticmethod
+    def makeChunks(items, count):
+        # Contiguous ranges of roughly the same amount of DATA each.
+        sizes = [item.count * item.typ.superType.byteSize if item.typ != None else 0 for item in items]
+        target = max(sum(sizes) / max(count, 1), 1)
+
+        chunks = []
+        start = 1
+        size = 0
+        for index in xrange(1, len(items)):
+            size += sizes[index]
+            if size >= target:
+                chunks.append((start, index + 1))
+                start = index + 1
+                size = 0
+
+        if start < len(items):
+            chunks.append((start, len(items)))
+
+        return chunks
+
+    @staticmethod
+    def decode(r, processes=None):
+        # Workers read every item at its ITEM offset, so files that need the
+        # PTCH offsets are left to the serial decode of getObject.
+        if r.usesPatchOffsets():
+            return
+
+        processes = processes or multiprocessing.cpu_count()
+        compendiumFileName = r.compendium.f.name if r.compendium != None else None
+        chunks = TagParallelDecoder.makeChunks(r.items, processes * 4)
+
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, initDecodeWorker, (r.f.name, compendiumFileName))
+
+            try:
+                results = pool.map(decodeItemChunk, chunks)
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            TagParallelDecoder.reader = r
+            results = map(decodeItemChunk, chunks)
+            TagParallelDecoder.reader = None
+
+        items = {index: [] for index in xrange(1, len(r.items))}
+        pointers = []
+
+        for chunk in results:
+            for index, elements in chunk:
+                if not elements:
+                    continue
+
+                plan = r.getDecodePlan(r.items[index].typ)
+                value = items[index]
+                for values in elements:
+                    value.append(plan.build(plan.tree, values, items, pointers))
+
+        for obj, index in pointers:
+            value = items[index]
+            obj.value = value[0] if len(value) == 1 else None
+
+        with r.lock:
+            for index, value in items.iteritems():
+                r.items[index].value = value
+
+
+# Pool workers have to be importable by name, which static methods are not.
+def initDecodeWorker(inputFileName, compendiumFileName):
+    TagParallelDecoder.initWorker(inputFileName, compendiumFileName)
+
+
+def decodeItemChunk(chunk):
+    return TagParallelDecoder.decodeChunk(chunk)
+
+
+class TagFileSummary(object):
+    def __init__(self, fileName=None):
+        self.fileName = fileName
+        self.fileType = TagFileType.Invalid
+        self.version = None
+        self.dataSize = 0
+        # TCID entries of a compendium, or the compendium ID a TCRF refers to.
+        self.compendiumIds = []
+        self.usesCompendium = False
+        self.typeCount = 0
+        self.typeNames = None
+        self.itemCount = 0
+        self.patchCount = 0
+        self.sections = []
+
+
+class TagFileScanner(TagReader):
+    """Walks the section tree of a tag file without decoding DATA or TBOD."""
+
+    def __init__(self, f, types=False, fileName=None):
+        self.f = f
+        self.scanTypes = types
+        self.summary = TagFileSummary(fileName)
+        self.scanRootSection()
+
+    def __exit__(self, arg1, arg2, arg3):
+        self.f.close()
+
+    @staticmethod
+    def scanFile(inputFileName, types=False):
+        with TagFileScanner(open(inputFileName, "rb"), types, inputFileName) as s:
+            return s.summary
+
+    def section(self, *signatures):
+        t = TagSectionReader(self, *signatures)
+        self.summary.sections.append((t.signature, t.offset, t.size))
+        return t
+
+    def scanTypeSection(self):
+        with self.section("TYPE", "TCRF") as t1:
+            if (t1.signature == "TCRF"):
+                self.summary.usesCompendium = True
+                self.summary.compendiumIds = [self.f.read(8)]
+                return
+
+            with self.section("TPTR") as t2:
+                pass
+
+            with self.section("TSTR") as t3:
+                typeStrings = self.f.read(t3.size).split("\0") if self.scanTypes else None
+
+            with self.section("TNAM", "TNA1") as t4:
+                # Some writers count the null type and some don't, so count
+                # the entries actually present instead.
+                typeCount = self.readPacked()
+                typeNames = []
+
+                while len(typeNames) < typeCount and not t4.padding:
+                    typeNames.append(self.readPacked())
+
+                    for i in xrange(self.readPacked()):
+                        self.readPacked()
+                        self.readPacked()
+
+                self.summary.typeCount = len(typeNames)
+
+                if self.scanTypes:
+                    self.summary.typeNames = [typeStrings[x] for x in typeNames]
+
+            with self.section("FSTR") as t5:
+                pass
+
+            with self.section("TBOD", "TBDY") as t6:
+                pass
+
+            with self.section("THSH") as t7:
+                pass
+
+            with self.section("TPAD") as t8:
+                pass
+
+    def scanRootSection(self):
+        with self.section("TAG0", "TCM0") as t1:
+            if (t1.signature == "TAG0"):
+                self.summary.fileType = TagFileType.Object
+
+                with self.section("SDKV") as t2:
+                    self.summary.version = self.f.read(8)
+
+                with self.section("DATA") as t3:
+                    self.summary.dataSize = t3.size
+
+                self.scanTypeSection()
+
+                with self.section("INDX") as t4:
+                    with self.section("ITEM") as t5:
+                        self.summary.itemCount = max(t5.size / 12 - 1, 0)
+
+                    with self.section("PTCH") as t6:
+                        while not t6.end:
+                            typeIndex, positionCount = self.readFormat("<2I")
+                            self.summary.patchCount += positionCount
+                            self.f.seek(positionCount * 4, 1)
+
+            elif (t1.signature == "TCM0"):
+                self.summary.fileType = TagFileType.Compendium
+
+                with self.section("TCID") as t2:
+                    self.summary.compendiumIds = [self.f.read(8) for i in xrange(t2.size / 8)]
+
+                self.scanTypeSection()
+
+
+class TagTypeReport(object):
+    """Per-type statistics of a tag file, taken from ITEM and PTCH alone.
+
+    Padding is the gap in DATA right before an item, which is put down to
+    that item's alignment. Share is the part of the whole file taken by
+    the type's items.
+    """
+
+    columns = ["type", "items", "elements", "bytes", "padding", "patches", "share"]
+
+    def __init__(self, r, fileName=None):
+        self.fileName = fileName
+        self.fileSize = len(r.data)
+        self.rows = {}
+
+        end = r.dataOffset
+        for item in sorted((x for x in r.items[1:] if x.typ != None), key=lambda x: x.offset):
+            size = item.count * (item.typ.superType.byteSize if item.typ.superType != None else 0)
+
+            row = self.getRow(item.typ)
+            row["items"] += 1
+            row["elements"] += item.count
+            row["bytes"] += size
+            row["padding"] += max(item.offset - end, 0)
+
+            end = max(end, item.offset + size)
+
+        for typeIndex, offsets in r.patches.iteritems():
+            self.getRow(r.types[typeIndex])["patches"] += len(offsets)
+
+        for row in self.rows.itervalues():
+            row["share"] = float(row["bytes"]) / self.fileSize if self.fileSize else 0.0
+
+    @staticmethod
+    def fromFile(inputFileName, compendium=None):
+        # Not a with block, which would close the compendium as well.
+        r = TagReader(open(inputFileName, "rb"), compendium)
+        try:
+            return TagTypeReport(r, inputFileName)
+
+        finally:
+            r.close()
+
+    def getRow(self, typ):
+        row = self.rows.get(typ)
+        if row == None:
+            row = {"type": str(typ), "items": 0, "elements": 0, "bytes": 0, "padding": 0, "patches": 0}
+            self.rows[typ] = row
+
+        return row
+
+    def sortedRows(self, column="bytes"):
+        if column == "type":
+            return sorted(self.rows.values(), key=lambda x: x["type"])
+
+        return sorted(self.rows.values(), key=lambda x: (-x[column], x["type"]))
+
+
+class TagSectionWriter(object):
+    def __init__(self, w, signature, flag=True):
+        self.w = w
+        self.headerOffset = w.f.tell()
+        self.flag = flag
 
         w.writeFormat(">I", 0)
         w.f.write(signature[:4])
@@ -722,13 +1704,54 @@ class TagSectionWriter(object):
 
 
 class TagWriter(object):
-    def __init__(self, f):
+    """Writes a tag file.
+
+    Given a compendium (a TagReader of a TCM0 file) and referenceCompendium,
+    types are looked up in it by name and templates and a TCRF reference to
+    it is written instead of a TYPE section. If the compendium lacks any of
+    the types, all of them are written in a TYPE section as usual.
+
+    With compactLayout, items are laid out by alignment instead of in the
+    order they're found, so little DATA is lost to padding.
+
+    With dedupe, equal strings and equal arrays of plain numbers are
+    written once and share an item, so readers get one shared list for
+    them. Without it, output is byte-compatible with older versions.
+
+    Arrays may hold NumPy arrays or array.array instead of lists of
+    TagObjects, which are written as one buffer, see TagArrayBlock.
+    """
+
+    def __init__(self, f, compendium=None, compendiumId=None, compactLayout=False, dedupe=False,
+                 referenceCompendium=False):
         self.f = f
+        self.compactLayout = compactLayout
+        self.dedupe = dedupe
+        self.contentItems = {}
+        self.scannedObjects = None
         self.dataOffset = 0
         self.types = [None]
+        self.typeIndices = {None: 0}
+        self.typeStrings = []
+        self.typeStringIndices = {}
+        self.fieldStrings = []
+        self.fieldStringIndices = {}
         self.items = [None]
-        self.items2 = []
+        self.itemIndices = {}
+        self.stringItems = []
         self.patches = {}
+        # Type -> hash written to THSH in place of its own
+        self.typeHashes = {}
+        self.compendium = None
+        self.compendiumId = None
+        self.compendiumTypes = None
+
+        if compendium != None and referenceCompendium:
+            self.compendium = compendium
+            self.compendiumId = compendiumId or compendium.ids[0]
+            self.compendiumTypes = {typ.key: typ for typ in compendium.types[1:]}
+            self.types = list(compendium.types)
+            self.typeIndices = dict(compendium.typeIndices)
 
     def __enter__(self):
         return self
@@ -737,58 +1760,48 @@ class TagWriter(object):
         self.f.close()
 
     @staticmethod
-    def toFile(outputFileName, obj):
-        with TagWriter(open(outputFileName, "wb")) as w:
+    def toFile(outputFileName, obj, compendium=None, **options):
+        with TagWriter(open(outputFileName, "wb"), compendium, **options) as w:
             w.writeRootSection(obj)
 
+    def writeCompendiumReference(self):
+        with TagSectionWriter(self, "TCRF") as t1:
+            self.f.write(self.compendiumId)
+
     def writeTypeSection(self):
         with TagSectionWriter(self, "TYPE", False) as t1:
 
             with TagSectionWriter(self, "TPTR") as t2:
                 self.writeNulls(8 * len(self.types))
 
-            typeStrings = []
-            fieldStrings = []
-            for typ in self.types[1:]:
-                if not typ.name in typeStrings:
-                    typeStrings.append(typ.name)
-
-                for template in typ.templates:
-                    if not template.name in typeStrings:
-                        typeStrings.append(template.name)
-
-                for member in typ.members:
-                    if not member.name in fieldStrings:
-                        fieldStrings.append(member.name)
-
             with TagSectionWriter(self, "TSTR") as t3:
-                self.f.write("\0".join(typeStrings) + "\0")
+                self.f.write("\0".join(self.typeStrings) + "\0")
 
             with TagSectionWriter(self, "TNAM") as t4:
                 self.writePacked(len(self.types))
 
                 for typ in self.types[1:]:
-                    self.writePacked(typeStrings.index(typ.name))
+                    self.writePacked(self.typeStringIndices[typ.name])
                     self.writePacked(len(typ.templates))
 
                     for template in typ.templates:
-                        self.writePacked(typeStrings.index(template.name))
-                        self.writePacked(self.types.index(template.value) if template.isType else template.value)
+                        self.writePacked(self.typeStringIndices[template.name])
+                        self.writePacked(self.typeIndices[template.value] if template.isType else template.value)
 
             with TagSectionWriter(self, "FSTR") as t5:
-                self.f.write("\0".join(fieldStrings) + "\0")
+                self.f.write("\0".join(self.fieldStrings) + "\0")
 
             with TagSectionWriter(self, "TBOD") as t6:
                 for typ in self.types[1:]:
-                    self.writePacked(self.types.index(typ))
-                    self.writePacked(self.types.index(typ.parent))
+                    self.writePacked(self.typeIndices[typ])
+                    self.writePacked(self.typeIndices[typ.parent])
                     self.writePacked(typ.flags)
 
                     if typ.flags & TagFlag.SubType:
-                        self.writePacked(typ.subTypeFlags)
+                        self.writePacked(typ.mFormatInfo)
 
                     if typ.flags & TagFlag.Pointer:
-                        self.writePacked(self.types.index(typ.pointer))
+                        self.writePacked(self.typeIndices[typ.mSubType])
 
                     if typ.flags & TagFlag.Version:
                         self.writePacked(typ.version)
@@ -804,26 +1817,27 @@ class TagWriter(object):
                         self.writePacked(len(typ.members))
 
                         for member in typ.members:
-                            self.writePacked(fieldStrings.index(member.name))
+                            self.writePacked(self.fieldStringIndices[member.name])
                             self.writePacked(member.flags)
                             self.writePacked(member.byteOffset)
-                            self.writePacked(self.types.index(member.typ))
+                            self.writePacked(self.typeIndices[member.typ])
 
                     if typ.flags & TagFlag.Interfaces:
                         self.writePacked(len(typ.interfaces))
 
-                        for typ, flag in typ.interfaces:
-                            self.writePacked(self.types.index(typ))
+                        for iTyp, flag in typ.interfaces:
+                            self.writePacked(self.typeIndices[iTyp])
                             self.writePacked(flag)
 
             with TagSectionWriter(self, "THSH") as t7:
-                hashes = [x for x in self.types[1:] if x.hsh]
+                hashes = [(x, self.typeHashes.get(x, x.hsh)) for x in self.types[1:]]
+                hashes = [(x, y) for x, y in hashes if y]
 
                 self.writePacked(len(hashes))
 
-                for typ in hashes:
-                    self.writePacked(self.types.index(typ))
-                    self.writeFormat("<I", typ.hsh)
+                for typ, hsh in hashes:
+                    self.writePacked(self.typeIndices[typ])
+                    self.writeFormat("<I", hsh)
 
             with TagSectionWriter(self, "TPAD") as t8:
                 pass
@@ -836,15 +1850,15 @@ class TagWriter(object):
 
                 for item in self.items[1:]:
                     if item.isPtr:
-                        self.writeFormat("<I", self.types.index(item.typ) | 0x10000000)
+                        self.writeFormat("<I", self.typeIndices[item.typ] | 0x10000000)
                     else:
-                        self.writeFormat("<I", self.types.index(item.typ) | 0x20000000)
+                        self.writeFormat("<I", self.typeIndices[item.typ] | 0x20000000)
 
                     self.writeFormat("<I", item.offset - self.dataOffset)
                     self.writeFormat("<I", len(item.value))
 
             with TagSectionWriter(self, "PTCH") as t3:
-                patches = [(self.types.index(key), value)
+                patches = [(self.typeIndices[key], value)
                            for key, value in self.patches.iteritems()]
 
                 patches.sort(key=lambda x: x[0])
@@ -872,7 +1886,23 @@ class TagWriter(object):
         return n
 
     def writeRootSection(self, obj):
-        self.scanObjectForType(obj)
+        # Types are registered in the order a depth-first walk of the graph
+        # finds them, as they always were, so TNAM and TBOD don't change.
+        try:
+            self.scanObjectForType(obj)
+
+            # Strings are typed as char arrays once DATA is written.
+            if self.compendium != None and self.getType("char") == None:
+                raise ValueError("Type char could not be found in the compendium")
+
+        except ValueError as e:
+            if self.compendium == None:
+                raise
+
+            print "WARNING: {}, writing types inline.".format(e)
+            self.dropCompendium()
+            self.scanObjectForType(obj)
+
         self.makeItem(obj, True)
 
         with TagSectionWriter(self, "TAG0", False) as t1:
@@ -883,22 +1913,165 @@ class TagWriter(object):
             with TagSectionWriter(self, "DATA") as t3:
                 self.dataOffset = t3.headerOffset + 8
 
-                while len(self.items2):
-                    items3 = self.items2
-                    self.items2 = []
-
-                    for item in items3:
-                        self.pad(self.nextPowerOfTwo(item.typ.superType.alignment))
+                if self.compactLayout:
+                    for item in self.getCompactLayout():
+                        self.writeItem(item)
 
-                        item.offset = self.f.tell()
-                        for i in xrange(len(item.value)):
-                            self.writeObject(item.value[i], item.offset + i * item.typ.superType.byteSize)
+                else:
+                    # Items discovered while writing are appended to self.items,
+                    # so this single pass also covers everything they reach.
+                    index = 1
+                    while index < len(self.items):
+                        self.writeItem(self.items[index])
+                        index += 1
 
                 self.pad(16)
 
-            self.writeTypeSection()
+            self.resolveStringItems()
+
+            if self.compendium != None:
+                self.writeCompendiumReference()
+            else:
+                self.writeTypeSection()
+
             self.writeIndexSection()
 
+    def dropCompendium(self):
+        self.compendium = None
+        self.compendiumId = None
+        self.compendiumTypes = None
+        self.types = [None]
+        self.typeIndices = {None: 0}
+
+    def writeCompendiumSection(self, ids):
+        with TagSectionWriter(self, "TCM0", False) as t1:
+
+            with TagSectionWriter(self, "TCID") as t2:
+                for compendiumId in ids:
+                    self.f.write(compendiumId)
+
+            self.writeTypeSection()
+
+    def getCompactLayout(self):
+        # Find every item up front, as writing would.
+        index = 1
+        while index < len(self.items):
+            item = self.items[index]
+            if not isinstance(item.value, str):
+                for obj in item.value:
+                    self.scanObject(obj)
+
+            index += 1
+
+        # The root stays first, the rest goes from the strictest alignment
+        # down. Sizes are multiples of alignments, so no gaps are left between
+        # items of the same class. Strings go last.
+        def getAlignment(item):
+            if isinstance(item.value, str):
+                return 0
+
+            return self.nextPowerOfTwo(item.typ.superType.alignment)
+
+        return self.items[1:2] + sorted(self.items[2:], key=getAlignment, reverse=True)
+
+    def scanObjectForType(self, obj):
+        self.scannedObjects = set()
+        TagGraphWalker.walk(obj, self.enterObjectForType)
+        self.scannedObjects = None
+
+    def enterObjectForType(self, obj):
+        if obj == None:
+            return None
+
+        self.scanType(obj.typ)
+
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.Pointer:
+            # Objects pointed at more than once have nothing new to offer.
+            if obj.value == None or id(obj.value) in self.scannedObjects:
+                return None
+
+            self.scannedObjects.add(id(obj.value))
+            return [obj.value]
+
+        elif typ.subType == TagSubType.Class:
+            return [obj.value[member.name] for member in typ.allMembers if obj.value.has_key(member.name)]
+
+        elif typ.subType & 0xF == TagSubType.Array:
+            if TagArrayBlock.isArrayBacked(obj.value):
+                return None
+
+            # Elements made of numbers only all reach the same types.
+            if obj.value and TagDecodePlan.get(obj.value[0].typ).primitive:
+                return obj.value[:1]
+
+            return obj.value
+
+        return None
+
+    def scanObject(self, obj):
+        TagGraphWalker.walk(obj, self.enterObjectForItems)
+
+    def enterObjectForItems(self, obj):
+        self.scanType(obj.typ)
+
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.String or typ.subType == TagSubType.Pointer or typ.subType == TagSubType.Array:
+            self.makeItem(obj)
+
+        elif typ.subType == TagSubType.Class:
+            return [obj.value[member.name] for member in typ.allMembers if obj.value.has_key(member.name)]
+
+        elif typ.subType == TagSubType.Tuple:
+            return [obj.value[i] for i in xrange(typ.tupleSize)]
+
+        return None
+
+    def writeItem(self, item):
+        if isinstance(item.value, str):
+            self.pad(self.nextPowerOfTwo(1))
+
+            item.offset = self.f.tell()
+            self.f.write(item.value)
+
+        elif isinstance(item.value, TagArrayBlock):
+            self.pad(self.nextPowerOfTwo(item.typ.superType.alignment))
+            self.scanType(item.typ)
+
+            item.offset = self.f.tell()
+            self.f.write(item.value.data)
+
+            for offset, obj in item.value.objects:
+                self.writeObject(obj, item.offset + offset)
+
+            self.f.seek(item.offset + len(item.value.data))
+
+        else:
+            self.pad(self.nextPowerOfTwo(item.typ.superType.alignment))
+
+            item.offset = self.f.tell()
+            for i in xrange(len(item.value)):
+                self.writeObject(item.value[i], item.offset + i * item.typ.superType.byteSize)
+
+    def resolveStringItems(self):
+        if not self.stringItems:
+            return
+
+        charType = self.getType("char")
+
+        if charType == None:
+            charType = TagType("char")
+            charType.flags = TagFlag.SubType | TagFlag.ByteSize
+            charType.mFormatInfo = TagSubType.Int | TagSubType.Int8
+            charType.byteSize = 1
+            charType.alignment = 1
+            self.scanType(charType)
+
+        for item in self.stringItems:
+            item.typ = charType
+
     def writeObject(self, obj, offset=0):
         if offset == 0:
             offset = self.f.tell()
@@ -906,6 +2079,8 @@ class TagWriter(object):
         else:
             self.f.seek(offset)
 
+        self.scanType(obj.typ)
+
         typ = obj.typ.superType
 
         if typ.subType == TagSubType.Bool:
@@ -916,7 +2091,7 @@ class TagWriter(object):
             item = self.makeItem(obj)
             if item != None:
                 self.addPatch(typ)
-                self.writeFormat("<I", self.items.index(item))
+                self.writeFormat("<I", self.itemIndices[item])
 
         elif typ.subType == TagSubType.Int:
             self.writeFormat(TagReader.getFormatString(typ.mFormatInfo, obj.value < 0), obj.value)
@@ -966,17 +2141,28 @@ class TagWriter(object):
             self.writeNulls(amount)
 
     def makeItem(self, obj, pointer=False):
-        if obj.value == None or (hasattr(obj.value, "__len__") and len(obj.value) <= 0):
+        # Not == None, which NumPy arrays compare elementwise.
+        if obj.value is None or (hasattr(obj.value, "__len__") and len(obj.value) <= 0):
             return None
 
         if obj.attachment != None:
             return obj.attachment
 
+        value = obj.value
+        if obj.typ.superType.subType == TagSubType.Array and TagArrayBlock.isArrayBacked(value):
+            value = TagArrayBlock(obj.typ.superType.mSubType, value)
+
+        key = self.getContentKey(obj.typ, value) if self.dedupe else None
+        if key != None and key in self.contentItems:
+            obj.attachment = self.contentItems[key]
+            return obj.attachment
+
         item = TagItem()
 
         if obj.typ.superType.subType == TagSubType.String:
-            item.typ = self.getType("char")
-            item.value = [TagObject(ord(x), item.typ) for x in obj.value + "\0"]
+            # Typed once the whole graph has been seen, see resolveStringItems.
+            item.value = obj.value + "\0"
+            self.stringItems.append(item)
 
         elif obj.typ.superType.subType == TagSubType.Pointer or pointer:
             # Fake Pointer
@@ -992,7 +2178,7 @@ class TagWriter(object):
 
         elif obj.typ.superType.subType == TagSubType.Array:
             item.typ = obj.typ.superType.mSubType
-            item.value = obj.value
+            item.value = value
 
             if item.typ.superType.subType == TagSubType.Pointer:
                 item.isPtr = True
@@ -1002,14 +2188,62 @@ class TagWriter(object):
 
         obj.attachment = item
 
+        self.itemIndices[item] = len(self.items)
         self.items.append(item)
-        self.items2.append(item)
+
+        if key != None:
+            self.contentItems[key] = item
 
         return item
 
+    def getContentKey(self, typ, value):
+        typ = typ.superType
+
+        if typ.subType == TagSubType.String:
+            return value
+
+        elif isinstance(value, TagArrayBlock):
+            return (typ.mSubType, value.data) if not value.objects else None
+
+        elif typ.subType == TagSubType.Array and TagDecodePlan.get(typ.mSubType).primitive:
+            values = []
+            for element in value:
+                self.addContentValues(element, values)
+
+            return (typ.mSubType, tuple(values))
+
+        return None
+
+    def addContentValues(self, obj, values):
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.Class:
+            for member in typ.allMembers:
+                if obj.value.has_key(member.name):
+                    self.addContentValues(obj.value[member.name], values)
+                else:
+                    values.append(None)
+
+        elif typ.subType == TagSubType.Tuple:
+            for i in xrange(typ.tupleSize):
+                self.addContentValues(obj.value[i], values)
+
+        elif typ.subType == TagSubType.Float:
+            # Compared as written, so that 0.0 and -0.0 stay apart.
+            values.append(struct.pack("<f", obj.value))
+
+        else:
+            values.append(obj.value)
+
     def scanType(self, typ):
-        if typ != None and not typ in self.types:
-            self.types.append(typ)
+        if typ != None and not typ in self.typeIndices:
+            if self.compendium != None:
+                # Items are typed by the subtypes of arrays and pointers.
+                self.typeIndices[typ] = self.findCompendiumType(typ)
+                self.scanType(typ.mSubType)
+                return
+
+            self.addType(typ)
 
             for template in typ.templates:
                 if template.isType:
@@ -1024,23 +2258,31 @@ class TagWriter(object):
             for iTyp, flag in typ.interfaces:
                 self.scanType(iTyp)
 
-    def scanObjectForType(self, obj):
-        if obj == None:
-            return
+    def addType(self, typ):
+        self.typeIndices[typ] = len(self.types)
+        self.types.append(typ)
 
-        self.scanType(obj.typ)
+        self.addString(self.typeStrings, self.typeStringIndices, typ.name)
 
-        if obj.typ.superType.subType == TagSubType.Pointer:
-            self.scanObjectForType(obj.value)
+        for template in typ.templates:
+            self.addString(self.typeStrings, self.typeStringIndices, template.name)
 
-        elif obj.typ.superType.subType == TagSubType.Class:
-            for member in obj.typ.allMembers:
-                if obj.value.has_key(member.name):
-                    self.scanObjectForType(obj.value[member.name])
+        for member in typ.members:
+            self.addString(self.fieldStrings, self.fieldStringIndices, member.name)
 
-        elif obj.typ.superType.subType & 0xF == TagSubType.Array:
-            for obj2 in obj.value:
-                self.scanObjectForType(obj2)
+    def findCompendiumType(self, typ):
+        match = self.compendiumTypes.get(typ.key)
+
+        if match == None or (typ.hsh and match.hsh and typ.hsh != match.hsh):
+            raise ValueError("Type {} could not be found in the compendium".format(typ))
+
+        return self.compendium.typeIndices[match]
+
+    @staticmethod
+    def addString(strings, indices, string):
+        if not string in indices:
+            indices[string] = len(strings)
+            strings.append(string)
 
     def getType(self, name):
         for typ in self.types[1:]:
@@ -1148,18 +2390,53 @@ class TagXmlParser(object):
     def parseFloat(self, text):
         return struct.unpack("f", struct.pack("I", int(text[1:], 16)))[0]
 
+    def parseFloats(self, texts):
+        # Converted as one block instead of one struct call per float.
+        words = array.array("I", [int(x[1:], 16) for x in texts])
+
+        floats = array.array("f")
+        floats.fromstring(words.tostring())
+        return floats
+
     def splitNumArray(self, text):
         prettyString = text.strip().replace("\n", "").replace("\r", "")
         return [x for x in prettyString.split(" ") if x]
 
     def parseNumArray(self, typ, text):
+        if typ.superType.subType == TagSubType.Float:
+            return [TagObject(x, typ) for x in self.parseFloats(self.splitNumArray(text))]
+
         return [self.parseValueText(typ, x) for x in self.splitNumArray(text)]
 
+    def parseVectorArray(self, typ, elem):
+        # Arrays of hkQsTransformf, vec4 and vec16 are kept as one block of
+        # floats, which TagWriter writes as is. None if an element has a
+        # different number of floats than its type.
+        subTyp = typ.superType.mSubType
+        size = subTyp.superType.byteSize // 4
+
+        texts = []
+        for x in elem:
+            texts.extend(self.splitNumArray(x.text or ""))
+
+        if len(texts) != len(elem) * size:
+            return None
+
+        return TagObject(self.parseFloats(texts), typ)
+
     def parseArray(self, typ, elem):
         pointer = typ.superType.mSubType.superType
 
+        if typ.superType.subType == TagSubType.Array and TagXmlSerializer.getVectorTag(pointer) != None:
+            obj = self.parseVectorArray(typ, elem)
+            if obj != None:
+                return obj
+
         value = None
         if pointer.subType >= TagSubType.Bool and pointer.subType <= TagSubType.Float and pointer.subType != TagSubType.String:
+            if typ.superType.subType == TagSubType.Array and pointer.subType == TagSubType.Float:
+                return TagObject(self.parseFloats(self.splitNumArray(elem.text)), typ)
+
             value = self.parseNumArray(typ.superType.mSubType, elem.text)
 
         else:
@@ -1208,7 +2485,8 @@ class TagXmlParser(object):
                 members[name] = value
 
             if typ.superType.name == "hkQsTransformf":
-                floats = [TagObject(self.parseFloat(x), self.findType("float")) for x in self.splitNumArray(elem.text)]
+                floatType = self.findType("float")
+                floats = [TagObject(x, floatType) for x in self.parseFloats(self.splitNumArray(elem.text))]
 
                 members["translation"] = TagObject(floats[:4], members["translation"].typ)
                 members["rotation"] = TagObject(floats[4:8], members["rotation"].typ)
@@ -1252,6 +2530,9 @@ class TagXmlSerializer(object):
         self.objects = []
         self.objCounter = 0
         self.backporter = backporter
+        # Type -> name written for it. Kept here rather than on the types,
+        # which are shared with later files.
+        self.typeTags = {}
 
     @staticmethod
     def toFile(outputFileName, obj, backporter=None):
@@ -1270,8 +2551,8 @@ class TagXmlSerializer(object):
         if typ.superType is not None:
             typ = typ.superType
 
-        if not dontCare and typ.tag != None:
-            return typ.tag
+        if not dontCare and typ in self.typeTags:
+            return self.typeTags[typ]
 
         name = typ.name
 
@@ -1292,8 +2573,8 @@ class TagXmlSerializer(object):
         if dontCare:
             return ret
 
-        typ.tag = ret
-        return typ.tag
+        self.typeTags[typ] = ret
+        return ret
 
     def getSubTypeName(self, typ):
         typ = typ.superType
@@ -1327,101 +2608,184 @@ class TagXmlSerializer(object):
     def getFloatString(self, value):
         return "x{:08x}".format(struct.unpack("I", struct.pack("f", value))[0])
 
-    def getValueString(self, obj):
-        typ = obj.typ.superType
+    def getFloatStrings(self, obj):
+        # Every float of an array made of floats only, converted as one block.
+        if TagArrayBlock.isArrayBacked(obj.value):
+            data = TagArrayBlock(obj.typ.superType.mSubType, obj.value).data
 
-        if typ.subType == TagSubType.Bool:
-            return str(1 if obj.value else 0)
+        else:
+            floats = array.array("f")
+            for element in obj.value:
+                self.addFloats(element, floats)
 
-        elif typ.subType == TagSubType.Int:
-            return str(obj.value)
+            data = floats.tostring()
 
-        elif typ.subType == TagSubType.Float:
-            return self.getFloatString(obj.value)
+        words = array.array("I")
+        words.fromstring(data)
 
-    def makeNumArray(self, obj):
-        index = 16 if obj.typ.superType.mSubType.superType.byteSize == 1 else 8
+        if sys.byteorder != "little" and TagArrayBlock.isArrayBacked(obj.value):
+            words.byteswap()
 
-        result = ""
-        for i in xrange(len(obj.value)):
-            if not i % index:
-                result += "\n"
+        return ["x{:08x}".format(x) for x in words]
 
-            result += self.getValueString(obj.value[i]) + " "
+    def addFloats(self, obj, floats):
+        typ = obj.typ.superType
 
-        return result[:-1]
+        if typ.subType == TagSubType.Float:
+            floats.append(obj.value)
 
-    def serializeObject(self, parent, obj):
-        if (hasattr(obj.value, "__len__") and len(obj.value) > 0) or obj.value:
-            elem = ET.SubElement(parent, self.getSubTypeName(obj.typ))
+        elif typ.subType == TagSubType.Tuple and typ.mSubType.superType.subType == TagSubType.Float:
+            floats.extend([x.value for x in obj.value])
 
-            typ = obj.typ.superType
+        elif typ.subType == TagSubType.Tuple:
+            for x in obj.value:
+                self.addFloats(x, floats)
 
-            if typ.subType == TagSubType.Bool:
-                elem.text = str(1 if obj.value else 0)
+        elif typ.subType == TagSubType.Class:
+            for member in typ.allMembers:
+                self.addFloats(obj.value[member.name], floats)
 
-            elif typ.subType == TagSubType.String:
-                elem.text = obj.value
+    @staticmethod
+    def getVectorTag(typ):
+        if typ.subType == TagSubType.Class and typ.name == "hkQsTransformf":
+            return "vec12"
 
-            elif typ.subType == TagSubType.Int:
-                elem.text = str(obj.value)
+        elif typ.subType == TagSubType.Tuple and typ.mSubType.superType.subType == TagSubType.Float:
+            if typ.tupleSize == 4:
+                return "vec4"
 
-            elif typ.subType == TagSubType.Float:
-                elem.text = self.getFloatString(obj.value)
+            elif typ.tupleSize == 16:
+                return "vec16"
 
-            elif typ.subType == TagSubType.Pointer:
-                elem.text = self.getIdString(obj.value.attachment)
+        return None
 
-            elif typ.subType == TagSubType.Class:
-                # hkQsTransformf
-                if typ.name == "hkQsTransformf":
-                    floats = [x.value for x in
-                              obj.value["translation"].value + obj.value["rotation"].value + obj.value["scale"].value]
+    def makeVectorArray(self, elem, obj):
+        # Whole arrays of vectors are converted in one go, then split into
+        # one element per vector.
+        typ = obj.typ.superType.mSubType.superType
+        tag = self.getVectorTag(typ)
+        size = typ.byteSize // 4
 
-                    elem.tag = "vec12"
-                    elem.text = " ".join([self.getFloatString(x) for x in floats])
+        strings = self.getFloatStrings(obj)
 
-                else:
-                    for member in typ.allMembers:
-                        if not member.flags & 1 and obj.value.has_key(member.name):
-                            memberElem = self.serializeObject(elem, obj.value[member.name])
+        for i in xrange(0, len(strings), size):
+            ET.SubElement(elem, tag).text = " ".join(strings[i:i + size])
 
-                            if memberElem != None:
-                                memberElem.set("name", member.name)
+        return len(strings) // size
 
-                            if member.tag:
-                                memberElem.tag = self.getSubTypeName(member.tag)
+    def getValueString(self, obj):
+        typ = obj.typ.superType
 
-            elif typ.subType & 0xF == TagSubType.Array:
-                pointer = typ.mSubType.superType
+        if typ.subType == TagSubType.Bool:
+            return str(1 if obj.value else 0)
 
-                if pointer.subType == TagSubType.Bool or pointer.subType == TagSubType.Int:
-                    elem.text = self.makeNumArray(obj)
+        elif typ.subType == TagSubType.Int:
+            return str(obj.value)
 
-                elif pointer.subType == TagSubType.Float:
-                    elem.text = " ".join([self.getFloatString(x.value) for x in obj.value])
+        elif typ.subType == TagSubType.Float:
+            return self.getFloatString(obj.value)
 
-                else:
-                    for obj2 in obj.value:
-                        self.serializeObject(elem, obj2)
+    def makeNumArray(self, obj):
+        index = 16 if obj.typ.superType.mSubType.superType.byteSize == 1 else 8
+
+        result = ""
+        for i in xrange(len(obj.value)):
+            if not i % index:
+                result += "\n"
+
+            result += self.getValueString(obj.value[i]) + " "
+
+        return result[:-1]
+
+    def serializeObject(self, parent, obj):
+        node = [parent, obj, None, None]
+        TagGraphWalker.walk(node, self.enterSerializeObject)
+        return node[3]
+
+    # Nodes are [parent element, object, member, element]; the member (if any)
+    # names the created element within its parent struct.
+    def enterSerializeObject(self, node):
+        parent, obj, member = node[0], node[1], node[2]
+
+        if not ((hasattr(obj.value, "__len__") and len(obj.value) > 0) or obj.value):
+            return
 
-                if typ.subType == TagSubType.Array:
-                    elem.set("size", str(len(obj.value)))
+        elem = ET.SubElement(parent, self.getSubTypeName(obj.typ))
+        node[3] = elem
+        children = None
 
-                elif typ.subType == TagSubType.Tuple:
-                    elem.set("size", str(typ.tupleSize))
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.Bool:
+            elem.text = str(1 if obj.value else 0)
+
+        elif typ.subType == TagSubType.String:
+            elem.text = obj.value
+
+        elif typ.subType == TagSubType.Int:
+            elem.text = str(obj.value)
+
+        elif typ.subType == TagSubType.Float:
+            elem.text = self.getFloatString(obj.value)
+
+        elif typ.subType == TagSubType.Pointer:
+            elem.text = self.getIdString(obj.value.attachment)
+
+        elif typ.subType == TagSubType.Class:
+            # hkQsTransformf
+            if typ.name == "hkQsTransformf":
+                floats = array.array("f")
+                self.addFloats(obj, floats)
+
+                elem.tag = "vec12"
+                elem.text = " ".join([self.getFloatString(x) for x in floats])
+
+            else:
+                children = [[elem, obj.value[member2.name], member2, None] for member2 in typ.allMembers
+                            if not member2.flags & 1 and obj.value.has_key(member2.name)]
+
+        elif typ.subType & 0xF == TagSubType.Array:
+            pointer = typ.mSubType.superType
+            count = len(obj.value)
+
+            if typ.subType == TagSubType.Array and self.getVectorTag(pointer) != None:
+                count = self.makeVectorArray(elem, obj)
+
+            elif pointer.subType == TagSubType.Bool or pointer.subType == TagSubType.Int:
+                elem.text = self.makeNumArray(obj)
+
+            elif pointer.subType == TagSubType.Float:
+                strings = self.getFloatStrings(obj)
+                count = len(strings)
+
+                elem.text = " ".join(strings)
+
+            else:
+                children = [[elem, obj2, None, None] for obj2 in obj.value]
 
-                # hkVector4
-                if typ.tupleSize == 4 and pointer.subType == TagSubType.Float:
-                    elem.tag = "vec4"
-                    elem.attrib.pop("size")
+            if typ.subType == TagSubType.Array:
+                elem.set("size", str(count))
 
-                # hkMatrix4f
-                elif typ.tupleSize == 16 and pointer.subType == TagSubType.Float:
-                    elem.tag = "vec16"
-                    elem.attrib.pop("size")
+            elif typ.subType == TagSubType.Tuple:
+                elem.set("size", str(typ.tupleSize))
 
-            return elem
+            # hkVector4
+            if typ.tupleSize == 4 and pointer.subType == TagSubType.Float:
+                elem.tag = "vec4"
+                elem.attrib.pop("size")
+
+            # hkMatrix4f
+            elif typ.tupleSize == 16 and pointer.subType == TagSubType.Float:
+                elem.tag = "vec16"
+                elem.attrib.pop("size")
+
+        if member != None:
+            elem.set("name", member.name)
+
+            if member.tag:
+                elem.tag = self.getSubTypeName(member.tag)
+
+        return children
 
     def serializeMemberProp(self, parent, typ):
         if typ == None:
@@ -1486,36 +2850,47 @@ class TagXmlSerializer(object):
         obj.attachment = self.objCounter
         self.scanObjectForType(obj)
 
-        if self.backporter != None:
-            self.backporter(self.types)
+        # Types are shared between files, so undo the backporter's changes afterwards.
+        saved = TagTypeBackporter.saveTypes(self.types)
 
-        rootElem = ET.Element("hktagfile", {"version": "1", "sdkversion": "hk_2012.2.0-r1"})
+        try:
+            if self.backporter != None:
+                self.backporter(self.types)
 
-        for typ in self.types:
-            if typ.subType == TagSubType.Class and typ.name != "hkQsTransformf":
-                self.serializeType(rootElem, typ)
+            rootElem = ET.Element("hktagfile", {"version": "1", "sdkversion": "hk_2012.2.0-r1"})
+
+            for typ in self.types:
+                if typ.subType == TagSubType.Class and typ.name != "hkQsTransformf":
+                    self.serializeType(rootElem, typ)
 
-        for obj2 in self.objects:
-            elem = self.serializeObject(rootElem, obj2)
-            elem.set("id", self.getIdString(obj2.attachment))
-            elem.set("type", self.getTypeName(obj2.typ.superType))
-            elem.tag = "object"
+            for obj2 in self.objects:
+                elem = self.serializeObject(rootElem, obj2)
+                elem.set("id", self.getIdString(obj2.attachment))
+                elem.set("type", self.getTypeName(obj2.typ.superType))
+                elem.tag = "object"
+
+        finally:
+            TagTypeBackporter.restoreTypes(saved)
 
         TagXmlSerializer.indent(rootElem)
         return rootElem
 
     @staticmethod
     def indent(elem, level=0, hor="  ", ver="\n"):
+        TagGraphWalker.walk((elem, level),
+                            lambda node: TagXmlSerializer.enterIndent(node, hor, ver),
+                            lambda node: TagXmlSerializer.leaveIndent(node, hor, ver))
+
+    @staticmethod
+    def enterIndent(node, hor, ver):
+        elem, level = node
         i = ver + level * hor
         if len(elem):
             if not elem.text or not elem.text.strip():
                 elem.text = i + hor
             if not elem.tail or not elem.tail.strip():
                 elem.tail = i
-            for elem in elem:
-                TagXmlSerializer.indent(elem, level + 1, hor, ver)
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
+            return [(child, level + 1) for child in elem]
         else:
             if level and (not elem.tail or not elem.tail.strip()):
                 elem.tail = i
@@ -1524,6 +2899,14 @@ class TagXmlSerializer(object):
                 elif (elem.tag == "class" or elem.tag == "struct") and not len(elem):
                     elem.text = i
 
+    @staticmethod
+    def leaveIndent(node, hor, ver):
+        elem, level = node
+        if len(elem):
+            i = ver + level * hor
+            last = elem[-1]
+            if not last.tail or not last.tail.strip():
+                last.tail = i
 
     def scanType(self, typ):
         if typ is None:
@@ -1546,48 +2929,51 @@ class TagXmlSerializer(object):
             for member in typ.members:
                 self.scanType(member.typ)
 
-            self.getTypeName(typ)
+            name = self.getTypeName(typ)
 
-            if TagXmlSerializerSpecialTypeNames.has_key(typ.tag):
-                specialName = TagXmlSerializerSpecialTypeNames[typ.tag]
+            if TagXmlSerializerSpecialTypeNames.has_key(name):
+                specialName = TagXmlSerializerSpecialTypeNames[name]
 
                 # Create Fake Type
                 fakeType = TagType(specialName)
                 fakeType.mFormatInfo = 7
-                fakeType.tag = specialName
-                fakeType.parent = TagType(typ.tag)
+                fakeType.parent = TagType(name)
                 self.types.append(fakeType)
 
-                typ.tag = specialName
+                self.typeTags[typ] = specialName
         else:
             pass
             # debug("type already recorded", typ.name)
 
     def scanObjectForType(self, obj):
+        TagGraphWalker.walk(obj, self.enterObjectForType)
+
+    def enterObjectForType(self, obj):
         if obj == None:
             return
 
-        # while True:
         self.scanType(obj.typ)
-        # if obj.value is None:
-        #     break
 
         if obj.typ.superType.subType == TagSubType.Pointer and obj.value and not obj.value.attachment:
             self.objects.append(obj.value)
             self.objCounter += 1
             obj.value.attachment = self.objCounter
 
-            self.scanObjectForType(obj.value)
+            return [obj.value]
+
         elif obj.typ.superType.subType == TagSubType.Class:
-            for member in obj.typ.allMembers:
-                if obj.value.has_key(member.name):
-                    self.scanObjectForType(obj.value[member.name])
+            return [obj.value[member.name] for member in obj.typ.allMembers
+                    if obj.value.has_key(member.name)]
 
         elif obj.typ.superType.subType & 0xF == TagSubType.Array:
-            for obj2 in obj.value:
-                self.scanObjectForType(obj2)
-        # else:
-        #     break
+            pointer = obj.typ.superType.mSubType.superType
+
+            # Numbers and vectors reach no types beyond the array's own.
+            if (pointer.subType == TagSubType.Bool or pointer.subType == TagSubType.Int or
+                    pointer.subType == TagSubType.Float or self.getVectorTag(pointer) != None):
+                return None
+
+            return obj.value
 
 def findFile(fileName):
     for arg in sys.argv:
@@ -1617,6 +3003,26 @@ class TagTypeBackporter(object):
         if mem is not None:
             typ.members.remove(mem)
 
+    @staticmethod
+    def saveTypes(types):
+        # Everything backportTypes2012 may change.
+        return [(typ, typ.version, list(typ.members), [(x, x.name, x.tag) for x in typ.members]) for typ in types]
+
+    @staticmethod
+    def getChangedTypes(saved):
+        # Types backportTypes2012 took members out of.
+        return set(typ for typ, version, members, names in saved if len(typ.members) != len(members))
+
+    @staticmethod
+    def restoreTypes(saved):
+        for typ, version, members, names in saved:
+            typ.version = version
+            typ.members = members
+
+            for member, name, tag in names:
+                member.name = name
+                member.tag = tag
+
 
     @staticmethod
     def backportTypes2012(types):
@@ -1696,77 +3102,2766 @@ class TagTypeBackporter(object):
         return types
 
 
-def findFile(fileName, mandatory=True):
-    for arg in sys.argv:
-        path = os.path.join(os.path.dirname(arg), fileName)
+class TagPackfileLayout(object):
+    """Works out 4101 layouts of tag types for packfiles.
 
-        if os.path.exists(path):
-            return path
+    4101 means 4-byte pointers, little endian, no reuse of base class
+    padding and empty base classes taking no space. Types without pointers
+    keep their tag layout, everything else is laid out again with 4-byte
+    pointers and 12-byte arrays. Types are expected to have gone through
+    TagTypeBackporter.backportTypes2012 first, and those it took members out
+    of, given in changedTypes, are laid out again as well.
 
-    if mandatory:
-        raise ValueError("AssetCc2.exe could not be found.")
+    These layouts have only been checked against this tool's own packfiles
+    and a hand-made one in tests/fixtures, not yet against AssetCc2's.
+    """
 
-    return None
+    def __init__(self):
+        self.layouts = {}
+        self.pointers = {}
+        self.changedTypes = set()
+        self.tagLayouts = {}
 
+    @staticmethod
+    def alignUp(value, alignment):
+        return (value + alignment - 1) & ~(alignment - 1)
 
-if __name__ == "__main__":
-    import sys
-    # sys.setrecursionlimit(10000)
-    if len(sys.argv) <= 1:
-        print "Tool for converting HKX (version <= 2012 2.0) files to 2016 1.0 tag binary files, and vice versa."
-        print "\nUsage: {} [source] [compendium] [destination]".format(os.path.basename(sys.argv[0]))
-        print "Compendium file is needed for files that contain no type info."
-        print "If no destination is included, the changes will be overwritten to the source."
-        print "You can do a simple drag and drop that way."
-        print "\nMade by Skyth."
-        print "Press enter to continue..."
-        raw_input()
+    def hasPointers(self, typ):
+        if typ == None:
+            return False
 
-    else:
-        inputFileName = None
-        inputFileType = TagFileType.Invalid
-        compendiumFileName = None
-        outputFileName = None
+        if typ in self.pointers:
+            return self.pointers[typ]
 
-        for arg in sys.argv[1:]:
-            if (os.path.exists(arg)):
-                typ = TagReader.checkFile(arg)
-            else:
-                typ = TagFileType.Invalid
-
-            if (compendiumFileName == None and typ == TagFileType.Compendium):
-                compendiumFileName = arg
-            elif (inputFileName == None):
-                inputFileName = arg
-                inputFileType = typ
-            elif (outputFileName == None):
-                outputFileName = arg
-
-        if (outputFileName == None):
-            outputFileName = os.path.splitext(inputFileName)[0] + ".hkx"
-
-        tempFileName = os.path.join(os.path.dirname(sys.argv[0]), "temp.xml")
-        # print(tempFileName)
-        print("input file type", inputFileType)
-        if inputFileType == TagFileType.Object:
-            assetCc2Path = findFile("AssetCc2.exe", False)
+        # Assumed while the type is being looked at, which only matters for
+        # classes containing themselves, and those do so through pointers.
+        self.pointers[typ] = False
 
-            destinationFileName = tempFileName
-            if (assetCc2Path == None):
-                destinationFileName = outputFileName
-            debug("dest: " + destinationFileName)
-            parsedObj = TagReader.fromFile(inputFileName, compendiumFileName)
-            TagXmlSerializer.toFile(destinationFileName, parsedObj, TagTypeBackporter.backportTypes2012)
+        sup = typ.superType
+        if sup == None:
+            result = False
+
+        elif sup.subType == TagSubType.String or sup.subType == TagSubType.Pointer or sup.subType == TagSubType.Array:
+            result = True
+
+        elif sup.subType == TagSubType.Tuple:
+            result = self.hasPointers(sup.mSubType)
+
+        elif sup.subType == TagSubType.Class:
+            result = sup.name == "hkBaseObject" or self.hasPointers(sup.parent) or \
+                any(self.hasPointers(x.typ) for x in sup.members)
 
-            if (assetCc2Path != None):
-                print('feed AssetCc2')
-                # subprocess.call([assetCc2Path, "--strip", "--rules8011", tempFileName, outputFileName])
-                subprocess.call([assetCc2Path, "--strip", "--rules4101", tempFileName, outputFileName])
-                # print("assetCc to " + outputFileName)
         else:
-            types = TagTypeHelper.loadTypes(findFile("TypeDatabase.xml"))
-            subprocess.call([findFile("AssetCc2.exe"), "-g", "-x", inputFileName, tempFileName])
-            TagWriter.toFile(outputFileName, TagXmlParser.fromFile(tempFileName, types))
+            result = False
 
-        if os.path.exists(tempFileName):
-            os.remove(tempFileName)
+        self.pointers[typ] = result
+        return result
+
+    def keepsTagLayout(self, typ):
+        if typ == None:
+            return True
+
+        if typ in self.tagLayouts:
+            return self.tagLayouts[typ]
+
+        self.tagLayouts[typ] = True
+
+        sup = typ.superType
+        if sup == None:
+            result = True
+
+        elif self.hasPointers(sup) or sup in self.changedTypes:
+            result = False
+
+        elif sup.subType == TagSubType.Tuple:
+            result = self.keepsTagLayout(sup.mSubType)
+
+        elif sup.subType == TagSubType.Class:
+            result = self.keepsTagLayout(sup.parent) and all(self.keepsTagLayout(x.typ) for x in sup.members)
+
+        else:
+            result = True
+
+        self.tagLayouts[typ] = result
+        return result
+
+    def getLayout(self, typ):
+        """Returns (size, alignment, member offsets) of a type."""
+        sup = typ.superType if typ != None else None
+
+        layout = self.layouts.get(sup)
+        if layout != None:
+            return layout
+
+        if sup == None:
+            layout = (0, 1, {})
+
+        elif self.keepsTagLayout(sup):
+            offsets = {}
+            if sup.subType == TagSubType.Class:
+                offsets = {x: x.byteOffset for x in sup.allMembers}
+
+            layout = (sup.byteSize, max(sup.alignment, 1), offsets)
+
+        elif sup.subType == TagSubType.String or sup.subType == TagSubType.Pointer:
+            layout = (4, 4, {})
+
+        elif sup.subType == TagSubType.Array:
+            layout = (12, 4, {})
+
+        elif sup.subType == TagSubType.Tuple:
+            size, alignment, offsets = self.getLayout(sup.mSubType)
+            layout = (size * sup.tupleSize, alignment, {})
+
+        elif sup.name == "hkBaseObject":
+            # Just the vtable.
+            layout = (4, 4, {})
+
+        else:
+            size = 0
+            alignment = 1
+            offsets = {}
+
+            if sup.parent != None:
+                size, alignment, parentOffsets = self.getLayout(sup.parent)
+                offsets.update(parentOffsets)
+
+                # Empty base classes take no space.
+                if not parentOffsets and not self.hasPointers(sup.parent):
+                    size = 0
+
+            for member in sup.members:
+                memberSize, memberAlignment, memberOffsets = self.getLayout(member.typ)
+                size = TagPackfileLayout.alignUp(size, memberAlignment)
+                offsets[member] = size
+                size += memberSize
+                alignment = max(alignment, memberAlignment)
+
+            layout = (TagPackfileLayout.alignUp(size, alignment), alignment, offsets)
+
+        self.layouts[sup] = layout
+        return layout
+
+    def getClassName(self, typ):
+        name = TagXmlSerializer().getTypeName(typ, True)
+        return TagXmlSerializerSpecialTypeNames.get(name, name)
+
+
+class TagPackfileWriter(TagPackfileLayout):
+    """Writes a 2012.2 binary packfile with 4101 layout rules.
+
+    Layouts are worked out by TagPackfileLayout from the tag types after
+    TagTypeBackporter.backportTypes2012.
+
+    The classnames section needs the 2012 signature of every class written.
+    Only a few are known here; the rest are taken from ClassSignatures.txt
+    next to the tool (one "name signature" pair per line, signatures in hex).
+    Writing fails with the list of classes missing a signature, since the
+    2012 runtime rejects classes whose signature doesn't match.
+    """
+
+    signatures = {
+        "hkClass": 0x33d42383,
+        "hkClassMember": 0xb0efa719,
+        "hkClassEnum": 0x8a3609cf,
+        "hkClassEnumItem": 0xce6f8a6c,
+        "hkRootLevelContainer": 0x2772c11e,
+    }
+
+    signatureFileName = None
+
+    def __init__(self, f, signatures=None):
+        TagPackfileLayout.__init__(self)
+        self.f = f
+        self.signatures = dict(TagPackfileWriter.signatures)
+
+        if signatures == None and TagPackfileWriter.signatureFileName == None:
+            TagPackfileWriter.signatureFileName = findFile("ClassSignatures.txt", False) or ""
+            if TagPackfileWriter.signatureFileName:
+                TagPackfileWriter.signatures.update(TagPackfileWriter.loadSignatures(TagPackfileWriter.signatureFileName))
+                self.signatures = dict(TagPackfileWriter.signatures)
+
+        self.signatures.update(signatures or {})
+        self.missingSignatures = []
+        self.data = bytearray()
+        self.localFixups = []
+        self.globalFixups = []
+        self.virtualFixups = []
+        self.objectOffsets = {}
+        self.queue = []
+        self.queued = set()
+        self.classNames = []
+        self.classNameOffsets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, arg1, arg2, arg3):
+        self.f.close()
+
+    @staticmethod
+    def toFile(outputFileName, obj, signatures=None):
+        # Nothing is written if a signature is missing.
+        f = io.BytesIO()
+        TagPackfileWriter(f, signatures).writeRootSection(obj)
+
+        with open(outputFileName, "wb") as output:
+            output.write(f.getvalue())
+
+    @staticmethod
+    def loadSignatures(inputFileName):
+        signatures = {}
+
+        with open(inputFileName, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and not line.startswith("#"):
+                    signatures[fields[0]] = int(fields[1], 16)
+
+        return signatures
+
+    @staticmethod
+    def getTypes(obj):
+        types = []
+        seen = set()
+
+        def enterType(typ):
+            if typ == None or typ in seen:
+                return None
+
+            seen.add(typ)
+            types.append(typ)
+
+            children = [typ.parent, typ.mSubType] + [x.typ for x in typ.members]
+            children.extend(x.value for x in typ.templates if x.isType)
+            return children
+
+        def enterObject(obj):
+            if obj == None or id(obj) in seen:
+                return None
+
+            seen.add(id(obj))
+            TagGraphWalker.walk(obj.typ, enterType)
+
+            subType = obj.typ.superType.subType
+            if subType == TagSubType.Pointer:
+                return [obj.value]
+
+            elif subType == TagSubType.Class:
+                return obj.value.values()
+
+            elif subType == TagSubType.Tuple or subType == TagSubType.Array:
+                return obj.value
+
+        TagGraphWalker.walk(obj, enterObject)
+        return types
+
+    def addClassName(self, name):
+        if not name in self.classNameOffsets:
+            # Signature, 0x09, then the name the offset points at.
+            self.classNameOffsets[name] = sum(len(x) + 6 for x in self.classNames) + 5
+            self.classNames.append(name)
+
+            if not name in self.signatures:
+                self.missingSignatures.append(name)
+
+        return self.classNameOffsets[name]
+
+    def pad(self, alignment):
+        self.data.extend("\0" * (TagPackfileWriter.alignUp(len(self.data), alignment) - len(self.data)))
+
+    def allocate(self, size, alignment):
+        self.pad(alignment)
+        offset = len(self.data)
+        self.data.extend("\0" * size)
+        return offset
+
+    def writeRootSection(self, obj):
+        types = TagPackfileWriter.getTypes(obj)
+        saved = TagTypeBackporter.saveTypes(types)
+
+        try:
+            TagTypeBackporter.backportTypes2012(types)
+            self.changedTypes = TagTypeBackporter.getChangedTypes(saved)
+
+            for name in ("hkClass", "hkClassMember", "hkClassEnum", "hkClassEnumItem"):
+                self.addClassName(name)
+
+            self.queue.append(obj)
+            self.queued.add(obj)
+            index = 0
+            while index < len(self.queue):
+                self.writeTopLevelObject(self.queue[index])
+                index += 1
+
+            self.pad(16)
+
+        finally:
+            TagTypeBackporter.restoreTypes(saved)
+
+        rootClassNameOffset = self.addClassName(self.getClassName(obj.typ))
+
+        if self.missingSignatures:
+            raise ValueError("No signature is known for {}, add them to ClassSignatures.txt".format(
+                ", ".join(self.missingSignatures)))
+
+        self.writeFile(rootClassNameOffset)
+
+    def writeTopLevelObject(self, obj):
+        size, alignment, offsets = self.getLayout(obj.typ)
+        offset = self.allocate(size, 16)
+
+        self.objectOffsets[obj] = offset
+        self.virtualFixups.append((offset, self.addClassName(self.getClassName(obj.typ))))
+
+        deferred = []
+        self.writeObject(obj, offset, deferred)
+        self.writeDeferred(deferred)
+
+    def writeObject(self, obj, offset, deferred):
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.Bool:
+            struct.pack_into(TagReader.getFormatString(typ.mFormatInfo), self.data, offset, obj.value)
+
+        elif typ.subType == TagSubType.Int:
+            struct.pack_into(TagReader.getFormatString(typ.mFormatInfo, obj.value < 0), self.data, offset, obj.value)
+
+        elif typ.subType == TagSubType.Float:
+            struct.pack_into("<f", self.data, offset, obj.value)
+
+        elif typ.subType == TagSubType.String:
+            if obj.value:
+                deferred.append((offset, obj))
+
+        elif typ.subType == TagSubType.Array:
+            if obj.value:
+                struct.pack_into("<2I", self.data, offset + 4, len(obj.value), len(obj.value) | 0x80000000)
+                deferred.append((offset, obj))
+
+        elif typ.subType == TagSubType.Pointer:
+            if obj.value != None:
+                if not obj.value in self.queued:
+                    self.queued.add(obj.value)
+                    self.queue.append(obj.value)
+
+                self.globalFixups.append((offset, obj.value))
+
+        elif typ.subType == TagSubType.Class:
+            size, alignment, offsets = self.getLayout(typ)
+            for member in typ.allMembers:
+                if obj.value.has_key(member.name):
+                    self.writeObject(obj.value[member.name], offset + offsets[member], deferred)
+
+        elif typ.subType == TagSubType.Tuple:
+            size, alignment, offsets = self.getLayout(typ.mSubType)
+            for i in xrange(typ.tupleSize):
+                self.writeObject(obj.value[i], offset + i * size, deferred)
+
+    def writeDeferred(self, deferred):
+        # Strings and array contents follow the object that points at them,
+        # in the order they were met.
+        for fieldOffset, obj in deferred:
+            typ = obj.typ.superType
+
+            if typ.subType == TagSubType.String:
+                dataOffset = self.allocate(len(obj.value) + 1, 2)
+                self.data[dataOffset:dataOffset + len(obj.value)] = obj.value
+
+            else:
+                size, alignment, offsets = self.getLayout(typ.mSubType)
+                dataOffset = self.allocate(size * len(obj.value), 16)
+
+                children = []
+                for i, element in enumerate(obj.value):
+                    self.writeObject(element, dataOffset + i * size, children)
+
+                self.writeDeferred(children)
+
+            self.localFixups.append((fieldOffset, dataOffset))
+
+    def writeFixups(self, fixups, format):
+        for fixup in fixups:
+            self.f.write(struct.pack(format, *fixup))
+
+        amount = TagPackfileWriter.alignUp(self.f.tell(), 16) - self.f.tell()
+        self.f.write("\xff" * amount)
+
+    def writeSectionHeader(self, tag, start, offsets):
+        self.f.write(tag.ljust(19, "\0") + "\xff")
+        self.f.write(struct.pack("<7i", start, *offsets))
+        self.f.write("\xff" * 16)
+
+    def writeFile(self, rootClassNameOffset):
+        classNames = "".join(struct.pack("<I", self.signatures.get(x, 0)) + "\x09" + x + "\0"
+                             for x in self.classNames)
+        classNames += "\xff" * (TagPackfileWriter.alignUp(len(classNames), 16) - len(classNames))
+
+        self.f.write(struct.pack("<2I", 0x57e0e057, 0x10c0c010))
+        self.f.write(struct.pack("<2i", 0, 11))
+        self.f.write(struct.pack("4B", 4, 1, 0, 1))
+        self.f.write(struct.pack("<5i", 3, 2, 0, 0, rootClassNameOffset))
+        self.f.write("hk_2012.2.0-r1\0\xff")
+        self.f.write(struct.pack("<Ihh", 0, -1, 0))
+
+        classNamesStart = 64 + 3 * 64
+        typesStart = classNamesStart + len(classNames)
+        dataStart = typesStart
+
+        # Fixup tables follow the data, each padded to 16 bytes.
+        localOffset = len(self.data)
+        globalOffset = localOffset + TagPackfileWriter.alignUp(len(self.localFixups) * 8, 16)
+        virtualOffset = globalOffset + TagPackfileWriter.alignUp(len(self.globalFixups) * 12, 16)
+        endOffset = virtualOffset + TagPackfileWriter.alignUp(len(self.virtualFixups) * 12, 16)
+
+        size = len(classNames)
+        self.writeSectionHeader("__classnames__", classNamesStart, [size] * 6)
+        self.writeSectionHeader("__types__", typesStart, [0] * 6)
+        self.writeSectionHeader("__data__", dataStart,
+                                [localOffset, globalOffset, virtualOffset, endOffset, endOffset, endOffset])
+
+        self.f.write(classNames)
+        self.f.write(self.data)
+        self.writeFixups(self.localFixups, "<2i")
+        self.writeFixups([(x, 2, self.objectOffsets[y]) for x, y in self.globalFixups], "<3i")
+        self.writeFixups([(x, 0, y) for x, y in self.virtualFixups], "<3i")
+
+
+class TagPackfileReader(TagPackfileLayout):
+    """Reads a 2012.2 binary packfile with 4101 layout rules.
+
+    Objects are typed against a type database from TagTypeHelper.loadTypes,
+    laid out as TagPackfileLayout does after backporting the types to 2012,
+    and come out like TagXmlParser makes them from the XML of "AssetCc2 -x":
+    members not serialized in 2012 are left out, top-level objects take the
+    type named by their virtual fixup.
+    """
+
+    def __init__(self, f, types):
+        TagPackfileLayout.__init__(self)
+        self.f = f
+        self.types = types
+        self.typesByName = None
+        self.data = TagReader.mapFile(f)
+        self.sections = []
+        # Absolute offsets, fixups are relative to their sections in the file.
+        self.localFixups = {}
+        self.globalFixups = {}
+        self.virtualFixups = {}
+        self.objects = {}
+        self.queue = []
+        self.plans = {}
+        self.names = {}
+        self.missingTypes = []
+        self.readHeader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, arg1, arg2, arg3):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+        self.f.close()
+
+    @staticmethod
+    def fromFile(inputFileName, types):
+        with TagPackfileReader(open(inputFileName, "rb"), types) as r:
+            return r.readRootSection()
+
+    def readString(self, offset):
+        return self.data[offset:self.data.find("\0", offset)]
+
+    def readHeader(self):
+        if len(self.data) < 64 or struct.unpack_from("<2I", self.data, 0) != (0x57e0e057, 0x10c0c010):
+            raise ValueError("Not a packfile")
+
+        fileVersion = struct.unpack_from("<i", self.data, 12)[0]
+        layoutRules = struct.unpack_from("4B", self.data, 16)
+        if fileVersion != 11 or layoutRules != (4, 1, 0, 1):
+            raise ValueError("Only 2012 packfiles with 4101 layout rules can be read, not version {} with {} rules"
+                             .format(fileVersion, "".join(str(x) for x in layoutRules)))
+
+        sectionCount, contentsSection, contentsOffset, classNameSection, classNameOffset = \
+            struct.unpack_from("<5i", self.data, 20)
+        predicatePadding = struct.unpack_from("<h", self.data, 62)[0]
+
+        for i in xrange(sectionCount):
+            offset = 64 + max(predicatePadding, 0) + i * 64
+            tag = self.readString(offset)[:19]
+            start, localOffset, globalOffset, virtualOffset, exportsOffset, importsOffset, endOffset = \
+                struct.unpack_from("<7i", self.data, offset + 20)
+            self.sections.append((tag, start, localOffset, globalOffset, virtualOffset, exportsOffset))
+
+        for tag, start, localOffset, globalOffset, virtualOffset, exportsOffset in self.sections:
+            # Unused entries at the end of each table are -1.
+            for offset in xrange(start + localOffset, start + globalOffset - 7, 8):
+                source, destination = struct.unpack_from("<2i", self.data, offset)
+                if source != -1:
+                    self.localFixups[start + source] = start + destination
+
+            for offset in xrange(start + globalOffset, start + virtualOffset - 11, 12):
+                source, section, destination = struct.unpack_from("<3i", self.data, offset)
+                if source != -1:
+                    self.globalFixups[start + source] = self.sections[section][1] + destination
+
+            for offset in xrange(start + virtualOffset, start + exportsOffset - 11, 12):
+                source, section, destination = struct.unpack_from("<3i", self.data, offset)
+                if source != -1:
+                    self.virtualFixups[start + source] = self.readString(self.sections[section][1] + destination)
+
+        self.rootOffset = self.sections[contentsSection][1] + contentsOffset
+        self.rootClassName = self.readString(self.sections[classNameSection][1] + classNameOffset)
+
+    def findType(self, name):
+        if self.typesByName == None:
+            self.typesByName = {self.getClassName(x): x for x in self.types if x.subType == TagSubType.Class}
+
+        return self.typesByName.get(name)
+
+    def readRootSection(self):
+        # Types are shared with other readers and writers, so undo the
+        # backporter's changes afterwards.
+        saved = TagTypeBackporter.saveTypes(self.types)
+
+        try:
+            TagTypeBackporter.backportTypes2012(list(self.types))
+            self.changedTypes = TagTypeBackporter.getChangedTypes(saved)
+            self.names = {member: name for typ, version, members, names in saved for member, name, tag in names}
+
+            root = self.getObject(self.rootOffset, self.findType(self.rootClassName))
+
+            index = 0
+            while index < len(self.queue):
+                offset, typ, obj = self.queue[index]
+                value = self.readObject(typ, offset)
+                obj.value = value.value
+                obj.typ = value.typ
+                index += 1
+
+        finally:
+            TagTypeBackporter.restoreTypes(saved)
+
+        for name in self.missingTypes:
+            print "WARNING: Type '{}' could not be found in the type database!".format(name)
+
+        return root
+
+    def getObject(self, offset, typ):
+        obj = self.objects.get(offset)
+        if obj != None or offset in self.objects:
+            return obj
+
+        name = self.virtualFixups.get(offset)
+        if name != None:
+            typ = self.findType(name)
+
+            if typ == None and not name in self.missingTypes:
+                self.missingTypes.append(name)
+
+        if typ != None:
+            obj = TagObject(None, typ)
+            self.queue.append((offset, typ, obj))
+
+        self.objects[offset] = obj
+        return obj
+
+    def getPlan(self, typ):
+        # Not TagDecodePlan.get, the types are backported while this reads.
+        plan = self.plans.get(typ)
+        if plan == None:
+            plan = TagDecodePlan(typ)
+            self.plans[typ] = plan
+
+        return plan
+
+    def readObject(self, typOrg, offset):
+        typ = typOrg.superType
+
+        if not self.hasPointers(typ):
+            # Laid out as in tag files, so everything is unpacked at once.
+            plan = self.getPlan(typOrg)
+            return plan.build(plan.tree, plan.unpack(self.data, offset), None, None)
+
+        elif typ.subType == TagSubType.String:
+            destination = self.localFixups.get(offset)
+            return TagObject(self.readString(destination) if destination != None else "", typOrg)
+
+        elif typ.subType == TagSubType.Pointer:
+            destination = self.globalFixups.get(offset)
+            return TagObject(self.getObject(destination, typ.mSubType) if destination != None else None, typOrg)
+
+        elif typ.subType == TagSubType.Array:
+            destination = self.localFixups.get(offset)
+            count = struct.unpack_from("<i", self.data, offset + 4)[0]
+            if destination == None or count <= 0:
+                return TagObject([], typOrg)
+
+            size, alignment, offsets = self.getLayout(typ.mSubType)
+            return TagObject([self.readObject(typ.mSubType, destination + x * size) for x in xrange(count)], typOrg)
+
+        elif typ.subType == TagSubType.Tuple:
+            size, alignment, offsets = self.getLayout(typ.mSubType)
+            return TagObject(tuple([self.readObject(typ.mSubType, offset + x * size)
+                                    for x in xrange(typ.tupleSize)]), typOrg)
+
+        elif typ.subType == TagSubType.Class:
+            size, alignment, offsets = self.getLayout(typ)
+            return TagObject({self.names.get(x, x.name): self.readObject(x.typ, offset + offsets[x])
+                              for x in typ.allMembers if not x.flags & 1}, typOrg)
+
+        return TagObject(None, typOrg)
+
+
+class TagCompendiumBuilder(object):
+    """Collects the types of many tag files into one TCM0 compendium.
+
+    Types are unified by TagType.key. Types sharing a key have to agree on
+    their THSH hash (or their layout when either has none); a file bringing
+    a conflicting type is left out as a whole. A hash found for a type only
+    in a later file is kept by the writer, as the type itself is shared.
+    """
+
+    def __init__(self):
+        self.w = TagWriter(None)
+        self.canonicalTypes = {}
+        self.fileNames = []
+
+    @staticmethod
+    def getLayout(typ):
+        return (typ.flags, typ.mFormatInfo, typ.byteSize, typ.alignment,
+                typ.parent.key if typ.parent != None else None,
+                typ.mSubType.key if typ.mSubType != None else None,
+                [(x.name, x.byteOffset, x.typ.key if x.typ != None else None) for x in typ.members])
+
+    def getHash(self, typ):
+        return self.w.typeHashes.get(typ, typ.hsh)
+
+    def sameLayout(self, typ, canonical):
+        hsh = self.getHash(canonical)
+        if typ.hsh and hsh:
+            return typ.hsh == hsh
+
+        return TagCompendiumBuilder.getLayout(typ) == TagCompendiumBuilder.getLayout(canonical)
+
+    def add(self, r, fileName=None):
+        for typ in r.types[1:]:
+            canonical = self.canonicalTypes.get(typ.key)
+            if canonical != None and not self.sameLayout(typ, canonical):
+                return False
+
+        for typ in r.types[1:]:
+            canonical = self.canonicalTypes.get(typ.key)
+
+            if canonical == None:
+                self.canonicalTypes[typ.key] = typ
+                self.w.addType(typ)
+
+            else:
+                if not self.getHash(canonical) and typ.hsh:
+                    self.w.typeHashes[canonical] = typ.hsh
+
+                self.w.typeIndices[typ] = self.w.typeIndices[canonical]
+
+        self.fileNames.append(fileName)
+        return True
+
+    def makeId(self):
+        h = hashlib.sha1()
+
+        for typ in self.w.types[1:]:
+            h.update("{}\0{}\0".format(typ.name, self.getHash(typ)))
+
+        return h.digest()[:8]
+
+    def toFile(self, outputFileName):
+        with open(outputFileName, "wb") as f:
+            self.w.f = f
+            self.w.writeCompendiumSection([self.makeId()])
+            self.w.f = None
+
+    @staticmethod
+    def rewriteFile(inputFileName, compendium, outputFileName=None):
+        """Makes a tag file reference the compendium instead of its own types.
+
+        DATA is copied as is; only the type indices in ITEM and PTCH change.
+        """
+        summary = TagFileScanner.scanFile(inputFileName)
+        sections = {x[0]: (x[1], x[2]) for x in summary.sections}
+
+        with TagReader(open(inputFileName, "rb")) as r:
+            f = io.BytesIO()
+            w = TagWriter(f, compendium, referenceCompendium=True)
+            typeIndices = [0] + [w.findCompendiumType(typ) for typ in r.types[1:]]
+
+            def section(signature):
+                offset, size = sections[signature]
+                return r.data[offset:offset + size]
+
+            with TagSectionWriter(w, "TAG0", False) as t1:
+
+                with TagSectionWriter(w, "SDKV") as t2:
+                    f.write(section("SDKV"))
+
+                with TagSectionWriter(w, "DATA") as t3:
+                    f.write(section("DATA"))
+
+                w.writeCompendiumReference()
+
+                with TagSectionWriter(w, "INDX", False) as t4:
+
+                    with TagSectionWriter(w, "ITEM") as t5:
+                        data = section("ITEM")
+
+                        for i in xrange(0, len(data) - 11, 12):
+                            flag, offset, count = struct.unpack_from("<3I", data, i)
+                            w.writeFormat("<3I", flag & ~0xFFFFFF | typeIndices[flag & 0xFFFFFF], offset, count)
+
+                    with TagSectionWriter(w, "PTCH") as t6:
+                        for typeIndex, offsets in sorted((typeIndices[x], y) for x, y in r.patches.iteritems()):
+                            w.writeFormat("<2I", typeIndex, len(offsets))
+
+                            for offset in offsets:
+                                w.writeFormat("<I", offset)
+
+        with open(outputFileName or inputFileName, "wb") as f2:
+            f2.write(f.getvalue())
+
+
+class TagFileEditor(object):
+    """Changes values in a tag file and saves it without rebuilding it.
+
+    getItem decodes the elements of one item, one level deep: pointers and
+    arrays in them are TagItemReferences, which can be passed to getItem in
+    turn, and strings are plain values. Change values in place, or give a
+    member a new value: a str for strings, a list of TagObjects for arrays,
+    a TagItemReference or None for pointers and arrays.
+
+    save copies SDKV and the TYPE or TCRF section as they are and encodes
+    again only the items getItem handed out, over their old bytes. Strings
+    and arrays given new values are appended to DATA as new items, leaving
+    their old copies unreferenced. Types can't be added this way, so new
+    values must use types the file already has.
+
+    Strings and arrays more than one field points at (see TagWriter's dedupe)
+    can't be changed in place, as that would change them for every field;
+    save raises ValueError instead. To change one use of a shared array,
+    give the member pointing at it a new list, such as a fresh copy from
+    r.readItem(index, depth=0), which is saved as a new item. Objects
+    several pointers point at are one object, and changing it for every
+    pointer is what's meant.
+
+    Files whose items are read at PTCH offsets can't be edited this way and
+    raise ValueError.
+    """
+
+    def __init__(self, inputFileName, compendium=None):
+        self.inputFileName = inputFileName
+        self.compendium = compendium
+        self.r = TagReader(open(inputFileName, "rb"), compendium)
+        try:
+            self.r.checkItemOffsets()
+        except ValueError:
+            self.r.close()
+            raise
+
+        # Item index -> elements handed out by getItem
+        self.values = {}
+        self.data = None
+        self.newItems = []
+        self.newStrings = {}
+        self.patches = {}
+        self.patchOffsets = {}
+        self.w = TagWriter(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, arg1, arg2, arg3):
+        self.r.__exit__(arg1, arg2, arg3)
+
+    def getItem(self, index):
+        index = self.r.resolveItemIndex(index)
+
+        if not index in self.values:
+            self.values[index] = self.r.readItem(index, depth=0)
+
+        return self.values[index]
+
+    def getObject(self):
+        return self.getItem(1)[0]
+
+    def getTypeIndex(self, typ):
+        index = self.r.typeIndices.get(typ)
+        if index == None:
+            raise ValueError("Type {} is not in the file".format(typ))
+
+        return index
+
+    def save(self, outputFileName=None):
+        r = self.r
+        summary = TagFileScanner.scanFile(self.inputFileName)
+        sections = {x[0]: (x[1], x[2]) for x in summary.sections}
+
+        def section(signature, header=False):
+            offset, size = sections[signature]
+            if header:
+                return r.data[offset - 8:offset + size]
+
+            return r.data[offset:offset + size]
+
+        self.data = bytearray(section("DATA"))
+        self.newItems = []
+        self.newStrings = {}
+        self.patches = {x: list(y) for x, y in r.patches.iteritems()}
+        self.patchOffsets = {}
+
+        counts = r.getReferenceCounts()
+
+        for index, elements in sorted(self.values.iteritems()):
+            item = r.items[index]
+            byteSize = item.typ.superType.byteSize
+            start = item.offset - r.dataOffset
+            old = str(self.data[start:start + byteSize * item.count])
+
+            for i, obj in enumerate(elements):
+                self.encodeObject(obj, start + i * byteSize)
+
+            if counts.get(index, 0) > 1 and self.data[start:start + byteSize * item.count] != old:
+                self.data = None
+                raise ValueError("Item {} is shared by {} fields and can't be changed in place".format(
+                    index, counts[index]))
+
+        self.pad(16)
+
+        # Tables without new offsets keep their order.
+        for typeIndex, offsets in self.patchOffsets.iteritems():
+            if len(offsets) != len(self.patches.get(typeIndex, ())):
+                self.patches[typeIndex] = sorted(offsets)
+
+        f = io.BytesIO()
+        w = TagWriter(f)
+
+        with TagSectionWriter(w, "TAG0", False) as t1:
+
+            with TagSectionWriter(w, "SDKV") as t2:
+                f.write(section("SDKV"))
+
+            with TagSectionWriter(w, "DATA") as t3:
+                f.write(self.data)
+
+            f.write(section("TCRF" if sections.has_key("TCRF") else "TYPE", True))
+
+            with TagSectionWriter(w, "INDX", False) as t4:
+
+                with TagSectionWriter(w, "ITEM") as t5:
+                    f.write(section("ITEM"))
+
+                    for flag, offset, count in self.newItems:
+                        w.writeFormat("<3I", flag, offset, count)
+
+                with TagSectionWriter(w, "PTCH") as t6:
+                    for typeIndex, offsets in sorted(self.patches.iteritems()):
+                        w.writeFormat("<2I", typeIndex, len(offsets))
+
+                        for offset in offsets:
+                            w.writeFormat("<I", offset)
+
+        self.data = None
+
+        if outputFileName == None or os.path.abspath(outputFileName) == os.path.abspath(self.inputFileName):
+            # The reader maps the file being overwritten; objects handed out
+            # so far are saved and not tracked any longer.
+            r.close()
+            with open(self.inputFileName, "wb") as f2:
+                f2.write(f.getvalue())
+
+            self.r = TagReader(open(self.inputFileName, "rb"), self.compendium)
+            self.values = {}
+
+        else:
+            with open(outputFileName, "wb") as f2:
+                f2.write(f.getvalue())
+
+    def pad(self, alignment):
+        self.data.extend("\0" * (-len(self.data) % alignment))
+
+    def addPatch(self, typ, offset):
+        typeIndex = self.getTypeIndex(typ)
+
+        offsets = self.patchOffsets.get(typeIndex)
+        if offsets == None:
+            offsets = set(self.patches.get(typeIndex, ()))
+            self.patchOffsets[typeIndex] = offsets
+
+        offsets.add(offset)
+
+    def addItem(self, typ, elements, flag=0x20000000):
+        sup = typ.superType
+
+        self.pad(self.w.nextPowerOfTwo(sup.alignment))
+        offset = len(self.data)
+        self.data.extend("\0" * (sup.byteSize * len(elements)))
+
+        index = len(self.r.items) + len(self.newItems)
+        self.newItems.append((self.getTypeIndex(typ) | flag, offset, len(elements)))
+
+        for i, element in enumerate(elements):
+            self.encodeObject(element, offset + i * sup.byteSize)
+
+        return index
+
+    def addString(self, value):
+        if not value in self.newStrings:
+            charType = self.r.getType("char")
+            if charType == None:
+                raise ValueError("Type char is not in the file")
+
+            self.pad(2)
+            offset = len(self.data)
+            self.data.extend(value + "\0")
+
+            self.newStrings[value] = len(self.r.items) + len(self.newItems)
+            self.newItems.append((self.getTypeIndex(charType) | 0x20000000, offset, len(value) + 1))
+
+        return self.newStrings[value]
+
+    def readString(self, index):
+        if index <= 0 or index >= len(self.r.items):
+            return ""
+
+        item = self.r.items[index]
+        return self.r.data[item.offset:item.offset + max(item.count - 1, 0)]
+
+    def encodeObject(self, obj, offset):
+        """Writes obj at an offset into DATA, keeping the items it refers to
+        where they are unchanged."""
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.Bool:
+            struct.pack_into(TagReader.getFormatString(typ.mFormatInfo), self.data, offset, obj.value)
+
+        elif typ.subType == TagSubType.Int:
+            struct.pack_into(TagReader.getFormatString(typ.mFormatInfo, obj.value < 0), self.data, offset, obj.value)
+
+        elif typ.subType == TagSubType.Float:
+            struct.pack_into("<f", self.data, offset, obj.value)
+
+        elif typ.subType == TagSubType.String or typ.subType == TagSubType.Pointer or typ.subType == TagSubType.Array:
+            index = struct.unpack_from("<I", self.data, offset)[0]
+
+            if isinstance(obj.value, TagItemReference):
+                index = obj.value.index
+
+            elif obj.value == None or (hasattr(obj.value, "__len__") and len(obj.value) <= 0):
+                index = 0
+
+            elif typ.subType == TagSubType.String:
+                if obj.value != self.readString(index):
+                    index = self.addString(obj.value)
+
+            elif typ.subType == TagSubType.Array:
+                isPtr = typ.mSubType.superType.subType == TagSubType.Pointer
+                index = self.addItem(typ.mSubType, obj.value, 0x10000000 if isPtr else 0x20000000)
+
+            else:
+                raise ValueError("Pointers can only be set to TagItemReferences or None")
+
+            struct.pack_into("<I", self.data, offset, index)
+
+            if index != 0:
+                self.addPatch(typ, offset)
+
+        elif typ.subType == TagSubType.Class:
+            for member in typ.allMembers:
+                if obj.value.has_key(member.name):
+                    self.encodeObject(obj.value[member.name], offset + member.byteOffset)
+
+        elif typ.subType == TagSubType.Tuple:
+            for i in xrange(typ.tupleSize):
+                self.encodeObject(obj.value[i], offset + i * typ.mSubType.superType.byteSize)
+
+
+class TagScalarPatcher(object):
+    """Rewrites bools, ints and floats of tag files in place.
+
+    Values are found by member paths such as
+    "hkaSkeleton.bones[3].lockTranslation", resolved with the ITEM table and
+    the types' byte offsets alone, and written through a writable mmap of the
+    file, so nothing is decoded and nothing else is touched.
+
+    A path starts with a type name, standing for the first object of that
+    type, or for the n-th one with [n]. Members are followed with .name
+    (through pointers too), elements of arrays and tuples with [n]. [*]
+    stands for every element.
+
+    Paths through a string or array more than one field points at (see
+    TagWriter's dedupe) raise ValueError, as writing it would change every
+    field, and so do files whose items are read at PTCH offsets. Objects
+    reached through several pointers are one object and are patched.
+    """
+
+    @staticmethod
+    def loadPatches(inputFileName):
+        """Reads "path = value" lines; empty lines and # comments are skipped."""
+        patches = []
+
+        with open(inputFileName, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                path, sep, value = line.rpartition("=")
+                if not sep:
+                    raise ValueError("Expected path = value, got {}".format(line))
+
+                patches.append((path.strip(), value.strip()))
+
+        return patches
+
+    @staticmethod
+    def patchFile(inputFileName, patches, compendium=None):
+        """Applies (path, value) pairs, returning the number of values written.
+
+        Paths starting with a type the file has no objects of are skipped.
+        Anything else that doesn't resolve raises ValueError before any byte
+        is written.
+        """
+        r = TagReader(open(inputFileName, "rb"), compendium)
+
+        try:
+            # Offsets are resolved from the ITEM table alone.
+            r.checkItemOffsets()
+
+            writes = []
+            for path, value in patches:
+                writes.extend(TagScalarPatcher.resolveWrites(r, path, value))
+
+        finally:
+            r.close()
+
+        if not writes:
+            return 0
+
+        with open(inputFileName, "r+b") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+
+            try:
+                for offset, packed in writes:
+                    data[offset:offset + len(packed)] = packed
+
+                data.flush()
+
+            finally:
+                data.close()
+
+        return len(writes)
+
+    @staticmethod
+    def parsePath(path):
+        match = re.match(r"([^.\[]+)(.*)$", path.strip())
+        if match == None:
+            raise ValueError("Invalid path {}".format(path))
+
+        steps = re.findall(r"\.([^.\[]+)|\[(\*|\d+)\]", match.group(2))
+        if "".join("." + name if name else "[" + index + "]" for name, index in steps) != match.group(2):
+            raise ValueError("Invalid path {}".format(path))
+
+        return match.group(1).strip(), [name.strip() if name else index for name, index in steps]
+
+    @staticmethod
+    def select(elements, index, path):
+        if index == "*":
+            return elements
+
+        if int(index) >= len(elements):
+            raise ValueError("Index {} is out of range in {}".format(index, path))
+
+        return [elements[int(index)]]
+
+    @staticmethod
+    def getItemElements(r, offset, path):
+        index = struct.unpack_from("<I", r.data, offset)[0]
+        if index == 0:
+            return []
+
+        count = r.getReferenceCounts().get(index, 0)
+        if count > 1:
+            raise ValueError("Item {} is shared by {} fields, so {} can't be patched in place".format(
+                index, count, path))
+
+        item = r.items[index]
+        byteSize = item.typ.superType.byteSize
+        return [(item.offset + x * byteSize, item.typ) for x in xrange(item.count)]
+
+    @staticmethod
+    def resolvePath(r, path):
+        """Returns the (absolute offset, type) of every value a path names."""
+        typeName, steps = TagScalarPatcher.parsePath(path)
+
+        typ = r.getType(typeName)
+        if typ == None:
+            return []
+
+        nodes = []
+        for index in r.itemIndices.get(typ, []):
+            item = r.items[index]
+            nodes.extend((item.offset + x * typ.superType.byteSize, typ) for x in xrange(item.count))
+
+        if steps and (steps[0].isdigit() or steps[0] == "*"):
+            nodes = TagScalarPatcher.select(nodes, steps.pop(0), path)
+        else:
+            nodes = nodes[:1]
+
+        for step in steps:
+            result = []
+
+            for offset, typ in nodes:
+                sup = typ.superType
+
+                if step.isdigit() or step == "*":
+                    if sup.subType == TagSubType.Tuple:
+                        size = sup.mSubType.superType.byteSize
+                        elements = [(offset + x * size, sup.mSubType) for x in xrange(sup.tupleSize)]
+
+                    elif sup.subType == TagSubType.Array or sup.subType == TagSubType.Pointer:
+                        elements = TagScalarPatcher.getItemElements(r, offset, path)
+
+                    else:
+                        raise ValueError("{} can't be indexed in {}".format(sup, path))
+
+                    result.extend(TagScalarPatcher.select(elements, step, path))
+                    continue
+
+                if sup.subType == TagSubType.Pointer:
+                    elements = TagScalarPatcher.getItemElements(r, offset, path)
+                    if not elements:
+                        continue
+
+                    offset, typ = elements[0]
+                    sup = typ.superType
+
+                member = None
+                if sup.subType == TagSubType.Class:
+                    member = next((x for x in sup.allMembers if x.name == step), None)
+
+                if member == None:
+                    raise ValueError("{} has no member {} in {}".format(sup, step, path))
+
+                result.append((offset + member.byteOffset, member.typ))
+
+            nodes = result
+
+        return nodes
+
+    @staticmethod
+    def resolveWrites(r, path, value):
+        writes = []
+
+        for offset, typ in TagScalarPatcher.resolvePath(r, path):
+            sup = typ.superType
+
+            if sup.subType == TagSubType.Bool:
+                if not value.lower() in ("0", "1", "false", "true"):
+                    raise ValueError("Invalid bool {} for {}".format(value, path))
+
+                packed = struct.pack(TagReader.getFormatString(sup.mFormatInfo), value.lower() in ("1", "true"))
+
+            elif sup.subType == TagSubType.Int:
+                number = int(value, 0)
+
+                try:
+                    packed = struct.pack(TagReader.getFormatString(sup.mFormatInfo, number < 0), number)
+                except struct.error:
+                    raise ValueError("{} is out of range for {} in {}".format(value, sup, path))
+
+            elif sup.subType == TagSubType.Float:
+                packed = struct.pack("<f", float(value))
+
+            else:
+                raise ValueError("{} is not a bool, int or float in {}".format(sup, path))
+
+            writes.append((offset, packed))
+
+        return writes
+
+
+class TagGraphDiff(object):
+    """Compares two decoded object graphs.
+
+    Every class, array, tuple and pointer gets a content hash, worked out
+    bottom-up once per object, so subtrees reached through shared pointers
+    are hashed once and equal subtrees are skipped without being walked.
+    Differences are (kind, path, old, new) with kind "added", "removed" or
+    "changed" and paths in the form TagScalarPatcher takes. Array elements
+    are matched by their hashes, so an inserted element shows up as one
+    addition rather than as every element after it changing; removed
+    elements are numbered as in the old array, everything else as in the
+    new one.
+    """
+
+    def __init__(self):
+        # id of object -> hash; the graphs are kept alive by the caller.
+        self.hashes = {}
+        self.pending = set()
+        self.visited = set()
+        self.differences = []
+
+    @staticmethod
+    def diffFiles(oldFileName, newFileName, compendiumFileName=None):
+        diff = TagGraphDiff()
+        diff.diff(TagReader.fromFile(oldFileName, compendiumFileName),
+                  TagReader.fromFile(newFileName, compendiumFileName))
+        return diff.differences
+
+    @staticmethod
+    def isComposite(obj):
+        subType = obj.typ.superType.subType
+        return subType == TagSubType.Class or subType == TagSubType.Pointer or subType & 0xF == TagSubType.Array
+
+    def getHash(self, obj):
+        if obj == None:
+            return "n"
+
+        digest = self.hashes.get(id(obj))
+        if digest != None:
+            return digest
+
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.Float:
+            return "f" + struct.pack("<f", obj.value)
+
+        elif typ.subType == TagSubType.String:
+            return "s" + (obj.value or "")
+
+        elif not TagGraphDiff.isComposite(obj):
+            return "i" + str(obj.value)
+
+        elif id(obj) in self.pending:
+            # Reached again through a cycle.
+            return "c" + typ.name
+
+        TagGraphWalker.walk([obj, False], self.enterHash, self.leaveHash)
+        return self.hashes[id(obj)]
+
+    def getChildren(self, obj):
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.Pointer:
+            return [obj.value] if obj.value != None else []
+
+        elif typ.subType == TagSubType.Class:
+            return [obj.value[x.name] for x in typ.allMembers if obj.value.has_key(x.name)]
+
+        return obj.value
+
+    def enterHash(self, node):
+        obj = node[0]
+        if obj == None or id(obj) in self.hashes or id(obj) in self.pending or not TagGraphDiff.isComposite(obj):
+            return
+
+        node[1] = True
+        self.pending.add(id(obj))
+
+        # Plain values are hashed where they're used.
+        return [[x, False] for x in self.getChildren(obj)
+                if x != None and TagGraphDiff.isComposite(x) and not id(x) in self.hashes]
+
+    def leaveHash(self, node):
+        obj, entered = node
+        if not entered:
+            return
+
+        self.pending.remove(id(obj))
+        typ = obj.typ.superType
+        h = hashlib.sha1(typ.name)
+
+        if typ.subType == TagSubType.Class:
+            h.update("".join(["\0" + x.name + "\0" + self.getHash(obj.value[x.name])
+                              for x in typ.allMembers if obj.value.has_key(x.name)]))
+
+        else:
+            h.update("".join(["\0" + self.getHash(x) for x in self.getChildren(obj)]))
+
+        self.hashes[id(obj)] = "h" + h.digest()
+
+    def getValueString(self, obj):
+        if obj == None:
+            return "null"
+
+        typ = obj.typ.superType
+
+        if typ.subType == TagSubType.Class:
+            return "<{}>".format(typ.name)
+
+        elif typ.subType == TagSubType.Pointer:
+            return self.getValueString(obj.value)
+
+        elif typ.subType & 0xF == TagSubType.Array:
+            return "<{} elements>".format(len(obj.value))
+
+        return repr(obj.value)
+
+    def add(self, kind, path, old, new):
+        self.differences.append((kind, path,
+                                 self.getValueString(old) if old != None else None,
+                                 self.getValueString(new) if new != None else None))
+
+    def diff(self, old, new):
+        path = old.typ.superType.name if old != None else new.typ.superType.name
+        TagGraphWalker.walk((old, new, path), self.enterDiff)
+        return self.differences
+
+    def enterDiff(self, node):
+        old, new, path = node
+
+        if old == None or new == None:
+            if old != None:
+                self.add("removed", path, old, None)
+            elif new != None:
+                self.add("added", path, None, new)
+
+            return
+
+        if self.getHash(old) == self.getHash(new) or (id(old), id(new)) in self.visited:
+            return
+
+        self.visited.add((id(old), id(new)))
+        oldType = old.typ.superType
+        newType = new.typ.superType
+
+        if oldType.name != newType.name or oldType.subType != newType.subType:
+            self.add("changed", path, old, new)
+
+        elif oldType.subType == TagSubType.Pointer:
+            if old.value == None or new.value == None:
+                self.add("changed", path, old, new)
+            else:
+                return [(old.value, new.value, path)]
+
+        elif oldType.subType == TagSubType.Class:
+            names = [x.name for x in oldType.allMembers]
+            return [(old.value.get(x), new.value.get(x), path + "." + x) for x in names]
+
+        elif oldType.subType == TagSubType.Tuple:
+            return [(x, y, "{}[{}]".format(path, i)) for i, (x, y) in enumerate(zip(old.value, new.value))]
+
+        elif oldType.subType == TagSubType.Array:
+            return self.diffArrays(old.value, new.value, path)
+
+        else:
+            self.add("changed", path, old, new)
+
+    def diffArrays(self, old, new, path):
+        children = []
+        oldHashes = [self.getHash(x) for x in old]
+        newHashes = [self.getHash(x) for x in new]
+
+        # Only the part between the common start and end is matched. Its
+        # junk heuristic makes SequenceMatcher give up on arrays of few
+        # distinct values, so it's only used when that part is long.
+        start = 0
+        while start < len(old) and start < len(new) and oldHashes[start] == newHashes[start]:
+            start += 1
+
+        end = 0
+        while end < len(old) - start and end < len(new) - start and oldHashes[-1 - end] == newHashes[-1 - end]:
+            end += 1
+
+        oldHashes = oldHashes[start:len(old) - end]
+        newHashes = newHashes[start:len(new) - end]
+        matcher = difflib.SequenceMatcher(None, oldHashes, newHashes, len(oldHashes) + len(newHashes) > 2000)
+
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+
+            i1, i2, j1, j2 = i1 + start, i2 + start, j1 + start, j2 + start
+
+            # Replaced runs are compared element by element, the rest of the
+            # longer run was removed or added.
+            count = min(i2 - i1, j2 - j1) if tag == "replace" else 0
+            for x in xrange(count):
+                children.append((old[i1 + x], new[j1 + x], "{}[{}]".format(path, j1 + x)))
+
+            for x in xrange(i1 + count, i2):
+                self.add("removed", "{}[{}]".format(path, x), old[x], None)
+
+            for x in xrange(j1 + count, j2):
+                self.add("added", "{}[{}]".format(path, x), None, new[x])
+
+        return children
+
+
+class TagGraphSerializer(object):
+    """Writes an object graph to a compact binary file, as a faster stand-in for XML.
+
+    The file starts with the version and "TGRF", followed by the types as
+    JSON and the objects pointers point at, each as its type index and
+    value. The root is object 1, pointers are object ids (0 for null) and
+    arrays seen before are written as the id of their list, so sharing is
+    kept. Values of types made of numbers only are packed as laid out in
+    DATA, so arrays of them are one little-endian block.
+    """
+
+    version = 1
+
+    def __init__(self):
+        self.chunks = []
+        self.types = [None]
+        self.typeIndices = {None: 0}
+        self.objectIds = {}
+        self.objects = []
+        self.lists = {}
+
+    @staticmethod
+    def toFile(outputFileName, obj):
+        with open(outputFileName, "wb") as f:
+            f.write(TagGraphSerializer().serialize(obj))
+
+    def serialize(self, obj):
+        self.getObjectId(obj)
+
+        index = 0
+        while index < len(self.objects):
+            obj = self.objects[index]
+            self.writeFormat("<I", self.getTypeIndex(obj.typ))
+            self.writeValue(obj.typ, obj)
+            index += 1
+
+        objects = "".join(self.chunks)
+        types = json.dumps(self.getTypeList(), separators=(",", ":"))
+
+        return "".join([struct.pack("<I", TagGraphSerializer.version), "TGRF",
+                        struct.pack("<I", len(types)), types,
+                        struct.pack("<I", len(self.objects)), objects])
+
+    def writeFormat(self, format, *args):
+        self.chunks.append(struct.pack(format, *args))
+
+    def getTypeIndex(self, typ):
+        if not typ in self.typeIndices:
+            self.typeIndices[typ] = len(self.types)
+            self.types.append(typ)
+
+        return self.typeIndices[typ]
+
+    def getObjectId(self, obj):
+        if obj == None:
+            return 0
+
+        if not id(obj) in self.objectIds:
+            self.objects.append(obj)
+            self.objectIds[id(obj)] = (len(self.objects), obj)
+
+        return self.objectIds[id(obj)][0]
+
+    def getTypeList(self):
+        # Types are only added while this runs, so everything they reference
+        # ends up in the list as well.
+        result = []
+
+        index = 1
+        while index < len(self.types):
+            typ = self.types[index]
+            get = self.getTypeIndex
+
+            result.append({
+                "name": typ.name,
+                "templates": [[x.name, get(x.value) if x.isType else x.value] for x in typ.templates],
+                "parent": get(typ.parent),
+                "flags": typ.flags,
+                "formatInfo": typ.mFormatInfo,
+                "subType": get(typ.mSubType),
+                "version": typ.version,
+                "byteSize": typ.byteSize,
+                "alignment": typ.alignment,
+                "abstractValue": typ.abstractValue,
+                "members": [[x.name, x.flags, x.byteOffset, get(x.typ), get(x.tag)] for x in typ.members],
+                "interfaces": [[get(x), y] for x, y in typ.interfaces],
+                "hsh": typ.hsh})
+
+            index += 1
+
+        return result
+
+    def writeValue(self, typ, obj):
+        plan = TagDecodePlan.get(typ)
+        if plan.primitive:
+            self.chunks.append(self.packElements(plan, [obj]))
+            return
+
+        sup = typ.superType
+
+        if sup.subType == TagSubType.String:
+            if obj.value is None:
+                self.writeFormat("<I", 0)
+            else:
+                self.writeFormat("<I", len(obj.value) + 1)
+                self.chunks.append(obj.value)
+
+        elif sup.subType == TagSubType.Pointer:
+            self.writeFormat("<I", self.getObjectId(obj.value))
+
+        elif sup.subType == TagSubType.Class:
+            for member in sup.allMembers:
+                value = obj.value.get(member.name)
+
+                if value is None:
+                    self.writeFormat("B", 0)
+                else:
+                    self.writeFormat("B", 1)
+                    self.writeValue(member.typ, value)
+
+        elif sup.subType == TagSubType.Tuple:
+            for x in obj.value:
+                self.writeValue(sup.mSubType, x)
+
+        elif sup.subType == TagSubType.Array:
+            self.writeArray(sup.mSubType, obj.value)
+
+    def writeArray(self, typ, value):
+        if value is None or len(value) == 0:
+            self.writeFormat("<I", 0)
+            return
+
+        if id(value) in self.lists:
+            self.writeFormat("<I", self.lists[id(value)][0])
+            return
+
+        # Kept with the id so it can't be collected and its id reused.
+        self.lists[id(value)] = (len(self.lists) + 1, value)
+
+        if TagArrayBlock.isArrayBacked(value):
+            block = TagArrayBlock(typ, value)
+            if block.objects:
+                raise ValueError("Arrays of {} can only be written as TagObjects".format(typ.name))
+
+            self.writeFormat("<3I", 1 << 31, self.getTypeIndex(typ), block.count)
+            self.chunks.append(block.data)
+            return
+
+        typ = value[0].typ
+        self.writeFormat("<3I", 1 << 31, self.getTypeIndex(typ), len(value))
+
+        plan = TagDecodePlan.get(typ)
+        if plan.primitive:
+            self.chunks.append(self.packElements(plan, value))
+
+        else:
+            for x in value:
+                self.writeValue(typ, x)
+
+    def packElements(self, plan, objs):
+        size = plan.typ.superType.byteSize
+        data = bytearray(len(objs) * size)
+
+        for i, obj in enumerate(objs):
+            values = [0] * len(plan.fields)
+            self.flatten(plan.tree, obj, values)
+
+            if plan.struct != None:
+                plan.struct.pack_into(data, i * size, *values)
+
+            else:
+                for (offset, s), value in zip(plan.structs, values):
+                    s.pack_into(data, i * size + offset, value)
+
+        return str(data)
+
+    def flatten(self, node, obj, values):
+        subType, typ, payload = node
+
+        if subType == TagSubType.Class:
+            for name, x in payload:
+                child = obj.value.get(name)
+                if child != None:
+                    self.flatten(x, child, values)
+
+        elif subType == TagSubType.Tuple:
+            for x, child in zip(payload, obj.value):
+                self.flatten(x, child, values)
+
+        else:
+            value = obj.value
+
+            if subType == TagSubType.Bool:
+                value = 1 if value else 0
+
+            elif subType == TagSubType.Int and value < 0 and payload[1].isupper():
+                # Negative values of unsigned types, written as TagWriter would.
+                value += 1 << (8 * struct.calcsize("<" + payload[1]))
+
+            values[payload[2]] = value
+
+
+class TagGraphParser(object):
+    """Reads files written by TagGraphSerializer.
+
+    With arrays, arrays of types made of floats or 8-32 bit ints only are
+    kept as array.array instead of lists of TagObjects, which TagWriter
+    writes in one go but other passes don't take.
+    """
+
+    typecodes = {"f": "f", "b": "b", "B": "B", "h": "h", "H": "H", "i": "i", "I": "I"}
+
+    def __init__(self, data, arrays=False):
+        self.data = data
+        self.offset = 0
+        self.arrays = arrays
+        self.types = None
+        self.objects = {}
+        self.lists = {}
+
+    @staticmethod
+    def fromFile(inputFileName, arrays=False):
+        with open(inputFileName, "rb") as f:
+            return TagGraphParser(f.read(), arrays).parse()
+
+    def readFormat(self, format):
+        values = struct.unpack_from(format, self.data, self.offset)
+        self.offset += struct.calcsize(format)
+        return values
+
+    def read(self, size):
+        self.offset += size
+        return self.data[self.offset - size:self.offset]
+
+    def parse(self):
+        version, signature = self.readFormat("<I4s")
+        if signature != "TGRF":
+            raise ValueError("Not a graph file")
+
+        if version != TagGraphSerializer.version:
+            raise ValueError("Graph file version {} is not supported".format(version))
+
+        self.types = self.parseTypes(json.loads(self.read(self.readFormat("<I")[0])))
+
+        # Nothing built here is garbage, so collecting while hundreds of
+        # thousands of objects are made only costs time.
+        enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            count = self.readFormat("<I")[0]
+            for index in xrange(1, count + 1):
+                typ = self.types[self.readFormat("<I")[0]]
+
+                obj = self.getObject(index)
+                obj.value = self.readValue(typ).value
+                obj.typ = typ
+
+        finally:
+            if enabled:
+                gc.enable()
+
+        return self.getObject(1)
+
+    def parseTypes(self, values):
+        types = [None] + [TagType(str(x["name"])) for x in values]
+
+        for typ, value in zip(types[1:], values):
+            for name, x in value["templates"]:
+                template = TagTemplate(str(name), x)
+                if template.isType:
+                    template.value = types[x]
+
+                typ.templates.append(template)
+
+            typ.parent = types[value["parent"]]
+            typ.flags = value["flags"]
+            typ.mFormatInfo = value["formatInfo"]
+            typ.mSubType = types[value["subType"]]
+            typ.version = value["version"]
+            typ.byteSize = value["byteSize"]
+            typ.alignment = value["alignment"]
+            typ.abstractValue = value["abstractValue"]
+            typ.hsh = value["hsh"]
+
+            for name, flags, byteOffset, x, tag in value["members"]:
+                member = TagMember()
+                member.name = str(name)
+                member.flags = flags
+                member.byteOffset = byteOffset
+                member.typ = types[x]
+                member.tag = types[tag]
+                typ.members.append(member)
+
+            typ.interfaces = [(types[x], y) for x, y in value["interfaces"]]
+
+        return TagTypeInterner.intern(types)
+
+    def getObject(self, index):
+        if index == 0:
+            return None
+
+        obj = self.objects.get(index)
+        if obj == None:
+            obj = TagObject(None, None)
+            self.objects[index] = obj
+
+        return obj
+
+    def readValue(self, typ):
+        plan = TagDecodePlan.get(typ)
+        if plan.primitive:
+            return plan.build(plan.tree, plan.unpack(self.read(typ.superType.byteSize), 0), None, None)
+
+        sup = typ.superType
+
+        if sup.subType == TagSubType.String:
+            size = self.readFormat("<I")[0]
+            return TagObject(self.read(size - 1) if size else None, typ)
+
+        elif sup.subType == TagSubType.Pointer:
+            return TagObject(self.getObject(self.readFormat("<I")[0]), typ)
+
+        elif sup.subType == TagSubType.Class:
+            value = {}
+
+            for member in sup.allMembers:
+                if self.readFormat("B")[0]:
+                    value[member.name] = self.readValue(member.typ)
+
+            return TagObject(value, typ)
+
+        elif sup.subType == TagSubType.Tuple:
+            return TagObject(tuple([self.readValue(sup.mSubType) for x in xrange(sup.tupleSize)]), typ)
+
+        elif sup.subType == TagSubType.Array:
+            return TagObject(self.readArray(), typ)
+
+        return TagObject(None, typ)
+
+    def readArray(self):
+        index = self.readFormat("<I")[0]
+
+        if index == 0:
+            return []
+
+        if not index & (1 << 31):
+            return self.lists[index]
+
+        # Numbered before the elements, which may hold arrays of their own.
+        index = len(self.lists) + 1
+        self.lists[index] = None
+
+        typeIndex, count = self.readFormat("<2I")
+        typ = self.types[typeIndex]
+
+        plan = TagDecodePlan.get(typ)
+        if not plan.primitive:
+            value = [self.readValue(typ) for x in xrange(count)]
+
+        else:
+            size = typ.superType.byteSize
+            data = self.read(count * size)
+            format = TagArrayBlock.getFlatFormat(typ)
+
+            if self.arrays and format in TagGraphParser.typecodes:
+                value = array.array(TagGraphParser.typecodes[format])
+                value.fromstring(data)
+
+                if sys.byteorder != "little":
+                    value.byteswap()
+
+            else:
+                value = [plan.build(plan.tree, plan.unpack(data, x * size), None, None) for x in xrange(count)]
+
+        self.lists[index] = value
+        return value
+
+
+def findFile(fileName, mandatory=True):
+    for arg in sys.argv:
+        path = os.path.join(os.path.dirname(arg), fileName)
+
+        if os.path.exists(path):
+            return path
+
+    if mandatory:
+        raise ValueError("AssetCc2.exe could not be found.")
+
+    return None
+
+
+def resolveArguments(args, extension=".hkx"):
+    inputFileName = None
+    inputFileType = TagFileType.Invalid
+    compendiumFileName = None
+    outputFileName = None
+
+    for arg in args:
+        if (os.path.exists(arg)):
+            typ = TagReader.checkFile(arg)
+        else:
+            typ = TagFileType.Invalid
+
+        if (compendiumFileName == None and typ == TagFileType.Compendium):
+            compendiumFileName = arg
+        elif (inputFileName == None):
+            inputFileName = arg
+            inputFileType = typ
+        elif (outputFileName == None):
+            outputFileName = arg
+
+    if (inputFileName == None):
+        raise ValueError("No source file was given")
+
+    if (outputFileName == None):
+        outputFileName = os.path.splitext(inputFileName)[0] + extension
+
+    return inputFileName, inputFileType, compendiumFileName, outputFileName
+
+
+def getWriterOptions(options):
+    writerOptions = {}
+    if options.has_key("compact-layout"):
+        writerOptions["compactLayout"] = True
+    if options.has_key("dedupe"):
+        writerOptions["dedupe"] = True
+    if options.has_key("reference-compendium"):
+        writerOptions["referenceCompendium"] = True
+
+    return writerOptions
+
+
+def callAssetCc2(args, stdout=None):
+    # A failed run can leave a partial output behind, which must not be
+    # taken for a result.
+    code = subprocess.call(args, stdout=stdout)
+
+    if code != 0:
+        raise ValueError("AssetCc2 failed with exit code {}".format(code))
+
+
+def convertFile(inputFileName, inputFileType, compendiumFileName, outputFileName, processes=None, writerOptions={},
+                native=False, graph=False):
+    tempFileName = os.path.join(os.path.dirname(sys.argv[0]), "temp.xml")
+    # print(tempFileName)
+    print("input file type", inputFileType)
+    try:
+        if inputFileType == TagFileType.Object and graph:
+            TagGraphSerializer.toFile(outputFileName, TagReader.fromFile(inputFileName, compendiumFileName, processes))
+
+        elif inputFileType == TagFileType.Object and native:
+            TagPackfileWriter.toFile(outputFileName, TagReader.fromFile(inputFileName, compendiumFileName, processes))
+
+        elif inputFileType == TagFileType.Object:
+            assetCc2Path = findFile("AssetCc2.exe", False)
+
+            destinationFileName = tempFileName
+            if (assetCc2Path == None):
+                destinationFileName = outputFileName
+            debug("dest: " + destinationFileName)
+            parsedObj = TagReader.fromFile(inputFileName, compendiumFileName, processes)
+            TagXmlSerializer.toFile(destinationFileName, parsedObj, TagTypeBackporter.backportTypes2012)
+
+            if (assetCc2Path != None):
+                print('feed AssetCc2')
+                # subprocess.call([assetCc2Path, "--strip", "--rules8011", tempFileName, outputFileName])
+                callAssetCc2([assetCc2Path, "--strip", "--rules4101", tempFileName, outputFileName])
+                # print("assetCc to " + outputFileName)
+        elif inputFileType == TagFileType.Graph:
+            compendium = None
+            if compendiumFileName != None:
+                compendium = TagReader(open(compendiumFileName, "rb"))
+
+            TagWriter.toFile(outputFileName, TagGraphParser.fromFile(inputFileName, True), compendium, **writerOptions)
+
+        else:
+            types = TagTypeHelper.loadTypes(findFile("TypeDatabase.xml"))
+
+            if native:
+                parsedObj = TagPackfileReader.fromFile(inputFileName, types)
+
+            else:
+                callAssetCc2([findFile("AssetCc2.exe"), "-g", "-x", inputFileName, tempFileName])
+                parsedObj = TagXmlParser.fromFile(tempFileName, types)
+
+            compendium = None
+            if compendiumFileName != None:
+                compendium = TagReader(open(compendiumFileName, "rb"))
+
+            TagWriter.toFile(outputFileName, parsedObj, compendium, **writerOptions)
+
+    finally:
+        if os.path.exists(tempFileName):
+            os.remove(tempFileName)
+
+
+# Part of every conversion cache key, so bump it whenever converted output
+# changes.
+TagToolsVersion = "1.3"
+
+
+class TagConversionCache(object):
+    """Maps a hash of everything a conversion depends on to its output.
+
+    Entries are plain files named after their key. A hit refreshes the
+    entry's modification time, which is what eviction orders by.
+    """
+
+    def __init__(self, directory, maxSize=512 * 1024 * 1024, maxCount=4096):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.maxCount = maxCount
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def fromOptions(options):
+        return TagConversionCache(options["cache"] or os.path.join(os.path.dirname(sys.argv[0]), "cache"),
+                                  int(options.get("cache-size") or 512) * 1024 * 1024)
+
+    @staticmethod
+    def makeConversionKey(inputFileName, compendiumFileName, writerOptions={}, native=False, graph=False):
+        # The output format depends on whether AssetCc2 is around to finish the job.
+        mode = "assetcc2" if findFile("AssetCc2.exe", False) != None else "xml"
+        keyFileNames = [inputFileName, compendiumFileName, findFile("TypeDatabase.xml", False)]
+
+        if native:
+            mode = "packfile"
+            keyFileNames.append(findFile("ClassSignatures.txt", False))
+
+        if graph:
+            mode = "graph"
+
+        mode += "".join(" {}={}".format(*x) for x in sorted(writerOptions.items()))
+        return TagConversionCache.makeKey(keyFileNames, mode)
+
+    @staticmethod
+    def makeKey(fileNames, mode=""):
+        h = hashlib.sha1(TagToolsVersion + "\0" + mode)
+
+        for fileName in fileNames:
+            h.update("\0")
+
+            if fileName != None and os.path.exists(fileName):
+                with open(fileName, "rb") as f:
+                    for chunk in iter(lambda: f.read(0x100000), ""):
+                        h.update(chunk)
+
+        return h.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key)
+
+    def fetch(self, key, outputFileName):
+        path = self.getPath(key)
+
+        if not os.path.exists(path):
+            return False
+
+        shutil.copyfile(path, outputFileName)
+        os.utime(path, None)
+        return True
+
+    def store(self, key, outputFileName):
+        if not os.path.exists(outputFileName):
+            return
+
+        path = self.getPath(key)
+        tempPath = path + ".tmp"
+
+        shutil.copyfile(outputFileName, tempPath)
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        os.rename(tempPath, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        totalSize = 0
+
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+            totalSize += stat.st_size
+
+        entries.sort()
+        count = len(entries)
+
+        for mtime, size, name in entries:
+            if totalSize <= self.maxSize and count <= self.maxCount:
+                break
+
+            os.remove(os.path.join(self.directory, name))
+            totalSize -= size
+            count -= 1
+
+
+class TagGraphSnapshots(TagConversionCache):
+    """Keeps the decoded graphs of tag files as graph files.
+
+    Snapshots are keyed by the contents of the file and its compendium and
+    start with a stamp of the tool, snapshot and graph file versions and
+    that key. One with any other stamp, or that fails to load, is stale: it
+    is removed and the file is decoded again.
+    """
+
+    # Bump when decoding gives other graphs for the same files, so snapshots
+    # of the old graphs aren't loaded even if TagToolsVersion stays the same.
+    version = 1
+
+    def getStamp(self, key):
+        return "TagTools {} snapshot {} graph {} {}\n".format(TagToolsVersion, TagGraphSnapshots.version,
+                                                             TagGraphSerializer.version, key)
+
+    def fetchGraph(self, key):
+        path = self.getPath(key)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        stamp = self.getStamp(key)
+
+        try:
+            if not data.startswith(stamp):
+                raise ValueError("Stale snapshot")
+
+            parser = TagGraphParser(data)
+            parser.offset = len(stamp)
+            obj = parser.parse()
+
+        except (ValueError, KeyError, IndexError, struct.error):
+            os.remove(path)
+            return None
+
+        os.utime(path, None)
+        return obj
+
+    def storeGraph(self, key, obj):
+        path = self.getPath(key)
+        tempPath = path + ".tmp"
+
+        with open(tempPath, "wb") as f:
+            f.write(self.getStamp(key))
+            f.write(TagGraphSerializer().serialize(obj))
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        os.rename(tempPath, path)
+        self.evict()
+
+    def load(self, inputFileName, compendiumFileName=None, processes=None):
+        key = TagConversionCache.makeKey([inputFileName, compendiumFileName],
+                                         "snapshot {} graph {}".format(TagGraphSnapshots.version,
+                                                                       TagGraphSerializer.version))
+
+        obj = self.fetchGraph(key)
+        if obj == None:
+            obj = TagReader.decodeFile(inputFileName, compendiumFileName, processes)
+            self.storeGraph(key, obj)
+
+        return obj
+
+
+class TagByteBudget(object):
+    """Blocks producers while too many bytes are in flight.
+
+    A single job larger than the whole budget is still let through once
+    nothing else is in flight, so it can't stall the pipeline forever.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.size > 0 and self.size + size > self.limit:
+                self.condition.wait()
+
+            self.size += size
+
+    def release(self, size):
+        with self.condition:
+            self.size -= size
+            self.condition.notify_all()
+
+
+class TagConversionJob(object):
+    def __init__(self, inputFileName, inputFileType, compendiumFileName, outputFileName):
+        self.inputFileName = inputFileName
+        self.inputFileType = inputFileType
+        self.compendiumFileName = compendiumFileName
+        self.outputFileName = outputFileName
+        self.data = None
+        self.size = 0
+        self.error = None
+
+
+class TagConversionPipeline(object):
+    """Converts many files with reading, converting and writing overlapped.
+
+    A reader thread prefetches inputs (running "AssetCc2 -x" for packfiles
+    unless native), a dispatcher hands them to a process pool and a writer
+    thread stores the results (running AssetCc2 again for packfile outputs
+    unless native). Stages are linked
+    by bounded queues and every job holds its input size against a shared
+    TagByteBudget until it's written.
+    """
+
+    types = None
+    # Path -> (modification time, size, TagReader)
+    compendiums = {}
+    subprocessOutput = None
+
+    def __init__(self, processes=None, maxSize=256 * 1024 * 1024, queueSize=4, writerOptions={}, native=False):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.writerOptions = writerOptions
+        self.native = native
+        self.budget = TagByteBudget(maxSize)
+        self.queueSize = queueSize
+        self.assetCc2Path = findFile("AssetCc2.exe", False)
+
+    @staticmethod
+    def makeTempFileName():
+        handle, fileName = tempfile.mkstemp(".xml")
+        os.close(handle)
+        return fileName
+
+    @staticmethod
+    def getCompendium(compendiumFileName):
+        if compendiumFileName == None:
+            return None
+
+        # A compendium rewritten since it was loaded is loaded again.
+        stat = os.stat(compendiumFileName)
+        entry = TagConversionPipeline.compendiums.get(compendiumFileName)
+
+        if entry == None or entry[:2] != (stat.st_mtime, stat.st_size):
+            if entry != None:
+                entry[2].close()
+
+            entry = (stat.st_mtime, stat.st_size, TagReader(open(compendiumFileName, "rb")))
+            TagConversionPipeline.compendiums[compendiumFileName] = entry
+
+        return entry[2]
+
+    @staticmethod
+    def convertData(inputFileType, data, compendiumFileName, writerOptions={}, native=False):
+        compendium = TagConversionPipeline.getCompendium(compendiumFileName)
+
+        if inputFileType == TagFileType.Object:
+            obj = TagReader(io.BytesIO(data), compendium).getObject(0)
+
+            f = io.BytesIO()
+            if native:
+                TagPackfileWriter(f).writeRootSection(obj)
+                return f.getvalue()
+
+            f.write('<?xml version="1.0" encoding="ascii"?>\n')
+            ET.ElementTree(TagXmlSerializer(TagTypeBackporter.backportTypes2012).serialize(obj)).write(f)
+            return f.getvalue()
+
+        if inputFileType == TagFileType.Graph:
+            f = io.BytesIO()
+            TagWriter(f, compendium, **writerOptions).writeRootSection(TagGraphParser(data, True).parse())
+            return f.getvalue()
+
+        if TagConversionPipeline.types == None:
+            TagConversionPipeline.types = TagTypeHelper.loadTypes(findFile("TypeDatabase.xml"))
+
+        if native:
+            obj = TagPackfileReader(io.BytesIO(data), TagConversionPipeline.types).readRootSection()
+        else:
+            obj = TagXmlParser(ET.fromstring(data), TagConversionPipeline.types).findObject("hkRootLevelContainer")
+
+        f = io.BytesIO()
+        TagWriter(f, compendium, **writerOptions).writeRootSection(obj)
+        return f.getvalue()
+
+    def readJob(self, job):
+        if job.inputFileType == TagFileType.Object or job.inputFileType == TagFileType.Graph or self.native:
+            with open(job.inputFileName, "rb") as f:
+                job.data = f.read()
+
+        else:
+            tempFileName = TagConversionPipeline.makeTempFileName()
+            try:
+                callAssetCc2([findFile("AssetCc2.exe"), "-g", "-x", job.inputFileName, tempFileName],
+                             TagConversionPipeline.subprocessOutput)
+                with open(tempFileName, "rb") as f:
+                    job.data = f.read()
+
+            finally:
+                os.remove(tempFileName)
+
+    def writeJob(self, job):
+        if job.inputFileType == TagFileType.Object and self.assetCc2Path != None and not self.native:
+            tempFileName = TagConversionPipeline.makeTempFileName()
+            try:
+                with open(tempFileName, "wb") as f:
+                    f.write(job.data)
+
+                callAssetCc2([self.assetCc2Path, "--strip", "--rules4101", tempFileName, job.outputFileName],
+                             TagConversionPipeline.subprocessOutput)
+
+            finally:
+                os.remove(tempFileName)
+
+        else:
+            with open(job.outputFileName, "wb") as f:
+                f.write(job.data)
+
+    def readStage(self, jobs, queue):
+        for job in jobs:
+            # Wait for budget before reading, so no input is held while
+            # waiting. The file size stands in for the data read from it.
+            try:
+                job.size = os.path.getsize(job.inputFileName)
+            except OSError:
+                job.size = 0
+
+            self.budget.acquire(job.size)
+
+            try:
+                self.readJob(job)
+
+            except Exception as e:
+                job.error = e
+                job.data = None
+
+            queue.put(job)
+
+        queue.put(None)
+
+    def convertStage(self, inQueue, outQueue, pool):
+        pending = collections.deque()
+
+        while True:
+            # Finish a job rather than wait for the next one: the reader may
+            # be waiting for budget that only written jobs give back.
+            if pending and inQueue.empty():
+                self.finishJob(pending.popleft(), outQueue)
+                continue
+
+            job = inQueue.get()
+            if job == None:
+                break
+
+            if job.error == None and pool != None:
+                pending.append((job, pool.apply_async(convertDataJob, (job.inputFileType, job.data,
+                                                                       job.compendiumFileName, self.writerOptions,
+                                                                       self.native))))
+                job.data = None
+
+            else:
+                pending.append((job, None))
+
+            # Keep at most a few results per worker outstanding.
+            while len(pending) > self.processes * 2:
+                self.finishJob(pending.popleft(), outQueue)
+
+        while pending:
+            self.finishJob(pending.popleft(), outQueue)
+
+        outQueue.put(None)
+
+    def finishJob(self, pendingJob, outQueue):
+        job, result = pendingJob
+
+        if job.error == None:
+            try:
+                if result != None:
+                    job.data = result.get()
+                else:
+                    job.data = TagConversionPipeline.convertData(job.inputFileType, job.data, job.compendiumFileName,
+                                                                 self.writerOptions, self.native)
+
+            except Exception as e:
+                job.error = e
+                job.data = None
+
+        outQueue.put(job)
+
+    def writeStage(self, queue, finished):
+        while True:
+            job = queue.get()
+            if job == None:
+                break
+
+            if job.error == None:
+                try:
+                    self.writeJob(job)
+
+                except Exception as e:
+                    job.error = e
+
+            job.data = None
+            self.budget.release(job.size)
+            finished.append(job)
+
+            if job.error == None:
+                print "converted {} -> {}".format(job.inputFileName, job.outputFileName)
+            else:
+                print "failed {}: {}".format(job.inputFileName, job.error)
+
+    def run(self, jobs):
+        readQueue = Queue.Queue(self.queueSize)
+        writeQueue = Queue.Queue(self.queueSize)
+        finished = []
+
+        pool = None
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+
+        threads = [
+            threading.Thread(target=self.readStage, args=(jobs, readQueue)),
+            threading.Thread(target=self.writeStage, args=(writeQueue, finished))]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            self.convertStage(readQueue, writeQueue, pool)
+
+            for thread in threads:
+                thread.join()
+
+        finally:
+            if pool != None:
+                pool.close()
+                pool.join()
+
+        return finished
+
+
+def convertDataJob(inputFileType, data, compendiumFileName, writerOptions, native):
+    return TagConversionPipeline.convertData(inputFileType, data, compendiumFileName, writerOptions, native)
+
+
+class TagConversionServer(object):
+    """Stays resident and converts files on request.
+
+    Requests and responses are JSON objects, one per line, read from stdin
+    or from connections to a Unix socket. A request is either
+    {"id": ..., "args": [source, compendium, destination], "options": {...}}
+    with the same arguments and options (see forwardedOptions) as the
+    command line, or {"command": "ping"} or {"command": "shutdown"}. The
+    type database, compendium readers and their decode plans stay loaded
+    between jobs.
+    """
+
+    # Command line options that --connect hands to the server.
+    forwardedOptions = ["cache", "cache-size", "compact-layout", "dedupe", "native", "reference-compendium"]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = True
+
+    def handle(self, request):
+        if not isinstance(request, dict):
+            return {"status": "error", "error": "Requests must be JSON objects"}
+
+        response = {"id": request.get("id")}
+        command = request.get("command", "convert")
+
+        if command == "ping":
+            response["status"] = "ok"
+
+        elif command == "shutdown":
+            self.running = False
+            response["status"] = "ok"
+
+        elif command == "convert":
+            try:
+                options = request.get("options") or {}
+                if not isinstance(options, dict):
+                    raise ValueError("Options must be a JSON object")
+
+                inputFileName, inputFileType, compendiumFileName, outputFileName = resolveArguments(request["args"])
+                job = TagConversionJob(inputFileName, inputFileType, compendiumFileName, outputFileName)
+                writerOptions = getWriterOptions(options)
+                native = options.has_key("native")
+                pipeline = TagConversionPipeline(1, writerOptions=writerOptions, native=native)
+                timings = {}
+
+                with self.lock:
+                    cache = None
+                    if options.has_key("cache"):
+                        cache = TagConversionCache.fromOptions(options)
+                        key = TagConversionCache.makeConversionKey(inputFileName, compendiumFileName, writerOptions,
+                                                                   native)
+
+                    if cache != None and cache.fetch(key, outputFileName):
+                        response["cached"] = True
+
+                    else:
+                        start = time.time()
+                        pipeline.readJob(job)
+                        timings["read"] = time.time() - start
+
+                        start = time.time()
+                        job.data = TagConversionPipeline.convertData(job.inputFileType, job.data,
+                                                                     job.compendiumFileName, writerOptions, native)
+                        timings["convert"] = time.time() - start
+
+                        start = time.time()
+                        pipeline.writeJob(job)
+                        timings["write"] = time.time() - start
+
+                        if cache != None:
+                            cache.store(key, outputFileName)
+
+                response["status"] = "ok"
+                response["output"] = outputFileName
+                response["timings"] = timings
+
+            except Exception as e:
+                response["status"] = "error"
+                response["error"] = str(e)
+
+        else:
+            response["status"] = "error"
+            response["error"] = "Unknown command {}".format(command)
+
+        return response
+
+    def serveStream(self, inputFile, outputFile):
+        for line in iter(inputFile.readline, ""):
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"status": "error", "error": str(e)}
+            else:
+                response = self.handle(request)
+
+            outputFile.write(json.dumps(response) + "\n")
+            outputFile.flush()
+
+            if not self.running:
+                break
+
+    def serveConnection(self, connection):
+        try:
+            self.serveStream(connection.makefile("rb"), connection.makefile("wb"))
+        finally:
+            connection.close()
+
+    def serveSocket(self, path):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("Unix sockets are not available, use --serve without a path instead")
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+        s.listen(8)
+        s.settimeout(0.5)
+
+        try:
+            while self.running:
+                try:
+                    connection, address = s.accept()
+                except socket.timeout:
+                    continue
+
+                connection.settimeout(None)
+                thread = threading.Thread(target=self.serveConnection, args=(connection,))
+                thread.daemon = True
+                thread.start()
+
+        finally:
+            s.close()
+            os.remove(path)
+
+    @staticmethod
+    def request(path, request):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+
+        try:
+            s.sendall(json.dumps(request) + "\n")
+            return json.loads(s.makefile("rb").readline())
+        finally:
+            s.close()
+
+
+if __name__ == "__main__":
+    import sys
+    multiprocessing.freeze_support()
+    options = {}
+    args = []
+
+    for arg in sys.argv[1:]:
+        if arg.startswith("--"):
+            name, sep, value = arg[2:].partition("=")
+            options[name] = value
+        else:
+            args.append(arg)
+
+    writerOptions = getWriterOptions(options)
+
+    if options.has_key("snapshots"):
+        TagReader.snapshots = TagGraphSnapshots(
+            options["snapshots"] or os.path.join(os.path.dirname(sys.argv[0]), "snapshots"),
+            int(options.get("cache-size") or 512) * 1024 * 1024)
+
+    fileNames = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for root, dirs, files in os.walk(arg):
+                fileNames.extend(os.path.join(root, x) for x in sorted(files) if x.lower().endswith(".hkx"))
+        else:
+            fileNames.append(arg)
+
+    if options.has_key("scan"):
+        print "\t".join(["file", "signature", "version", "items", "patches", "types", "data", "compendium"])
+
+        for fileName in fileNames:
+            try:
+                summary = TagFileScanner.scanFile(fileName, options["scan"] == "types")
+            except (ValueError, struct.error, IndexError, IOError) as e:
+                print "\t".join([fileName, "error", " ".join(str(e).split())])
+                continue
+
+            print "\t".join([
+                fileName,
+                summary.sections[0][0],
+                summary.version or "-",
+                str(summary.itemCount),
+                str(summary.patchCount),
+                str(summary.typeCount) if not summary.usesCompendium else "-",
+                str(summary.dataSize),
+                ",".join(x.encode("hex") for x in summary.compendiumIds) or "-"])
+
+            if summary.typeNames != None:
+                print "\t" + " ".join(summary.typeNames)
+
+    elif options.has_key("report"):
+        compendium = None
+        reports = []
+
+        for fileName in fileNames:
+            typ = TagReader.checkFile(fileName)
+            if typ == TagFileType.Compendium:
+                compendium = TagReader(open(fileName, "rb"))
+            elif typ == TagFileType.Object:
+                reports.append(fileName)
+
+        column = options.get("sort") or "bytes"
+        if not column in TagTypeReport.columns:
+            print "Unknown column {}, expected one of {}".format(column, ", ".join(TagTypeReport.columns))
+            sys.exit(1)
+
+        reports = [TagTypeReport.fromFile(x, compendium) for x in reports]
+
+        if options["report"] == "json":
+            json.dump([{"file": x.fileName, "size": x.fileSize, "types": x.sortedRows(column)} for x in reports],
+                      sys.stdout, indent=2, sort_keys=True)
+            print
+
+        else:
+            writer = csv.writer(sys.stdout, lineterminator="\n")
+            writer.writerow(["file"] + TagTypeReport.columns)
+
+            for report in reports:
+                for row in report.sortedRows(column):
+                    writer.writerow([report.fileName] + [row[x] for x in TagTypeReport.columns])
+
+    elif options.has_key("diff") and len(args) > 0:
+        compendiumFileName = None
+        inputFileNames = []
+
+        for fileName in fileNames:
+            if TagReader.checkFile(fileName) == TagFileType.Compendium:
+                compendiumFileName = fileName
+            else:
+                inputFileNames.append(fileName)
+
+        if len(inputFileNames) != 2:
+            print "--diff takes two tag files"
+            sys.exit(2)
+
+        differences = TagGraphDiff.diffFiles(inputFileNames[0], inputFileNames[1], compendiumFileName)
+
+        for kind, path, old, new in differences:
+            if kind == "changed":
+                print "changed {}: {} -> {}".format(path, old, new)
+            else:
+                print "{} {}: {}".format(kind, path, old or new)
+
+        sys.exit(1 if differences else 0)
+
+    elif options.has_key("patch") and len(args) > 0:
+        patches = TagScalarPatcher.loadPatches(options["patch"])
+        compendium = None
+        inputFileNames = []
+
+        for fileName in fileNames:
+            try:
+                typ = TagReader.checkFile(fileName)
+            except IOError as e:
+                print "failed {}: {}".format(fileName, e)
+                continue
+
+            if typ == TagFileType.Compendium:
+                compendium = TagReader(open(fileName, "rb"))
+            elif typ == TagFileType.Object:
+                inputFileNames.append(fileName)
+
+        for fileName in inputFileNames:
+            try:
+                print "patched {} values in {}".format(TagScalarPatcher.patchFile(fileName, patches, compendium), fileName)
+            except (ValueError, struct.error, IndexError, IOError) as e:
+                print "failed {}: {}".format(fileName, e)
+
+    elif options.has_key("make-compendium") and len(args) > 0:
+        builder = TagCompendiumBuilder()
+
+        for fileName in fileNames:
+            if TagReader.checkFile(fileName) != TagFileType.Object or TagFileScanner.scanFile(fileName).usesCompendium:
+                continue
+
+            with TagReader(open(fileName, "rb")) as r:
+                if not builder.add(r, fileName):
+                    print "skipped {}: conflicting types".format(fileName)
+
+        compendiumFileName = options["make-compendium"] or "compendium.hkx"
+        builder.toFile(compendiumFileName)
+        print "{} types from {} files written to {}".format(
+            len(builder.w.types) - 1, len(builder.fileNames), compendiumFileName)
+
+        if options.has_key("rewrite"):
+            with TagReader(open(compendiumFileName, "rb")) as compendium:
+                for fileName in builder.fileNames:
+                    TagCompendiumBuilder.rewriteFile(fileName, compendium)
+                    print "rewrote {}".format(fileName)
+
+    elif options.has_key("batch") and len(args) > 0:
+        compendiumFileName = None
+        jobs = []
+
+        for fileName in fileNames:
+            typ = TagReader.checkFile(fileName)
+            if typ == TagFileType.Compendium:
+                compendiumFileName = fileName
+            else:
+                outputFileName = os.path.splitext(fileName)[0] + ".hkx"
+                if options["batch"]:
+                    outputFileName = os.path.join(options["batch"], os.path.basename(outputFileName))
+
+                jobs.append(TagConversionJob(fileName, typ, None, outputFileName))
+
+        for job in jobs:
+            job.compendiumFileName = compendiumFileName
+
+        if options["batch"] and not os.path.exists(options["batch"]):
+            os.makedirs(options["batch"])
+
+        pipeline = TagConversionPipeline(
+            int(options.get("processes") or 0),
+            int(options.get("batch-memory") or 256) * 1024 * 1024,
+            writerOptions=writerOptions,
+            native=options.has_key("native"))
+
+        finished = pipeline.run(jobs)
+        print "{} of {} files converted".format(len([x for x in finished if x.error == None]), len(finished))
+
+    elif options.has_key("serve"):
+        server = TagConversionServer()
+
+        if options["serve"]:
+            server.serveSocket(options["serve"])
+
+        else:
+            # Responses own stdout, anything else printed goes to stderr.
+            output = sys.stdout
+            sys.stdout = sys.stderr
+            TagConversionPipeline.subprocessOutput = sys.stderr
+            server.serveStream(sys.stdin, output)
+
+    elif len(args) <= 0:
+        print "Tool for converting HKX (version <= 2012 2.0) files to 2016 1.0 tag binary files, and vice versa."
+        print "\nUsage: {} [options] [source] [compendium] [destination]".format(os.path.basename(sys.argv[0]))
+        print "Compendium file is needed for files that contain no type info."
+        print "If no destination is included, the changes will be overwritten to the source."
+        print "You can do a simple drag and drop that way."
+        print "\nOptions:"
+        print "  --batch[=directory]   Convert every given file or directory, overlapping disk and CPU work."
+        print "  --batch-memory=MB     Maximum size of batch inputs held in memory at once."
+        print "  --cache[=directory]   Reuse outputs of previous conversions of identical inputs."
+        print "  --cache-size=MB       Maximum size of the cache before old entries are evicted."
+        print "  --compact-layout      Order items in written tag files to waste less space on padding."
+        print "  --connect=socket      Hand the conversion to a server started with --serve=socket."
+        print "  --dedupe              Write equal strings and number arrays of tag files once, sharing one item."
+        print "  --diff                Compare two tag files and list the values added, removed or changed."
+        print "  --graph               Write a tag file's objects to a graph file, which converts back without AssetCc2."
+        print "  --make-compendium[=file] Collect the types of the given tag files into a compendium."
+        print "  --report[=csv|json]   List item counts, DATA bytes and padding per type of the given tag files."
+        print "  --sort=column         With --report, sort by type, items, elements, bytes, padding, patches or share."
+        print "  --rewrite             With --make-compendium, make the files reference the compendium."
+        print "  --native              Experimental: read and write packfiles directly instead of through AssetCc2."
+        print "  --patch=file          Set the bools, ints and floats listed in file (path = value lines) in place."
+        print "  --processes[=count]   Decode tag files with worker processes (default: one per CPU)."
+        print "  --reference-compendium Make written tag files reference the given compendium instead of embedding types."
+        print "  --scan[=types]        Summarize the sections of the given files or directories without converting."
+        print "  --serve[=socket]      Stay resident and convert JSON-lines requests from stdin or a Unix socket."
+        print "  --snapshots[=directory] Keep decoded tag files as snapshots that load faster the next time."
+        print "\nMade by Skyth."
+        print "Press enter to continue..."
+        raw_input()
+
+    elif options.has_key("connect"):
+        # The server may run in another directory.
+        requestOptions = {x: options[x] for x in TagConversionServer.forwardedOptions if options.has_key(x)}
+        if requestOptions.get("cache"):
+            requestOptions["cache"] = os.path.abspath(requestOptions["cache"])
+
+        response = TagConversionServer.request(options["connect"], {
+            "args": [os.path.abspath(x) for x in args], "options": requestOptions})
+
+        if response["status"] == "ok" and response.get("cached"):
+            print "up to date {}".format(response["output"])
+
+        elif response["status"] == "ok":
+            print "converted {} ({})".format(response["output"], ", ".join(
+                "{} {:.3f}s".format(name, response["timings"][name]) for name in ("read", "convert", "write")))
+        else:
+            print "failed: {}".format(response["error"])
+            sys.exit(1)
+
+    else:
+        inputFileName, inputFileType, compendiumFileName, outputFileName = resolveArguments(
+            args, ".graph" if options.has_key("graph") else ".hkx")
+
+        processes = None
+        if options.has_key("processes"):
+            processes = int(options["processes"] or 0)
+
+        if options.has_key("cache"):
+            cache = TagConversionCache.fromOptions(options)
+            key = TagConversionCache.makeConversionKey(inputFileName, compendiumFileName, writerOptions,
+                                                       options.has_key("native"), options.has_key("graph"))
+
+            if cache.fetch(key, outputFileName):
+                print("up to date", outputFileName)
+
+            else:
+                convertFile(inputFileName, inputFileType, compendiumFileName, outputFileName, processes, writerOptions,
+                            options.has_key("native"), options.has_key("graph"))
+                cache.store(key, outputFileName)
+
+        else:
+            convertFile(inputFileName, inputFileType, compendiumFileName, outputFileName, processes, writerOptions,
+                        options.has_key("native"), options.has_key("graph"))
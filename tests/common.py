@@ -0,0 +1,186 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from TagTools import *
+
+types = None
+
+
+def loadTypes():
+    global types
+    if types == None:
+        types = TagTypeHelper.loadTypes(os.path.join(root, "TypeDatabase.xml"))
+
+    return types
+
+
+def getType(name):
+    for typ in loadTypes():
+        if typ.name == name:
+            return typ
+
+
+def getMemberType(typ, name):
+    for member in typ.superType.allMembers:
+        if member.name == name:
+            return member.typ
+
+
+def makeVector(typ, values):
+    floatType = getType("float")
+    return TagObject([TagObject(float(x), floatType) for x in values], typ)
+
+
+def makeSkeleton(name, boneCount):
+    skeletonType = getType("hkaSkeleton")
+    boneType = getType("hkaBone")
+    transformType = getType("hkQsTransformf")
+    parentIndicesType = getMemberType(skeletonType, "parentIndices")
+
+    bones = []
+    poses = []
+    for x in xrange(boneCount):
+        bones.append(TagObject({
+            "name": TagObject("bone{}".format(x), getMemberType(boneType, "name")),
+            "lockTranslation": TagObject(x % 2 == 0, getMemberType(boneType, "lockTranslation"))}, boneType))
+
+        poses.append(TagObject({
+            "translation": makeVector(getMemberType(transformType, "translation"), [x, 1, 2, 0]),
+            "rotation": makeVector(getMemberType(transformType, "rotation"), [0, 0, 0, 1]),
+            "scale": makeVector(getMemberType(transformType, "scale"), [1, 1, 1, 0])}, transformType))
+
+    return TagObject({
+        "name": TagObject(name, getMemberType(skeletonType, "name")),
+        "parentIndices": TagObject([TagObject(x - 1, parentIndicesType.superType.mSubType) for x in xrange(boneCount)],
+                                   parentIndicesType),
+        "bones": TagObject(bones, getMemberType(skeletonType, "bones")),
+        "referencePose": TagObject(poses, getMemberType(skeletonType, "referencePose"))}, skeletonType)
+
+
+def makeContainer(skeletons):
+    containerType = getType("hkRootLevelContainer")
+    variantsType = getMemberType(containerType, "namedVariants")
+    variantType = variantsType.superType.mSubType
+
+    variants = [TagObject({
+        "name": TagObject(skeleton.value["name"].value, getMemberType(variantType, "name")),
+        "className": TagObject("hkaSkeleton", getMemberType(variantType, "className")),
+        "variant": TagObject(skeleton, getMemberType(variantType, "variant"))}, variantType)
+        for skeleton in skeletons]
+
+    return TagObject({"namedVariants": TagObject(variants, variantsType)}, containerType)
+
+
+def makeGraph(skeletonCount=3, boneCount=20):
+    return makeContainer([makeSkeleton("skeleton {}".format(x), boneCount + x) for x in xrange(skeletonCount)])
+
+
+def makeSharedSkeleton():
+    """A container whose two variants point at one skeleton, which is one
+    object and not a copy."""
+    container = makeContainer([makeSkeleton("a", 4)] * 2)
+    variants = container.value["namedVariants"].value
+    variants[1].value["variant"] = variants[0].value["variant"]
+    return container
+
+
+def makeList(length):
+    """A linked list of length nodes, the first holding length - 1."""
+    intType = getType("int")
+
+    nodeType = TagType("Node")
+    nodeType.flags = TagFlag.SubType | TagFlag.ByteSize | TagFlag.Members
+    nodeType.mFormatInfo = TagSubType.Class
+    nodeType.byteSize = 8
+    nodeType.alignment = 4
+
+    pointerType = TagType("T*")
+    pointerType.flags = TagFlag.SubType | TagFlag.Pointer | TagFlag.ByteSize
+    pointerType.mFormatInfo = TagSubType.Pointer
+    pointerType.mSubType = nodeType
+    pointerType.byteSize = 4
+    pointerType.alignment = 4
+
+    for name, offset, typ in (("value", 0, intType), ("next", 4, pointerType)):
+        member = TagMember()
+        member.name = name
+        member.byteOffset = offset
+        member.typ = typ
+        nodeType.members.append(member)
+
+    obj = None
+    for x in xrange(length):
+        obj = TagObject({"value": TagObject(x, intType), "next": TagObject(obj, pointerType)}, nodeType)
+
+    return obj
+
+
+def getFloats(obj):
+    """Floats of an object made of floats only, in member order."""
+    typ = obj.typ.superType
+
+    if typ.subType == TagSubType.Float:
+        return [obj.value]
+
+    elif typ.subType == TagSubType.Class:
+        return [x for member in typ.allMembers for x in getFloats(obj.value[member.name])]
+
+    return [x for element in obj.value for x in getFloats(element)]
+
+
+def dumpObject(obj, seen=None):
+    """Canonical text of a graph; empty or false members and shared objects
+    aside, equal graphs give equal text."""
+    if obj == None:
+        return "None"
+
+    if seen == None:
+        seen = set()
+
+    typ = obj.typ.superType
+    value = obj.value
+
+    if typ.subType == TagSubType.Class:
+        return "{" + ",".join("{}:{}".format(name, dumpObject(value[name], seen)) for name in sorted(value)
+                              if value[name] != None and value[name].value != None and value[name].value is not False
+                              and not (hasattr(value[name].value, "__len__") and len(value[name].value) == 0)) + "}"
+
+    elif typ.subType == TagSubType.Pointer:
+        if value == None:
+            return "null"
+
+        if id(value) in seen:
+            return "@"
+
+        seen.add(id(value))
+        return "*" + dumpObject(value, seen)
+
+    elif typ.subType & 0xF == TagSubType.Array:
+        if TagXmlSerializer.getVectorTag(typ.mSubType.superType) != None:
+            # The XML parser keeps arrays of vectors as flat floats.
+            floats = value if TagArrayBlock.isArrayBacked(value) else getFloats(obj)
+            return "[" + ",".join("{:.4f}".format(x) for x in floats) + "]"
+
+        return "[" + ",".join(dumpObject(x, seen) for x in value) + "]"
+
+    elif typ.subType == TagSubType.Float:
+        return "{:.4f}".format(value)
+
+    return repr(value)
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
@@ -0,0 +1,52 @@
+import gc
+import unittest
+
+from common import *
+
+
+@unittest.skipIf(numpy == None, "NumPy is not installed")
+class TestArrayView(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        self.fileName = self.path("graph.hkx")
+        TagWriter.toFile(self.fileName, makeGraph())
+
+    def getPoseIndex(self, r):
+        return r.itemIndices[r.getType("hkQsTransform")][0]
+
+    def testArraysOutliveTheReader(self):
+        r = TagReader(open(self.fileName, "rb"))
+        index = self.getPoseIndex(r)
+        copy = TagArrayView.getItemArray(r, index)
+        view = TagArrayView.getItemArray(r, index, view=True)
+
+        r.close()
+        del r
+        gc.collect()
+
+        self.assertTrue(copy.flags.writeable)
+        self.assertFalse(view.flags.writeable)
+        self.assertEqual(copy["translation"][3].tolist(), [3, 1, 2, 0])
+        self.assertEqual(view["translation"][3].tolist(), [3, 1, 2, 0])
+
+    def readArrays(self, typeName):
+        with TagReader(open(self.fileName, "rb")) as r:
+            typ = r.getType(typeName)
+            return typ, [TagArrayView.getItemArray(r, x) for x in r.itemIndices[typ]]
+
+    def testPointerFreeArraysWriteBack(self):
+        typ, arrays = self.readArrays("hkQsTransform")
+        self.assertEqual(TagArrayBlock(typ, arrays[0]).data, arrays[0].tobytes())
+
+    def testItemIndicesAreRefused(self):
+        typ, arrays = self.readArrays("hkaBone")
+
+        with self.assertRaises(ValueError) as context:
+            TagArrayBlock(typ, arrays[0])
+
+        self.assertTrue("hkaBone.name" in str(context.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import time
+import unittest
+
+from common import *
+
+
+class TestConversionCache(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        self.inputFileName = self.path("graph.hkx")
+        TagWriter.toFile(self.inputFileName, makeGraph(1, 4))
+
+    def writeFile(self, name, size):
+        fileName = self.path(name)
+        with open(fileName, "wb") as f:
+            f.write("x" * size)
+
+        return fileName
+
+    def testHitAndMiss(self):
+        cache = TagConversionCache(self.path("cache"))
+        key = TagConversionCache.makeConversionKey(self.inputFileName, None)
+
+        outputFileName = self.path("output.xml")
+        self.assertFalse(cache.fetch(key, outputFileName))
+
+        cache.store(key, self.writeFile("converted.xml", 10))
+        self.assertTrue(cache.fetch(key, outputFileName))
+        with open(outputFileName, "rb") as f:
+            self.assertEqual(f.read(), "x" * 10)
+
+        self.assertEqual(TagConversionCache.makeConversionKey(self.inputFileName, None), key)
+        self.assertNotEqual(TagConversionCache.makeConversionKey(self.inputFileName, None, {"compactLayout": True}), key)
+        self.assertNotEqual(TagConversionCache.makeConversionKey(self.inputFileName, None, graph=True), key)
+
+        TagWriter.toFile(self.inputFileName, makeGraph(1, 5))
+        changedKey = TagConversionCache.makeConversionKey(self.inputFileName, None)
+        self.assertNotEqual(changedKey, key)
+        self.assertFalse(cache.fetch(changedKey, outputFileName))
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = TagConversionCache(self.path("cache"), maxCount=2)
+        cache.store("a", self.writeFile("a", 10))
+        cache.store("b", self.writeFile("b", 10))
+
+        now = time.time()
+        os.utime(cache.getPath("a"), (now - 20, now - 20))
+        os.utime(cache.getPath("b"), (now - 10, now - 10))
+        self.assertTrue(cache.fetch("a", self.path("output")))
+
+        cache.store("c", self.writeFile("c", 10))
+        self.assertEqual(sorted(os.listdir(cache.directory)), ["a", "c"])
+
+    def testEvictsBySize(self):
+        cache = TagConversionCache(self.path("cache"), maxSize=25)
+        cache.store("a", self.writeFile("a", 10))
+        os.utime(cache.getPath("a"), (time.time() - 10, time.time() - 10))
+        cache.store("b", self.writeFile("b", 10))
+        self.assertEqual(sorted(os.listdir(cache.directory)), ["a", "b"])
+
+        cache.store("c", self.writeFile("c", 10))
+        self.assertEqual(sorted(os.listdir(cache.directory)), ["b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import StringIO
+import unittest
+
+from common import *
+
+
+class TestCompendiumReference(TempDirTestCase):
+    def makeCompendium(self, fileNames):
+        builder = TagCompendiumBuilder()
+        for fileName in fileNames:
+            with TagReader(open(fileName, "rb")) as r:
+                builder.add(r, fileName)
+
+        compendiumFileName = self.path("compendium.hkx")
+        builder.toFile(compendiumFileName)
+        return compendiumFileName
+
+    def writeFile(self, fileName, compendiumFileName, **options):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            with TagReader(open(compendiumFileName, "rb")) as compendium:
+                TagWriter.toFile(fileName, makeGraph(), compendium, **options)
+
+            return sys.stdout.getvalue()
+
+        finally:
+            sys.stdout = stdout
+
+    def testReferenceIsOptIn(self):
+        typedFileName = self.path("typed.hkx")
+        TagWriter.toFile(typedFileName, makeGraph())
+        compendiumFileName = self.makeCompendium([typedFileName])
+
+        fileName = self.path("output.hkx")
+        self.writeFile(fileName, compendiumFileName)
+        self.assertFalse(TagFileScanner.scanFile(fileName).usesCompendium)
+
+        self.writeFile(fileName, compendiumFileName, referenceCompendium=True)
+        self.assertTrue(TagFileScanner.scanFile(fileName).usesCompendium)
+        self.assertEqual(dumpObject(TagReader.decodeFile(fileName, compendiumFileName)),
+                         dumpObject(TagReader.decodeFile(typedFileName)))
+
+    def testMissingTypesAreWrittenInline(self):
+        compendiumFileName = self.makeCompendium([])
+
+        fileName = self.path("output.hkx")
+        output = self.writeFile(fileName, compendiumFileName, referenceCompendium=True)
+
+        self.assertTrue(output.startswith("WARNING"))
+        self.assertFalse(TagFileScanner.scanFile(fileName).usesCompendium)
+
+        typedFileName = self.path("typed.hkx")
+        TagWriter.toFile(typedFileName, makeGraph())
+        with open(fileName, "rb") as f, open(typedFileName, "rb") as typed:
+            self.assertEqual(f.read(), typed.read())
+
+
+class TestCompendiumBuilder(TempDirTestCase):
+    def getSkeletonHash(self, fileName):
+        with TagReader(open(fileName, "rb")) as r:
+            return r.getType("hkaSkeleton").hsh
+
+    def testHashesFoundLaterLeaveSharedTypesAlone(self):
+        skeletonType = getType("hkaSkeleton")
+        hsh = skeletonType.hsh
+
+        unhashedFileName = self.path("unhashed.hkx")
+        skeletonType.hsh = 0
+        try:
+            TagWriter.toFile(unhashedFileName, makeGraph(1, 4))
+        finally:
+            skeletonType.hsh = hsh
+
+        hashedFileName = self.path("hashed.hkx")
+        TagWriter.toFile(hashedFileName, makeGraph(1, 4))
+
+        builder = TagCompendiumBuilder()
+        for fileName in (unhashedFileName, hashedFileName):
+            with TagReader(open(fileName, "rb")) as r:
+                self.assertTrue(builder.add(r, fileName))
+
+        compendiumFileName = self.path("compendium.hkx")
+        builder.toFile(compendiumFileName)
+
+        self.assertEqual(self.getSkeletonHash(compendiumFileName), hsh)
+        self.assertEqual(self.getSkeletonHash(unhashedFileName), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+from common import *
+
+
+class ShiftedBoneWriter(TagWriter):
+    # Lists the offsets of all bones but the first in PTCH under the bone
+    # type, the way HavocCli files do, so that a reader taking PTCH offsets
+    # reads every bone from its successor.
+    def writeIndexSection(self):
+        for item in self.items[1:]:
+            if item.typ.name == "hkaBone":
+                byteSize = item.typ.superType.byteSize
+                self.patches[item.typ] = [item.offset + x * byteSize for x in xrange(1, len(item.value))]
+
+        TagWriter.writeIndexSection(self)
+
+
+class TestParallelDecode(TempDirTestCase):
+    def testMatchesSerialDecode(self):
+        fileName = self.path("graph.hkx")
+        TagWriter.toFile(fileName, makeGraph())
+
+        expected = dumpObject(TagReader.decodeFile(fileName))
+        for processes in (1, 2):
+            self.assertEqual(dumpObject(TagReader.decodeFile(fileName, None, processes)), expected)
+
+    def testPatchOffsetsFallBackToSerialDecode(self):
+        fileName = self.path("shifted.hkx")
+        with ShiftedBoneWriter(open(fileName, "wb")) as w:
+            w.writeRootSection(makeGraph(1))
+
+        with TagReader(open(fileName, "rb")) as r:
+            self.assertTrue(r.usesPatchOffsets())
+
+        obj = TagReader.decodeFile(fileName)
+        bones = obj.value["namedVariants"].value[0].value["variant"].value.value["bones"].value
+        self.assertEqual(bones[0].value["name"].value, "bone1")
+
+        expected = dumpObject(obj)
+        for processes in (1, 2):
+            self.assertEqual(dumpObject(TagReader.decodeFile(fileName, None, processes)), expected)
+
+    def testPatchOffsetsAcrossGetObjectCalls(self):
+        fileName = self.path("shifted.hkx")
+        with ShiftedBoneWriter(open(fileName, "wb")) as w:
+            w.writeRootSection(makeGraph(2))
+
+        expected = dumpObject(TagReader.decodeFile(fileName))
+
+        # Each skeleton read on its own takes the next PTCH offsets, as in
+        # a decode from the root.
+        with TagReader(open(fileName, "rb")) as r:
+            for index in r.itemIndices[r.getType("hkaSkeleton")]:
+                r.getObject(index - 1)
+
+            self.assertEqual(dumpObject(r.getObject(0)), expected)
+
+    def testPatchOffsetsRefusePartialReads(self):
+        fileName = self.path("shifted.hkx")
+        with ShiftedBoneWriter(open(fileName, "wb")) as w:
+            w.writeRootSection(makeGraph(1))
+
+        with TagReader(open(fileName, "rb")) as r:
+            boneIndex = r.itemIndices[r.getType("hkaBone")][0]
+
+            self.assertRaises(ValueError, r.readItem, boneIndex, depth=5)
+            self.assertRaises(ValueError, r.readItem, boneIndex, 1)
+            self.assertRaises(ValueError, r.readItems, [boneIndex])
+            self.assertEqual(r.readItem(boneIndex)[0].value["name"].value, "bone1")
+
+        self.assertRaises(ValueError, TagFileEditor, fileName)
+
+        with open(fileName, "rb") as f:
+            data = f.read()
+
+        self.assertRaises(ValueError, TagScalarPatcher.patchFile, fileName, [("hkaBone.lockTranslation", "0")])
+        with open(fileName, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
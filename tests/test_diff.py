@@ -0,0 +1,67 @@
+import unittest
+
+from common import *
+
+bonesPath = "hkRootLevelContainer.namedVariants[0].variant.bones"
+
+
+def getBones(container, index=0):
+    return container.value["namedVariants"].value[index].value["variant"].value.value["bones"].value
+
+
+def makeBone(name):
+    boneType = getType("hkaBone")
+    return TagObject({"name": TagObject(name, getMemberType(boneType, "name"))}, boneType)
+
+
+def diffGraphs(old, new):
+    return sorted(TagGraphDiff().diff(old, new))
+
+
+class TestGraphDiff(unittest.TestCase):
+    def testEqualGraphs(self):
+        self.assertEqual(diffGraphs(makeGraph(1, 4), makeGraph(1, 4)), [])
+
+    def testInsertionAndFlag(self):
+        new = makeGraph(1, 4)
+        getBones(new).insert(2, makeBone("inserted"))
+        getBones(new)[0].value["lockTranslation"].value = False
+
+        self.assertEqual(diffGraphs(makeGraph(1, 4), new), [
+            ("added", bonesPath + "[2]", None, "<hkaBone>"),
+            ("changed", bonesPath + "[0].lockTranslation", "True", "False")])
+
+    def testRemoval(self):
+        new = makeGraph(1, 4)
+        del getBones(new)[1]
+
+        self.assertEqual(diffGraphs(makeGraph(1, 4), new), [("removed", bonesPath + "[1]", "<hkaBone>", None)])
+
+    def testScalarChange(self):
+        new = makeGraph(1, 4)
+        getBones(new)[3].value["name"].value = "renamed"
+
+        self.assertEqual(diffGraphs(makeGraph(1, 4), new),
+                         [("changed", bonesPath + "[3].name", "'bone3'", "'renamed'")])
+
+    def testSharedPointers(self):
+        # The skeleton both variants point at is compared once.
+        new = makeSharedSkeleton()
+        getBones(new, 1)[2].value["name"].value = "renamed"
+
+        self.assertEqual(diffGraphs(makeSharedSkeleton(), new),
+                         [("changed", bonesPath + "[2].name", "'bone2'", "'renamed'")])
+
+    def testCycles(self):
+        old = makeList(3)
+        new = makeList(3)
+        for obj in (old, new):
+            obj.value["next"].value.value["next"].value.value["next"].value = obj
+
+        new.value["next"].value.value["value"].value = 5
+
+        self.assertEqual(diffGraphs(old, new), [("changed", "Node.next.value", "1", "5")])
+
+
+if __name__ == "__main__":
+    unittest.main()
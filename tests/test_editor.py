@@ -0,0 +1,82 @@
+import unittest
+
+from common import *
+
+
+class TestSharedItems(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        # Both skeletons have the same pose, which dedupe writes once.
+        self.fileName = self.path("graph.hkx")
+        TagWriter.toFile(self.fileName, makeContainer([makeSkeleton("a", 4), makeSkeleton("b", 4)]), None, dedupe=True)
+
+    def getSkeleton(self, editor, index):
+        variants = editor.getItem(editor.getObject().value["namedVariants"].value)
+        return editor.getItem(variants[index].value["variant"].value)[0]
+
+    def testEditorRefusesSharedItems(self):
+        fileName = self.path("output.hkx")
+
+        with TagFileEditor(self.fileName) as editor:
+            poses = editor.getItem(self.getSkeleton(editor, 0).value["referencePose"].value)
+            poses[0].value["translation"].value[0].value = 5.0
+
+            with self.assertRaises(ValueError):
+                editor.save(fileName)
+
+        self.assertFalse(os.path.exists(fileName))
+
+    def testEditorSplitsSharedArrays(self):
+        fileName = self.path("output.hkx")
+
+        with TagFileEditor(self.fileName) as editor:
+            pose = self.getSkeleton(editor, 0).value["referencePose"]
+            poses = editor.r.readItem(pose.value.index, depth=0)
+            poses[0].value["translation"].value[0].value = 5.0
+            pose.value = poses
+
+            editor.save(fileName)
+
+        root = TagReader.decodeFile(fileName)
+        first, second = [x.value["variant"].value.value["referencePose"].value[0] for x in root.value["namedVariants"].value]
+        self.assertEqual(first.value["translation"].value[0].value, 5.0)
+        self.assertEqual(second.value["translation"].value[0].value, 0.0)
+
+    def testEditorChangesSharedObjects(self):
+        TagWriter.toFile(self.fileName, makeSharedSkeleton())
+
+        with TagFileEditor(self.fileName) as editor:
+            self.getSkeleton(editor, 0).value["name"].value = "renamed"
+            editor.save()
+
+        root = TagReader.decodeFile(self.fileName)
+        first, second = [x.value["variant"].value for x in root.value["namedVariants"].value]
+        self.assertTrue(first is second)
+        self.assertEqual(first.value["name"].value, "renamed")
+
+    def testPatcherRefusesSharedItems(self):
+        with open(self.fileName, "rb") as f:
+            data = f.read()
+
+        with self.assertRaises(ValueError):
+            TagScalarPatcher.patchFile(self.fileName, [("hkaSkeleton.referencePose[0].translation[0]", "5")])
+
+        with open(self.fileName, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+        self.assertEqual(TagScalarPatcher.patchFile(self.fileName, [("hkaSkeleton.bones[1].lockTranslation", "1")]), 1)
+
+    def testPatcherFollowsSharedPointers(self):
+        TagWriter.toFile(self.fileName, makeSharedSkeleton())
+
+        path = "hkRootLevelContainer.namedVariants[1].variant.bones[1].lockTranslation"
+        self.assertEqual(TagScalarPatcher.patchFile(self.fileName, [(path, "1")]), 1)
+
+        root = TagReader.decodeFile(self.fileName)
+        bones = root.value["namedVariants"].value[0].value["variant"].value.value["bones"].value
+        self.assertTrue(bones[1].value["lockTranslation"].value)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import glob
+import struct
+import unittest
+
+from common import *
+
+# Reference files made by AssetCc2 aren't shipped. To check against them,
+# put pairs of <name>.xml ("AssetCc2 -g -x" output of an asset) and
+# <name>.hkx ("AssetCc2 --strip --rules4101" output of that XML, a 2012.2
+# packfile) in this directory.
+fixtureDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "packfiles")
+fixtureNames = sorted(os.path.splitext(x)[0] for x in glob.glob(os.path.join(fixtureDirectory, "*.xml"))
+                      if os.path.exists(os.path.splitext(x)[0] + ".hkx"))
+
+signatures = {"hkaSkeleton": 0x12345678}
+
+
+def readSignatures(fileName):
+    """Class signatures listed in the classnames section of a packfile."""
+    with TagPackfileReader(open(fileName, "rb"), loadTypes()) as r:
+        for tag, start, localOffset, globalOffset, virtualOffset, exportsOffset in r.sections:
+            if tag == "__classnames__":
+                break
+
+        result = {}
+        offset = start
+        while offset + 5 < start + localOffset:
+            signature, = struct.unpack_from("<I", r.data, offset)
+            if signature == 0xFFFFFFFF:
+                break
+
+            name = r.readString(offset + 5)
+            result[name] = signature
+            offset += len(name) + 6
+
+        return result
+
+
+class TestPackfileWriter(TempDirTestCase):
+    def testRoundTrip(self):
+        fileName = self.path("graph.hkx")
+        graph = makeGraph()
+        TagPackfileWriter.toFile(fileName, graph, signatures)
+
+        self.assertEqual(readSignatures(fileName)["hkaSkeleton"], signatures["hkaSkeleton"])
+
+        self.assertEqual(dumpObject(TagPackfileReader.fromFile(fileName, loadTypes())), dumpObject(graph))
+
+    def testMissingSignatures(self):
+        fileName = self.path("graph.hkx")
+
+        with self.assertRaises(ValueError) as context:
+            TagPackfileWriter.toFile(fileName, makeGraph(), {"unused": 0})
+
+        self.assertTrue("hkaSkeleton" in str(context.exception))
+        self.assertFalse(os.path.exists(fileName))
+
+    def testLayoutAfterRemovedMembers(self):
+        # A version of ElementDecl without pointers, whose last member the
+        # backporter takes out.
+        declType = TagType("hkxVertexDescription::ElementDecl")
+        declType.flags = TagFlag.SubType | TagFlag.ByteSize
+        declType.mFormatInfo = TagSubType.Class
+        declType.version = 4
+        declType.byteSize = 20
+        declType.alignment = 4
+
+        for name, offset in (("byteOffset", 0), ("byteStride", 4), ("numElements", 8), ("channelID", 16)):
+            member = TagMember()
+            member.name = name
+            member.byteOffset = offset
+            member.typ = getType("hkUint32")
+            declType.members.append(member)
+
+        types = [declType]
+        saved = TagTypeBackporter.saveTypes(types)
+        try:
+            TagTypeBackporter.backportTypes2012(types)
+
+            layout = TagPackfileLayout()
+            self.assertEqual(layout.getLayout(declType)[0], 20)
+
+            layout = TagPackfileLayout()
+            layout.changedTypes = TagTypeBackporter.getChangedTypes(saved)
+            self.assertEqual(layout.getLayout(declType)[0], 12)
+
+        finally:
+            TagTypeBackporter.restoreTypes(saved)
+
+    @unittest.skipUnless(fixtureNames, "no AssetCc2 packfiles in tests/fixtures/packfiles")
+    def testMatchesAssetCc2(self):
+        for name in fixtureNames:
+            referenceFileName = name + ".hkx"
+            fileName = self.path(os.path.basename(referenceFileName))
+
+            TagPackfileWriter.toFile(fileName, TagXmlParser.fromFile(name + ".xml", loadTypes()),
+                                     readSignatures(referenceFileName))
+
+            self.assertEqual(dumpObject(TagPackfileReader.fromFile(fileName, loadTypes())),
+                             dumpObject(TagPackfileReader.fromFile(referenceFileName, loadTypes())), name)
+            self.assertEqual(readSignatures(fileName), readSignatures(referenceFileName), name)
+
+
+class TestPackfileReader(TempDirTestCase):
+    def testHandMadeFile(self):
+        # fixtures/aabb.hkx was put together by hand from the 2012.2 format,
+        # not by TagPackfileWriter: a 64 byte header (version 11, rules 4101,
+        # root class name at 75 in __classnames__), three 64 byte section
+        # headers, __classnames__ at 256 (112 bytes), an empty __types__ and
+        # __data__ at 368 with
+        #   0  hkRootLevelContainer: array at 16, size 1
+        #   16 NamedVariant: name at 32, className at 48, variant at 64
+        #   32 "aabb", 48 "hkAabb", each padded to 16
+        #   64 hkAabb: min (1, 2, 3, 0), max (4, 5, 6, 0)
+        # followed by the local, global and virtual fixups.
+        fileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "aabb.hkx")
+
+        aabbType = getType("hkAabb")
+        aabb = TagObject({"min": makeVector(getMemberType(aabbType, "min"), [1, 2, 3, 0]),
+                          "max": makeVector(getMemberType(aabbType, "max"), [4, 5, 6, 0])}, aabbType)
+
+        containerType = getType("hkRootLevelContainer")
+        variantsType = getMemberType(containerType, "namedVariants")
+        variantType = variantsType.superType.mSubType
+        variant = TagObject({"name": TagObject("aabb", getMemberType(variantType, "name")),
+                             "className": TagObject("hkAabb", getMemberType(variantType, "className")),
+                             "variant": TagObject(aabb, getMemberType(variantType, "variant"))}, variantType)
+        expected = TagObject({"namedVariants": TagObject([variant], variantsType)}, containerType)
+
+        self.assertEqual(dumpObject(TagPackfileReader.fromFile(fileName, loadTypes())), dumpObject(expected))
+        self.assertEqual(readSignatures(fileName)["hkAabb"], 0x4a948b16)
+
+    def testMatchesXmlParser(self):
+        # The XML stands in for "AssetCc2 -x" output of the same packfile.
+        graph = makeGraph()
+        fileName = self.path("graph.hkx")
+        TagPackfileWriter.toFile(fileName, graph, signatures)
+
+        xmlFileName = self.path("graph.xml")
+        TagXmlSerializer.toFile(xmlFileName, graph, TagTypeBackporter.backportTypes2012)
+
+        self.assertEqual(dumpObject(TagPackfileReader.fromFile(fileName, loadTypes())),
+                         dumpObject(TagXmlParser.fromFile(xmlFileName, loadTypes())))
+
+    @unittest.skipUnless(fixtureNames, "no AssetCc2 packfiles in tests/fixtures/packfiles")
+    def testMatchesAssetCc2(self):
+        for name in fixtureNames:
+            self.assertEqual(dumpObject(TagPackfileReader.fromFile(name + ".hkx", loadTypes())),
+                             dumpObject(TagXmlParser.fromFile(name + ".xml", loadTypes())), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import StringIO
+import threading
+import unittest
+
+from common import *
+
+
+class MeasuringPipeline(TagConversionPipeline):
+    # Tracks the bytes of the inputs read and not yet written.
+    def __init__(self, *args):
+        TagConversionPipeline.__init__(self, *args)
+        self.lock = threading.Lock()
+        self.held = 0
+        self.maxHeld = 0
+
+        release = self.budget.release
+
+        def releaseAndCount(size):
+            with self.lock:
+                self.held -= size
+
+            release(size)
+
+        self.budget.release = releaseAndCount
+
+    def readJob(self, job):
+        TagConversionPipeline.readJob(self, job)
+
+        with self.lock:
+            self.held += len(job.data)
+            self.maxHeld = max(self.maxHeld, self.held)
+
+
+class TestConversionPipeline(TempDirTestCase):
+    def runPipeline(self, pipeline, jobs):
+        finished = []
+        thread = threading.Thread(target=lambda: finished.extend(pipeline.run(jobs)))
+        thread.daemon = True
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            thread.start()
+            thread.join(60)
+
+        finally:
+            sys.stdout = stdout
+
+        self.assertFalse(thread.is_alive(), "pipeline is stuck")
+        return finished
+
+    def testSmallBudget(self):
+        # Every job holds more than half of the budget, so the reader has to
+        # wait for each one to be written before reading the next.
+        fileName = self.path("graph.hkx")
+        TagWriter.toFile(fileName, makeGraph(1, 4))
+        size = os.path.getsize(fileName)
+
+        jobs = [TagConversionJob(fileName, TagFileType.Object, None, self.path("out{}.xml".format(x)))
+                for x in xrange(3)]
+
+        for processes in (1, 2):
+            pipeline = MeasuringPipeline(processes, size * 3 / 2, 1)
+            finished = self.runPipeline(pipeline, jobs)
+
+            # Budget is taken before reading, so no second input is read
+            # while the first is still held.
+            self.assertEqual(pipeline.maxHeld, size)
+
+            self.assertEqual(len(finished), 3)
+            for job in finished:
+                self.assertEqual(job.error, None)
+                self.assertTrue(os.path.exists(job.outputFileName))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from common import *
+
+
+class TestTypeReport(TempDirTestCase):
+    def testCounts(self):
+        fileName = self.path("graph.hkx")
+        TagWriter.toFile(fileName, makeGraph(1, 4))
+        report = TagTypeReport.fromFile(fileName)
+
+        rows = {x["type"]: (x["items"], x["elements"], x["bytes"], x["padding"]) for x in report.sortedRows()
+                if x["items"]}
+
+        # DATA holds the container (16 bytes), its variant (24), the strings
+        # "skeleton 0" twice, "hkaSkeleton" and the four bone names, the
+        # skeleton (144), 4 parent indices, 4 bones of 16 bytes and 4
+        # transforms of 48. Padding comes before the second string (to 2),
+        # the parent indices (to 2), the bones (to 8) and the transforms
+        # (to 16).
+        self.assertEqual(rows, {
+            "hkRootLevelContainer": (1, 1, 16, 0),
+            "hkRootLevelContainer::NamedVariant": (1, 1, 24, 0),
+            "hkaSkeleton": (1, 1, 144, 0),
+            "char": (7, 58, 58, 1),
+            "hkInt16": (1, 4, 8, 1),
+            "hkaBone": (1, 4, 64, 4),
+            "hkQsTransform": (1, 4, 192, 8)})
+
+        # Variant name, class name, skeleton name and bone names, then one
+        # each for the variant pointer and the four arrays.
+        self.assertEqual(sum(x["patches"] for x in report.rows.itervalues()), 12)
+        self.assertEqual(report.fileSize, os.path.getsize(fileName))
+
+
+if __name__ == "__main__":
+    unittest.main()
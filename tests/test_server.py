@@ -0,0 +1,47 @@
+import StringIO
+import json
+import unittest
+
+from common import *
+
+
+class TestConversionServer(TempDirTestCase):
+    def testRequestsMustBeObjects(self):
+        server = TagConversionServer()
+        output = StringIO.StringIO()
+        server.serveStream(StringIO.StringIO('[1]\n"convert"\n{"id": 2, "command": "ping"}\n'), output)
+
+        responses = [json.loads(x) for x in output.getvalue().splitlines()]
+        self.assertEqual([x["status"] for x in responses], ["error", "error", "ok"])
+        self.assertEqual(responses[2]["id"], 2)
+
+    def testOptionsReachTheWriter(self):
+        graphFileName = self.path("graph.graph")
+        TagGraphSerializer.toFile(graphFileName, makeGraph())
+
+        expectedFileName = self.path("expected.hkx")
+        TagWriter.toFile(expectedFileName, TagGraphParser.fromFile(graphFileName, True), None, compactLayout=True)
+
+        outputFileName = self.path("output.hkx")
+        response = TagConversionServer().handle({"args": [graphFileName, outputFileName],
+                                                 "options": {"compact-layout": ""}})
+
+        self.assertEqual(response["status"], "ok", response.get("error"))
+        with open(expectedFileName, "rb") as expected, open(outputFileName, "rb") as output:
+            self.assertEqual(output.read(), expected.read())
+
+    def testCompendiumIsReloadedWhenChanged(self):
+        fileName = self.path("compendium.hkx")
+        TagCompendiumBuilder().toFile(fileName)
+        compendium = TagConversionPipeline.getCompendium(fileName)
+        self.assertTrue(TagConversionPipeline.getCompendium(fileName) is compendium)
+
+        with open(fileName, "ab") as f:
+            f.write("\0" * 4)
+
+        self.assertFalse(TagConversionPipeline.getCompendium(fileName) is compendium)
+        del TagConversionPipeline.compendiums[fileName]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+from common import *
+
+
+class TestGraphSnapshots(TempDirTestCase):
+    def testVersionMakesSnapshotsStale(self):
+        fileName = self.path("graph.hkx")
+        TagWriter.toFile(fileName, makeGraph(1, 4))
+        snapshots = TagGraphSnapshots(self.path("snapshots"))
+
+        decodes = []
+        decodeFile = TagReader.decodeFile
+        TagReader.decodeFile = staticmethod(lambda *args: decodes.append(args) or decodeFile(*args))
+        version = TagGraphSnapshots.version
+        try:
+            expected = dumpObject(snapshots.load(fileName))
+            self.assertEqual(dumpObject(snapshots.load(fileName)), expected)
+            self.assertEqual(len(decodes), 1)
+
+            TagGraphSnapshots.version += 1
+            self.assertEqual(dumpObject(snapshots.load(fileName)), expected)
+            self.assertEqual(len(decodes), 2)
+
+        finally:
+            TagReader.decodeFile = staticmethod(decodeFile)
+            TagGraphSnapshots.version = version
+
+
+if __name__ == "__main__":
+    unittest.main()
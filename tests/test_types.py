@@ -0,0 +1,74 @@
+import unittest
+
+from common import *
+
+
+def makeType(name, byteSize, members=()):
+    typ = TagType(name)
+    typ.flags = TagFlag.SubType | TagFlag.ByteSize
+    typ.mFormatInfo = TagSubType.Class if members else TagSubType.Int | TagSubType.Int32
+    typ.byteSize = byteSize
+    typ.alignment = 4
+
+    for i, memberType in enumerate(members):
+        member = TagMember()
+        member.name = "m{}".format(i)
+        member.byteOffset = i * 4
+        member.typ = memberType
+        typ.members.append(member)
+
+    return typ
+
+
+class TestTypeInterner(unittest.TestCase):
+    def tearDown(self):
+        TagTypeInterner.types = {}
+        TagTypeInterner.sections = {}
+
+    def testUnhashedReferencesAreComparedInFull(self):
+        # Same names, no hashes, but the member types differ in size.
+        first = makeType("Outer", 4, [makeType("Inner", 4)])
+        second = makeType("Outer", 4, [makeType("Inner", 8)])
+
+        firstTypes = TagTypeInterner.intern([None, first, first.members[0].typ])
+        secondTypes = TagTypeInterner.intern([None, second, second.members[0].typ])
+
+        self.assertFalse(firstTypes[1] is secondTypes[1])
+        self.assertEqual(secondTypes[1].members[0].typ.byteSize, 8)
+
+    def testEqualTypesAreShared(self):
+        first = makeType("Outer", 4, [makeType("Inner", 4)])
+        second = makeType("Outer", 4, [makeType("Inner", 4)])
+
+        firstTypes = TagTypeInterner.intern([None, first, first.members[0].typ])
+        secondTypes = TagTypeInterner.intern([None, second, second.members[0].typ])
+
+        self.assertTrue(firstTypes[1] is secondTypes[1])
+        self.assertTrue(firstTypes[2] is secondTypes[2])
+
+    def testCyclesEnd(self):
+        node = makeType("Node", 8)
+        pointer = makeType("T*", 4)
+        pointer.mFormatInfo = TagSubType.Pointer
+        pointer.mSubType = node
+        node.mFormatInfo = TagSubType.Class
+        node.members = makeType("Node", 8, [pointer]).members
+
+        types = TagTypeInterner.intern([None, node, pointer])
+        self.assertTrue(types[1] is node)
+
+    def testTablesAreBounded(self):
+        maxSections = TagTypeInterner.maxSections
+        TagTypeInterner.maxSections = 2
+        try:
+            for i in xrange(5):
+                TagTypeInterner.intern([None, makeType("Type{}".format(i), 4)], str(i))
+
+            self.assertTrue(len(TagTypeInterner.sections) <= 3)
+
+        finally:
+            TagTypeInterner.maxSections = maxSections
+
+
+if __name__ == "__main__":
+    unittest.main()
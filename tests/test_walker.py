@@ -0,0 +1,36 @@
+import unittest
+import xml.etree.ElementTree as ET
+
+from common import *
+
+
+def getValues(obj):
+    values = []
+    while obj != None:
+        values.append(obj.value["value"].value)
+        obj = obj.value["next"].value
+
+    return values
+
+
+class TestDeepGraphs(TempDirTestCase):
+    def testDeeperThanRecursionLimit(self):
+        length = sys.getrecursionlimit() * 2
+        expected = range(length - 1, -1, -1)
+
+        fileName = self.path("deep.hkx")
+        TagWriter.toFile(fileName, makeList(length))
+        obj = TagReader.decodeFile(fileName)
+        self.assertEqual(getValues(obj), expected)
+
+        graphFileName = self.path("deep.graph")
+        TagGraphSerializer.toFile(graphFileName, obj)
+        self.assertEqual(getValues(TagGraphParser.fromFile(graphFileName)), expected)
+
+        xmlFileName = self.path("deep.xml")
+        TagXmlSerializer.toFile(xmlFileName, obj)
+        self.assertEqual(len(ET.parse(xmlFileName).getroot().findall("object")), length)
+
+
+if __name__ == "__main__":
+    unittest.main()
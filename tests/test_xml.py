@@ -0,0 +1,31 @@
+import unittest
+
+from common import *
+
+
+def makeStorage():
+    """A hkcdStaticTree::DynamicStorage<Codec3Axis4> with one node, which XML
+    names hkcdStaticTreeDynamicStorage4."""
+    storageType = next(x for x in loadTypes()[1:] if x.name == "hkcdStaticTree::DynamicStorage" and
+                       TagXmlSerializer().getTypeName(x, True) == "hkcdStaticTreeDynamicStoragehkcdStaticTreeCodec3Axis4")
+    nodesType = getMemberType(storageType, "nodes")
+    nodeType = nodesType.superType.mSubType
+
+    node = TagObject({"data": TagObject(1, getMemberType(nodeType, "data"))}, nodeType)
+    return TagObject({"nodes": TagObject([node], nodesType)}, storageType)
+
+
+class TestXmlSerializer(unittest.TestCase):
+    def testSpecialNamesInEveryFile(self):
+        # Types are shared between files, so the second file must declare the
+        # special class just like the first.
+        for i in xrange(2):
+            root = TagXmlSerializer().serialize(makeStorage())
+
+            classes = [x.get("name") for x in root.findall("class")]
+            self.assertTrue("hkcdStaticTreeDynamicStorage4" in classes)
+            self.assertEqual([x.get("type") for x in root.findall("object")], ["hkcdStaticTreeDynamicStorage4"])
+
+
+if __name__ == "__main__":
+    unittest.main()